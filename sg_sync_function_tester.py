@@ -1,434 +1,4803 @@
+import argparse
+import bisect
+import codecs
+import copy
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import gzip
+import hashlib
+import heapq
+import hmac
+import importlib
+import importlib.util
+import ipaddress
 import json
 import os
+import random
+import re
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from urllib3.util.retry import Retry
+try:
+    import quickjs
+except ImportError:  # Only needed for the offline mode
+    quickjs = None
+try:
+    import orjson
+except ImportError:  # Optional, a faster JSON library
+    orjson = None
+try:
+    import ujson
+except ImportError:  # Optional, a faster JSON library
+    ujson = None
+from datetime import datetime, timedelta, timezone
+import email.utils
+import itertools
 import logging
+from logging.handlers import (
+    QueueHandler, QueueListener, RotatingFileHandler
+)
+import math
+import multiprocessing
+import queue
+import shutil
+import socket
 import sys
+import tarfile
+import threading
 import time
 
+# Buffers the log records of one document so documents processed in
+# parallel still write their lines as one contiguous block
+
+
+class DocLog():
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.records = []
+
+    # Creates the record now so it keeps the time the event happened
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level):
+            self.records.append(self.logger.makeRecord(
+                self.logger.name, level, "(doc)", 0, msg, args,
+                kwargs.get("exc_info"), extra=kwargs.get("extra")
+            ))
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    # Hands the buffered records to the real logger, in order
+    def flush(self):
+        for record in self.records:
+            self.logger.handle(record)
+        self.records.clear()
+
+
+# Swallows the log lines of operations whose results are only measured,
+# such as the ones a load test runs
+
+
+class NullLog():
+
+    def log(self, *args, **kwargs):
+        pass
+
+    debug = info = warning = error = log
+
+
+# A token bucket: acquire() blocks until a token is free, so callers
+# sharing one bucket are held to `rate` per second with bursts of up
+# to `burst`
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Reserve the token now and sleep off the debt outside the
+            # lock, so waiting callers are served in arrival order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+# Caps the HTTP requests in flight and adapts the cap AIMD-style to how
+# Sync Gateway copes: every healthy response adds 1/limit (about one slot
+# per round trip), a 429/503, a failed connection or a latency spike
+# halves it, at most once per round trip. It starts at `minimum` and
+# ramps up to `maximum`. A spike is a response slower than `latency`
+# seconds, or with latency 0, three times the running average. Requests
+# Sync Gateway holds open on purpose (longpoll and continuous feeds) are
+# released with sample=False: they say nothing about its latency, so
+# only a throttled or failed one changes the limit
+
+
+class AdaptiveConcurrency():
+
+    WARMUP = 20  # Responses averaged before spikes are looked for
+
+    def __init__(self, maximum, minimum=1, latency=0.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(self.minimum)
+        self.latency = latency
+        self.average = None
+        self.samples = 0
+        self.inFlight = 0
+        self.lowest = self.highest = self.limit
+        self.decreases = 0
+        self.lastDecrease = 0.0
+        self.condition = threading.Condition()
+
+    # Waits for a free slot
+    def acquire(self):
+        with self.condition:
+            while self.inFlight >= int(self.limit):
+                self.condition.wait()
+            self.inFlight += 1
+
+    # Frees a slot and adjusts the limit for how the request went
+    def release(self, elapsed, throttled=False, failed=False, sample=True):
+        with self.condition:
+            self.inFlight -= 1
+            if throttled or failed or (sample and self.isSpike(elapsed)):
+                now = time.monotonic()
+                if now - self.lastDecrease >= (self.average or elapsed):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.lowest = min(self.lowest, self.limit)
+                    self.decreases += 1
+                    self.lastDecrease = now
+            elif sample:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.highest = max(self.highest, self.limit)
+            if sample and not throttled and not failed:
+                self.samples += 1
+                self.average = elapsed if self.average is None \
+                    else self.average * 0.9 + elapsed * 0.1
+            self.condition.notify_all()
+
+    def isSpike(self, elapsed):
+        if self.latency:
+            return elapsed > self.latency
+        return self.samples >= self.WARMUP and elapsed > 3 * self.average
+
+    def summary(self):
+        with self.condition:
+            return {"limit": int(self.limit), "lowest": int(self.lowest),
+                    "highest": int(self.highest),
+                    "decreases": self.decreases}
+
+
+# Counts how Sync Gateway pushed back during a run (throttled responses,
+# retries, time spent waiting) and holds the retry budget: retries may
+# add at most `ratio` of the requests sent, plus `minimum`, so an
+# overloaded server does not get a second wave of retried requests
+
+
+class Backpressure():
+
+    def __init__(self, ratio=0.1, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+
+    # Takes a retry from the budget, if there is one left
+    def allowRetry(self):
+        with self.lock:
+            if self.counts["retries"] < \
+                    self.minimum + self.ratio * self.counts["requests"]:
+                self.counts["retries"] += 1
+                return True
+            self.counts["retryBudgetExhausted"] += 1
+            return False
+
+    def summary(self):
+        with self.lock:
+            counts = dict(self.counts)
+        for key in ("rateLimitWaitSeconds", "retryWaitSeconds"):
+            counts[key] = round(counts.get(key, 0.0), 3)
+        return counts
+
+
+# Seconds a Retry-After header asks to wait: a number of seconds or an
+# HTTP date. None when there is no usable header
+def retryAfterSeconds(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+# A latency distribution in constant memory. Samples fall into
+# logarithmic buckets 1% wide, so percentiles are within 1% of the exact
+# value while count, errors, mean and max are exact
+
+
+class LatencyHistogram():
+
+    GROWTH = 1.01
+    FLOOR = 1e-6  # One microsecond, the smallest bucket
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    # Records one sample in seconds, and whether it was an error
+    def record(self, seconds, ok=True):
+        index = int(math.log(max(seconds, self.FLOOR) / self.FLOOR,
+                             self.GROWTH))
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if not ok:
+                self.errors += 1
+
+    # Adds the samples of another histogram to this one
+    def merge(self, other):
+        with self.lock:
+            for index, count in other.buckets.items():
+                self.buckets[index] = self.buckets.get(index, 0) + count
+            self.count += other.count
+            self.errors += other.errors
+            self.total += other.total
+            self.max = max(self.max, other.max)
+
+    # The samples as a JSON-safe dict, e.g. to send a shard's timings to
+    # the coordinator
+    def state(self):
+        with self.lock:
+            return {"buckets": dict(self.buckets), "count": self.count,
+                    "errors": self.errors, "total": self.total,
+                    "max": self.max}
+
+    # A histogram rebuilt from state()
+    @classmethod
+    def fromState(cls, state):
+        histogram = cls()
+        histogram.buckets = {int(index): count
+                             for index, count in state["buckets"].items()}
+        histogram.count = state["count"]
+        histogram.errors = state["errors"]
+        histogram.total = state["total"]
+        histogram.max = state["max"]
+        return histogram
+
+    # The latency in seconds below which `percent` % of the samples fall
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.FLOOR * self.GROWTH ** (index + 1), self.max)
+        return self.max
+
+    # Count, errors and latencies in milliseconds as a plain dict
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total / self.count * 1000, 3)
+            if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p95_ms": round(self.percentile(95) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3)
+        }
+
+
+# Latency histograms keyed by a tuple of labels, for example
+# (operation, user), created on first use
+
+
+class LatencyReport():
+
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, labels):
+        histogram = self.series.get(labels)
+        if histogram is None:
+            with self.lock:
+                histogram = self.series.setdefault(labels,
+                                                   LatencyHistogram())
+        return histogram
+
+    def record(self, labels, seconds, ok=True):
+        self.histogram(labels).record(seconds, ok)
+
+    # Summaries keyed by the labels joined with "|"
+    def summary(self):
+        return {
+            "|".join(str(label) for label in labels): histogram.summary()
+            for labels, histogram in sorted(self.series.items())
+        }
+
+    # Every series as a JSON-safe list of [labels, histogram state]
+    def state(self):
+        return [[list(labels), histogram.state()]
+                for labels, histogram in list(self.series.items())]
+
+    # Adds the series of a state() to this report
+    def mergeState(self, state):
+        for labels, histogram in state:
+            self.histogram(tuple(labels)).merge(
+                LatencyHistogram.fromState(histogram)
+            )
+
+
+# The `limit` slowest operations of a run with the document they ran on,
+# labelled like a LatencyReport, e.g. (operation, admin/user, doc ID). A
+# min-heap keeps only those, so memory does not grow with the corpus
+
+
+class SlowestDocs():
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def record(self, labels, seconds, ok=True):
+        if self.limit <= 0:
+            return
+        entry = (seconds, [str(label) for label in labels], ok)
+        with self.lock:
+            if len(self.heap) < self.limit:
+                heapq.heappush(self.heap, entry)
+            elif seconds > self.heap[0][0]:
+                heapq.heapreplace(self.heap, entry)
+
+    # Slowest first, with the labels joined with "|"
+    def summary(self):
+        with self.lock:
+            entries = sorted(self.heap, reverse=True)
+        return [{"labels": "|".join(labels), "ms": round(seconds * 1000, 3),
+                 "ok": ok} for seconds, labels, ok in entries]
+
+    def state(self):
+        with self.lock:
+            return [list(entry) for entry in self.heap]
+
+    def mergeState(self, state):
+        for seconds, labels, ok in state:
+            self.record(labels, seconds, ok)
+
+
+# Encodes JSON to compact UTF-8 bytes and decodes it from bytes or text
+# with the library named by jsonLibrary: "orjson", "ujson", "json" (the
+# standard library), or "auto" for the fastest one installed. Request
+# bodies are sent as these bytes, and responses are parsed from their
+# bytes without decoding them to text first
+
+
+class JsonCodec():
+
+    def __init__(self, library="auto"):
+        if library == "auto":
+            library = "orjson" if orjson else "ujson" if ujson else "json"
+        if library == "orjson" and orjson:
+            self.dumps = orjson.dumps
+            self.loads = orjson.loads
+        elif library == "ujson" and ujson:
+            self.dumps = self.ujsonDumps
+            self.loads = ujson.loads
+        elif library == "json":
+            self.dumps = self.stdlibDumps
+            self.loads = json.loads
+        else:
+            raise Exception(f"JSON library '{library}' is not installed.")
+        self.name = library
+
+    @staticmethod
+    def ujsonDumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+
+    @staticmethod
+    def stdlibDumps(obj):
+        return json.dumps(obj, ensure_ascii=False,
+                          separators=(",", ":")).encode()
+
+
+# Streams fixture documents one at a time so memory stays flat however
+# large the corpus is. A source is a folder (scanned lazily with
+# os.scandir), a .json file, a .jsonl/.ndjson file with one document per
+# line, a gzip'd version of either, or a .tar/.tar.gz/.tgz archive of them
+
+
+class FixtureSource():
+
+    JSON_SUFFIXES = (".json", ".json.gz")
+    JSONL_SUFFIXES = (".jsonl", ".ndjson", ".jsonl.gz", ".ndjson.gz")
+    TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz")
+
+    def __init__(self, paths, logger=None, loads=json.loads):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.logger = logger or logging.getLogger()
+        self.loads = loads
+
+    def __iter__(self):
+        for path in self.paths:
+            for json_data in self.iterPath(path):
+                if isinstance(json_data, dict) and json_data.get("_id"):
+                    yield json_data
+
+    # Dispatches on the kind of path
+    def iterPath(self, path):
+        name = path.lower()
+        if os.path.isdir(path):
+            yield from self.iterFolder(path)
+        elif name.endswith(self.TAR_SUFFIXES):
+            yield from self.iterTar(path)
+        elif name.endswith(self.JSONL_SUFFIXES):
+            with self.openFile(path) as f:
+                yield from self.iterLines(f, path)
+        elif name.endswith(self.JSON_SUFFIXES):
+            with self.openFile(path) as f:
+                yield from self.iterJson(f, path)
+
+    # Walks a folder entry by entry instead of listing it up front
+    def iterFolder(self, folder):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(
+                    self.JSON_SUFFIXES + self.JSONL_SUFFIXES
+                    + self.TAR_SUFFIXES
+                ):
+                    yield from self.iterPath(entry.path)
+
+    # Streams the .json and .jsonl members of a tar archive in order
+    def iterTar(self, path):
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                name = member.name.lower()
+                if not member.isfile():
+                    continue
+                if name.endswith(self.JSONL_SUFFIXES + self.JSON_SUFFIXES):
+                    # Members of a streamed archive are not seekable
+                    f = archive.extractfile(member)
+                    if name.endswith(".gz"):
+                        f = gzip.GzipFile(fileobj=f)
+                    if name.endswith(self.JSONL_SUFFIXES):
+                        yield from self.iterLines(f, f"{path}:{member.name}")
+                    else:
+                        yield from self.iterJson(f, f"{path}:{member.name}")
+
+    # Opens a plain or gzip'd file as bytes, which the JSON libraries
+    # parse without a decode to text first
+    def openFile(self, path):
+        if path.lower().endswith(".gz"):
+            return gzip.open(path, "rb")
+        return open(path, "rb")
+
+    # A .json file holds one document, or a list of documents
+    def iterJson(self, f, name):
+        json_data = self.loads(f.read())
+        if isinstance(json_data, list):
+            yield from json_data
+        else:
+            yield json_data
+
+    # One document per line, text or bytes; blank lines are ignored and
+    # bad lines are logged and skipped so one typo does not end a long run
+    def iterLines(self, f, name):
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield self.loads(line)
+            except ValueError:  # Every library's decode error is one
+                self.logger.warning(
+                    f"[failed] - [LOAD] - Invalid JSON on line "
+                    f"{line_number} of {name} - skipped"
+                )
+
+
+# What one operation did for one user (or "Admin") on one document.
+# "allowed" is whether Sync Gateway let it happen; for CHANGES it is
+# whether the document showed up in the user's feed. "channels" are the
+# channels the document is currently assigned to, when the operation
+# reports them (GET_RAW)
+
+
+class OpOutcome():
+
+    __slots__ = ("doc_id", "op", "user", "status", "allowed", "channels",
+                 "rev", "elapsed", "http", "keyspace")
+
+    def __init__(self, doc_id, op, user, status, allowed=None,
+                 channels=None, rev=None, elapsed=0.0, http=None,
+                 keyspace=None):
+        self.doc_id = doc_id
+        self.op = op
+        self.user = user
+        self.status = status
+        self.allowed = status == "success" if allowed is None else allowed
+        self.channels = channels
+        self.rev = rev
+        self.elapsed = elapsed
+        self.http = http
+        self.keyspace = keyspace
+
+
+# Outcome details found in a GET_RAW response: the current revision and
+# the channels the document is in now (removed channels carry a value)
+def rawOutcome(raw):
+    sync = raw.get("_sync") or {}
+    rev = sync.get("rev")
+    if isinstance(rev, dict):
+        rev = rev.get("rev")
+    channels = sorted(
+        channel for channel, removed in (sync.get("channels") or {}).items()
+        if removed is None
+    )
+    return {"rev": rev, "channels": channels}
+
+
+# The generation of a revision ID ("3-abc" is 3), None when it has none
+def revGeneration(rev):
+    generation = str(rev).split("-", 1)[0]
+    return int(generation) if generation.isdigit() else None
+
+
+# The shape of a document's revision tree in a GET_RAW response: the
+# current revision, its generation (the depth of the tree), and when
+# _sync.history is there the revisions it keeps and how many of them are
+# leaves, i.e. open or tombstoned branches
+def revTree(raw):
+    rev = rawOutcome(raw)["rev"]
+    tree = {"rev": rev, "depth": None, "storedRevs": None, "leaves": None}
+    if rev:
+        tree["depth"] = revGeneration(rev)
+    history = (raw.get("_sync") or {}).get("history") or {}
+    revs = history.get("revs")
+    if revs:
+        parents = {parent for parent in history.get("parents") or []
+                   if parent is not None and parent >= 0}
+        tree["storedRevs"] = len(revs)
+        tree["leaves"] = len(revs) - len(parents)
+    return tree
+
+
+# What a document's _sync metadata holds and weighs, from its GET_RAW
+# response (size is the response's length in bytes): the revision tree,
+# the channels it is in and was removed from, its channel history, the
+# access() and role() grants it makes and its attachments. The document
+# type is its "docType", or else the part of its ID before the first "-"
+SYNC_METRICS = ("bytes", "syncBytes", "revTreeDepth", "storedRevs",
+                "leaves", "channels", "removedChannels", "channelHistory",
+                "accessGrants", "roleGrants", "attachments")
+
+
+def syncMetadata(doc_id, raw, size, dumps):
+    sync = raw.get("_sync") or {}
+    tree = revTree(raw)
+    channels = sync.get("channels") or {}
+    doc_type = raw.get("docType") or (
+        doc_id.split("-", 1)[0] if "-" in doc_id else "(none)")
+    return {
+        "docType": str(doc_type),
+        "bytes": size,
+        "syncBytes": len(dumps(sync)),
+        "revTreeDepth": tree["depth"] or 0,
+        "storedRevs": tree["storedRevs"] or 0,
+        "leaves": tree["leaves"] or 0,
+        "channels": sum(removed is None for removed in channels.values()),
+        "removedChannels": sum(removed is not None
+                               for removed in channels.values()),
+        "channelHistory": len(sync.get("channel_set") or [])
+        + len(sync.get("channel_set_history") or []),
+        "accessGrants": sum(len(granted or {}) for granted in
+                            (sync.get("access") or {}).values()),
+        "roleGrants": sum(len(granted or {}) for granted in
+                          (sync.get("role_access") or {}).values()),
+        "attachments": len(sync.get("attachments") or {})
+    }
+
+
+# Declarative expected results, loaded from a JSON list or a JSONL file of
+# entries such as
+#   {"docId": "foo", "user": "bob", "op": "PUT", "allowed": false}
+#   {"docId": "foo", "user": "Admin", "op": "GET_RAW", "channels": ["bob"]}
+# Entries are indexed by (docId, user, op), and any of the three may be
+# "*", so checking one outcome is a handful of dict lookups however many
+# expectations there are. Mismatches are counted and logged; expectations
+# naming an exact (docId, user, op) that never ran count as failures too
+
+
+class Expectations():
+
+    MAX_DETAILS = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.seen = set()
+        self.checked = 0
+        self.mismatches = 0
+        self.details = []
+        self.lock = threading.Lock()
+        with open(path, "r") as f:
+            if path.lower().endswith((".jsonl", ".ndjson")):
+                entries = (json.loads(line) for line in f if line.strip())
+            else:
+                entries = json.load(f)
+            for entry in entries:
+                key = (entry.get("docId", "*"), entry.get("user", "*"),
+                       entry.get("op", "*"))
+                self.index[key] = entry
+
+    # The most specific expectation for one outcome, if any
+    def lookup(self, doc_id, user, op):
+        for key in itertools.product((doc_id, "*"), (user, "*"), (op, "*")):
+            entry = self.index.get(key)
+            if entry is not None:
+                return key, entry
+        return None, None
+
+    # Outcome listener: compares one outcome with its expectation
+    def check(self, outcome):
+        key, entry = self.lookup(outcome.doc_id, outcome.user, outcome.op)
+        if entry is None:
+            return
+        problems = []
+        if "allowed" in entry and entry["allowed"] != outcome.allowed:
+            problems.append(
+                f"expected {'allowed' if entry['allowed'] else 'denied'}, "
+                f"was {'allowed' if outcome.allowed else 'denied'}"
+            )
+        if "channels" in entry and outcome.channels is not None and \
+                sorted(entry["channels"]) != outcome.channels:
+            problems.append(
+                f"expected channels {sorted(entry['channels'])}, "
+                f"was {outcome.channels}"
+            )
+        with self.lock:
+            self.checked += 1
+            self.seen.add(key)
+            if problems:
+                self.mismatches += 1
+                if len(self.details) < self.MAX_DETAILS:
+                    self.details.append({
+                        "docId": outcome.doc_id, "user": outcome.user,
+                        "op": outcome.op, "problems": problems
+                    })
+        if problems:
+            logging.getLogger().warning(
+                f"[failed] - [EXPECT] - [{outcome.user}] - "
+                f"{outcome.op} on [{outcome.doc_id}] - "
+                f"{'; '.join(problems)}"
+            )
+
+    # What this run checked, as a JSON-safe dict for mergeState()
+    def state(self):
+        with self.lock:
+            return {"checked": self.checked, "mismatches": self.mismatches,
+                    "seen": [list(key) for key in self.seen],
+                    "details": list(self.details)}
+
+    # Adds what another run (e.g. one shard) checked against the same file
+    def mergeState(self, state):
+        with self.lock:
+            self.checked += state["checked"]
+            self.mismatches += state["mismatches"]
+            self.seen.update(tuple(key) for key in state["seen"])
+            self.details.extend(
+                state["details"][:self.MAX_DETAILS - len(self.details)]
+            )
+
+    # Totals for the end of the run; passed is False on any mismatch or
+    # any exact expectation that never ran
+    def report(self):
+        not_run = [
+            {"docId": key[0], "user": key[1], "op": key[2]}
+            for key in self.index
+            if "*" not in key and key not in self.seen
+        ]
+        return {
+            "expectations": len(self.index),
+            "checked": self.checked,
+            "mismatches": self.mismatches,
+            "notRun": len(not_run),
+            "passed": not self.mismatches and not not_run,
+            "details": self.details,
+            "notRunDetails": not_run[:self.MAX_DETAILS]
+        }
+
+
+# Pairs up the outcomes of the same plan run against two targets, "a" and
+# "b", while both runs are going. Outcomes are indexed by a hash of
+# (docId, user, op); once the other target reports the same key the pair
+# is compared and dropped, so the index only holds outcomes one target
+# has reported and the other has not yet. Only pairs that differ in
+# allowed/denied or channel assignment are kept and logged
+
+
+class OutcomeDiff():
+
+    MAX_DETAILS = 1000
+
+    def __init__(self):
+        self.pending = {}
+        self.compared = 0
+        self.changed = 0
+        self.flips = Counter()
+        self.details = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(outcome):
+        return hashlib.blake2b(
+            f"{outcome.doc_id}\x1f{outcome.user}\x1f{outcome.op}".encode(),
+            digest_size=16
+        ).digest()
+
+    # Outcome listener for one side ("a" or "b")
+    def add(self, side, outcome):
+        key = self.key(outcome)
+        value = (outcome.allowed, outcome.channels)
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None or entry[0] == side:
+                if entry is None:
+                    entry = self.pending[key] = (
+                        side, deque(),
+                        (outcome.doc_id, outcome.user, outcome.op)
+                    )
+                entry[1].append(value)
+                return
+            other = entry[1].popleft()
+            if not entry[1]:
+                del self.pending[key]
+            self.compared += 1
+            a, b = (other, value) if side == "b" else (value, other)
+            if a == b:
+                return
+            self.changed += 1
+            flip = f"{outcome.op}:" + (
+                f"{'allowed' if a[0] else 'denied'}->"
+                f"{'allowed' if b[0] else 'denied'}"
+                if a[0] != b[0] else "channels"
+            )
+            self.flips[flip] += 1
+            if len(self.details) < self.MAX_DETAILS:
+                self.details.append({
+                    "docId": outcome.doc_id, "user": outcome.user,
+                    "op": outcome.op,
+                    "a": {"allowed": a[0], "channels": a[1]},
+                    "b": {"allowed": b[0], "channels": b[1]}
+                })
+        logging.getLogger().warning(
+            f"[failed] - [DIFF] - [{outcome.user}] - {outcome.op} on "
+            f"[{outcome.doc_id}] - a: {'allowed' if a[0] else 'denied'}"
+            f"{f' {a[1]}' if a[1] is not None else ''}, "
+            f"b: {'allowed' if b[0] else 'denied'}"
+            f"{f' {b[1]}' if b[1] is not None else ''}"
+        )
+
+    # Totals once both runs are done; outcomes still pending only ran on
+    # one side
+    def report(self):
+        only = Counter()
+        only_details = []
+        for side, values, names in self.pending.values():
+            only[side] += len(values)
+            if len(only_details) < self.MAX_DETAILS:
+                only_details.append({"docId": names[0], "user": names[1],
+                                     "op": names[2], "side": side})
+        return {
+            "compared": self.compared,
+            "changed": self.changed,
+            "onlyInA": only["a"],
+            "onlyInB": only["b"],
+            "identical": not self.changed and not only,
+            "flips": dict(sorted(self.flips.items())),
+            "details": self.details,
+            "onlyDetails": only_details
+        }
+
+
+# Assigns document IDs to shards by consistent hashing: every shard owns
+# `replicas` points on a ring of 64-bit blake2b hashes and a document goes
+# to the shard owning the first point at or after the hash of its _id. A
+# document always lands on the same shard for the same number of shards
+# (so a resumed shard finds its own journal entries), and going from n to
+# n + 1 shards only moves about 1/(n + 1) of the documents
+
+
+class HashRing():
+
+    def __init__(self, shards, replicas=64):
+        self.shards = shards
+        points = sorted(
+            (self.hash(f"shard-{shard}-{replica}"), shard)
+            for shard in range(shards) for replica in range(replicas)
+        )
+        self.points = [point for point, shard in points]
+        self.owners = [shard for point, shard in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+        )
+
+    # The shard (0 .. shards - 1) a document ID belongs to
+    def owner(self, doc_id):
+        index = bisect.bisect_left(self.points, self.hash(str(doc_id)))
+        return self.owners[index % len(self.points)]
+
+
+# Append-only journal of the steps a run has completed, one JSON line per
+# (keyspace, docId, step, user) with the document's cached revision after
+# the step. Lines are fsync'd every syncEvery records and on close. When
+# resuming, the journal is read back (a line cut short by a crash is
+# dropped) so finished steps are skipped and the revision cache restored.
+# The first line records batchMode: batch mode journals admin steps once
+# per document as "Admin", the other mode once per test user, so one
+# mode cannot resume the journal of the other
+
+
+class Checkpoint():
+
+    def __init__(self, path, resume=False, syncEvery=100, batchMode=False):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.done = set()
+        self.revs = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        good = 0
+        journaled = None
+        if resume and os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if "ks" not in entry:
+                        journaled = entry.get("batchMode")
+                        continue
+                    key = (entry["ks"], entry["doc"])
+                    self.done.add(key + (entry["step"], entry["user"]))
+                    self.revs[key] = entry.get("rev")
+        if journaled is not None and journaled != batchMode:
+            raise Exception(
+                f"{path} was written with batchMode {journaled}, resume "
+                f"it with the same batchMode or run without --resume."
+            )
+        self.file = open(path, "r+" if good else "w")
+        self.file.truncate(good)
+        self.file.seek(good)
+        if not good:
+            self.file.write(json.dumps({"batchMode": batchMode}) + "\n")
+
+    def isDone(self, keyspace, doc_id, step, user):
+        return (keyspace, doc_id, step, user) in self.done
+
+    def record(self, keyspace, doc_id, step, user, rev=None):
+        line = json.dumps({"ks": keyspace, "doc": doc_id, "step": step,
+                           "user": user, "rev": rev})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.pending += 1
+            if self.pending >= self.syncEvery:
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.sync()
+                self.file.close()
+
+
+# Decodes a _changes response row by row as its text arrives, never
+# holding the whole feed. feed=continuous sends one JSON object per line;
+# normal and longpoll feeds send one object whose "results" array is
+# decoded one row at a time. last_seq is set once the feed has been read
+
+
+class ChangesReader():
+
+    RESULTS = re.compile(r'"results"\s*:\s*\[')
+    LAST_SEQ = re.compile(r'"last_seq"\s*:\s*("(?:[^"\\]|\\.)*"|[^,}\s]+)')
+
+    def __init__(self, chunks, continuous=False, loads=json.loads):
+        self.chunks = chunks
+        self.continuous = continuous
+        self.loads = loads
+        self.last_seq = None
+
+    def __iter__(self):
+        if self.continuous:
+            return self.iterLines()
+        return self.iterResults()
+
+    def iterLines(self):
+        buffer = ""
+        for chunk in itertools.chain(self.chunks, ["\n"]):
+            buffer += chunk
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue  # heartbeat
+                row = self.loads(line)
+                if "id" not in row and "last_seq" in row:
+                    self.last_seq = row["last_seq"]
+                else:
+                    self.last_seq = row.get("seq", self.last_seq)
+                    yield row
+
+    def iterResults(self):
+        decoder = json.JSONDecoder()
+        buffer = ""
+        head = ""
+        state = "head"
+        for chunk in self.chunks:
+            buffer += chunk
+            if state == "head":
+                match = self.RESULTS.search(buffer)
+                if not match:
+                    continue
+                head = buffer[:match.start()]
+                buffer = buffer[match.end():]
+                state = "rows"
+            if state == "rows":
+                pos = 0
+                while True:
+                    while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                        pos += 1
+                    if pos == len(buffer):
+                        break
+                    if buffer[pos] == "]":
+                        state = "tail"
+                        break
+                    try:
+                        row, pos = decoder.raw_decode(buffer, pos)
+                    except json.JSONDecodeError:
+                        break  # The row is not complete yet
+                    self.last_seq = row.get("seq", self.last_seq)
+                    yield row
+                buffer = buffer[pos:]
+        # last_seq sits after the results, or before them in the head
+        for text in (buffer, head):
+            match = self.LAST_SEQ.search(text)
+            if match:
+                self.last_seq = json.loads(match.group(1))
+                break
+
+
+# The outcome of one HTTP call: the status code (None when no response
+# came back), the parsed JSON body (None on errors or an empty body) and
+# the bytes it was parsed from, the total time on a monotonic clock and,
+# when known, the time until the response headers arrived
+
+
+class HttpResult():
+
+    __slots__ = ("status", "body", "elapsed", "server", "raw")
+
+    def __init__(self, status=None, body=None, elapsed=0.0, server=None,
+                 raw=None):
+        self.status = status
+        self.body = body
+        self.elapsed = elapsed
+        self.server = server
+        self.raw = raw
+
+
+# Sums the HTTP calls one operation made into the timing attached to its
+# log records and metrics, in milliseconds. "server" is the time until the
+# response headers arrived and "transfer" the rest of "total"
+def summarizeTimings(calls):
+    total = sum(call.elapsed for call in calls)
+    timing = {"requests": len(calls), "total_ms": round(total * 1000, 3)}
+    if calls and all(call.server is not None for call in calls):
+        server = sum(call.server for call in calls)
+        timing["server_ms"] = round(server * 1000, 3)
+        timing["transfer_ms"] = round(max(total - server, 0) * 1000, 3)
+    return timing
+
+
+# Wraps an operation's log so every record it writes carries the timing
+# of the HTTP calls the operation has made so far
+
+
+class TimedLog():
+
+    def __init__(self, log, calls):
+        self.inner = log
+        self.calls = calls
+
+    def log(self, level, msg, *args, **kwargs):
+        kwargs["extra"] = dict(kwargs.get("extra") or {},
+                               timing=summarizeTimings(self.calls))
+        self.inner.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+
+# Log formatter that appends an operation's timing, and the keyspace of a
+# multi-keyspace run, when the record carries them, to the usual line
+
+
+class TimingFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = super().format(record)
+        timing = getattr(record, "timing", None)
+        if timing and timing.get("requests"):
+            line += " - [" + " ".join(
+                f"{key[:-3] if key.endswith('_ms') else key}:"
+                f"{value}{'ms' if key.endswith('_ms') else ''}"
+                for key, value in timing.items()
+            ) + "]"
+        keyspace = getattr(record, "keyspace", None)
+        if keyspace:
+            line += f" - [keyspace:{keyspace}]"
+        return line
+
+
+# Writes records whose message is a dict as compact JSON lines, with the
+# time the record was made. Used for the results and bodies files
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {"ts": round(record.created, 3)}
+        raw = {}
+        for key, value in record.msg.items():
+            # Already encoded JSON, e.g. a response body as received, is
+            # written as it is
+            if isinstance(value, bytes) and b"\n" not in value:
+                raw[key] = value
+            elif isinstance(value, bytes):
+                entry[key] = json.loads(value)
+            else:
+                entry[key] = value
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        for key, value in raw.items():
+            line = f"{line[:-1]},{json.dumps(key)}:{value.decode()}}}"
+        return line
+
+
+# Queues records as they are, for a QueueListener in the same process.
+# The stock QueueHandler formats every record on the calling thread;
+# leaving that to the listener thread keeps it off the hot path
+
+
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+
+# Rotator for RotatingFileHandler: gzips the file being rotated out
+def gzipRotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+# Offline mode: a stand-in for Sync Gateway that runs the sync function
+# in an embedded QuickJS engine, in-process. Documents, their channels and
+# the access()/role() grants they make are kept in memory, so a whole
+# corpus can be checked against a sync function in seconds without a
+# running Sync Gateway. Each operation gives the same allow/deny, log
+# line and outcome as the HTTP path:
+#   PUT / DELETE  run the sync function as the user (admin bypasses the
+#                 require* checks), then store the document or tombstone
+#   GET           allowed when the user can see one of the doc's channels
+#   CHANGES       allowed when the document is visible in the user's feed;
+#                 only the current document is looked at
+#   GET_RAW       the document with a _sync holding its rev, channels and
+#                 grants, shaped as Sync Gateway's: access and role_access
+#                 map user/role -> channel/role -> sequence, where the
+#                 sequence counts the writes of this run
+#   PURGE         forgets the document and its grants
+# Test users may list "roles" and "channels" (their admin_roles and
+# admin_channels) in sgTestUsers for the require* checks
+
+
+class OfflineGateway():
+
+    PRELUDE = """
+var __user = null, __result = null;
+function __list(v) {
+    if (v === null || v === undefined) return [];
+    return Array.isArray(v) ? v : [v];
+}
+function __forbidden(message) { throw({forbidden: message}); }
+function channel() {
+    for (var i = 0; i < arguments.length; i++)
+        __result.channels = __result.channels.concat(__list(arguments[i]));
+}
+function access(users, channels) {
+    __result.access.push([__list(users), __list(channels)]);
+}
+function role(users, roles) {
+    __result.roles.push([__list(users), __list(roles)]);
+}
+function expiry(value) { __result.expiry = value; }
+function requireAdmin() {
+    if (!__user.admin) __forbidden("sg admin required");
+}
+function requireUser(names) {
+    if (__user.admin) return;
+    if (__list(names).indexOf(__user.name) < 0) __forbidden("wrong user");
+}
+function requireRole(roles) {
+    if (__user.admin) return;
+    var wanted = __list(roles);
+    for (var i = 0; i < wanted.length; i++)
+        if (__user.roles.indexOf(wanted[i]) >= 0) return;
+    __forbidden("missing role");
+}
+function requireAccess(channels) {
+    if (__user.admin || __user.channels.indexOf("*") >= 0) return;
+    var wanted = __list(channels);
+    for (var i = 0; i < wanted.length; i++)
+        if (__user.channels.indexOf(wanted[i]) >= 0) return;
+    __forbidden("missing channel access");
+}
+function __run(docJson, oldDocJson, userJson) {
+    __user = JSON.parse(userJson);
+    __result = {channels: [], access: [], roles: [], expiry: null};
+    try {
+        __syncFunction(JSON.parse(docJson),
+                       oldDocJson ? JSON.parse(oldDocJson) : null, {});
+    } catch (e) {
+        if (e && e.forbidden)
+            return JSON.stringify({allowed: false, status: 403,
+                                   reason: String(e.forbidden)});
+        if (e && e.unauthorized)
+            return JSON.stringify({allowed: false, status: 401,
+                                   reason: String(e.unauthorized)});
+        return JSON.stringify({allowed: false, status: 500,
+                               reason: "Exception in JS sync function: "
+                                       + String(e)});
+    }
+    __result.allowed = true;
+    __result.status = 200;
+    return JSON.stringify(__result);
+}
+"""
+    LEADING_COMMENTS = re.compile(r"^(\s*(//[^\n]*|/\*.*?\*/))*\s*", re.S)
+
+    def __init__(self, work, sync_function_file):
+        if quickjs is None:
+            raise Exception("Offline mode needs the quickjs package: "
+                            "pip install quickjs")
+        with open(sync_function_file, "r") as f:
+            source = self.LEADING_COMMENTS.sub("", f.read(), count=1)
+        self.work = work
+        self.context = quickjs.Context()
+        # Sync Gateway config files hold "function(doc, oldDoc) {...}"
+        # optionally followed by helper functions, so the source is
+        # returned from a wrapper in which the helpers stay in scope
+        self.context.eval(
+            self.PRELUDE
+            + "var __syncFunction = (function () { return "
+            + source + "\n})();"
+        )
+        self.runSync = self.context.get("__run")
+        self.docs = {}
+        self.accessGrants = {}
+        self.roleGrants = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.handlers = {
+            "GET": self.runGet,
+            "PUT": self.runPut,
+            "DELETE": self.runDelete,
+            "CHANGES": self.runChanges,
+            "PURGE": self.runPurge,
+            "GET_RAW": self.runGetRaw
+        }
+
+    # Calls the handler of one operation, one at a time as the JS engine
+    # is single threaded
+    def dispatch(self, op, is_admin, params, json_data, user, log):
+        handler = self.handlers.get(op)
+        if handler is None:
+            return None
+        with self.lock:
+            return handler(json_data, user, is_admin, params, log)
+
+    # What the sync function and the read checks know about a user: the
+    # roles and channels configured for them plus everything granted by
+    # access() and role() calls on the documents stored so far
+    def userContext(self, user, is_admin):
+        if is_admin:
+            return {"name": "", "admin": True, "roles": [], "channels": ["*"]}
+        name = user["userName"]
+        roles = set(user.get("roles", []))
+        roles.update(self.roleGrants.get(name, {}))
+        channels = set(user.get("channels", []))
+        channels.add("!")
+        for principal in [name] + [f"role:{r}" for r in roles]:
+            channels.update(self.accessGrants.get(principal, {}))
+        return {"name": name, "admin": False, "roles": sorted(roles),
+                "channels": sorted(channels)}
+
+    # Adds (sign=1) or removes (sign=-1) the grants one document makes
+    def applyGrants(self, stored, sign):
+        for grants, index in ((stored["access"], self.accessGrants),
+                              (stored["roles"], self.roleGrants)):
+            for principals, names in grants:
+                for principal in principals:
+                    counts = index.setdefault(principal, {})
+                    for name in names:
+                        counts[name] = counts.get(name, 0) + sign
+                        if counts[name] <= 0:
+                            del counts[name]
+
+    # Whether a user can see a stored document
+    def canSee(self, stored, context):
+        if context["admin"] or "*" in context["channels"]:
+            return True
+        return bool(set(stored["channels"]) & set(context["channels"]))
+
+    # Runs the sync function for a new revision and stores it if allowed.
+    # Returns (status, result body)
+    def write(self, doc_id, body, user, is_admin):
+        stored = self.docs.get(doc_id)
+        old_doc = None
+        if stored:
+            old_doc = dict(stored["body"], _id=doc_id, _rev=stored["rev"])
+            if stored["deleted"]:
+                old_doc["_deleted"] = True
+        outcome = json.loads(self.runSync(
+            json.dumps(body),
+            json.dumps(old_doc) if old_doc else "",
+            json.dumps(self.userContext(user, is_admin))
+        ))
+        if not outcome["allowed"]:
+            error = {401: "Unauthorized", 403: "Forbidden"}.get(
+                outcome["status"], "Internal Server Error")
+            return "failed", {"error": error, "reason": outcome["reason"]}
+        generation = int(stored["rev"].split("-")[0]) + 1 if stored else 1
+        digest = hashlib.md5(
+            json.dumps(body, sort_keys=True).encode()).hexdigest()
+        rev = f"{generation}-{digest}"
+        if stored:
+            self.applyGrants(stored, -1)
+        self.sequence += 1
+        stored = {
+            "body": {k: v for k, v in body.items()
+                     if k not in ("_id", "_rev", "_deleted")},
+            "rev": rev,
+            "seq": self.sequence,
+            "deleted": bool(body.get("_deleted")),
+            "channels": sorted(set(str(c) for c in outcome["channels"])),
+            "access": outcome["access"],
+            "roles": outcome["roles"]
+        }
+        self.docs[doc_id] = stored
+        self.applyGrants(stored, 1)
+        return "success", {"id": doc_id, "ok": True, "rev": rev}
+
+    def who(self, user, is_admin):
+        return "Admin" if is_admin else user["userName"]
+
+    def runGet(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        stored = self.docs.get(doc_id)
+        result = None
+        if stored and not stored["deleted"] and self.canSee(
+                stored, self.userContext(user, is_admin)):
+            result = dict(stored["body"], _id=doc_id, _rev=stored["rev"])
+        status = "success" if result else "failed"
+        log.info(
+            f"[{status}] - [GET] - [{self.who(user, is_admin)}] - "
+            f"GET result for [{doc_id}] - "
+            f"{self.work.logBody(result or None)}"
+        )
+        if result:
+            self.work.noteOutcome(rev=result["_rev"])
+        return status
+
+    def runPut(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        body = {k: v for k, v in json_data.items() if k != "_rev"}
+        body["dateTimeStamp"] = datetime.now().isoformat()
+        status, result = self.write(doc_id, body, user, is_admin)
+        log.info(
+            f"[{status}] - [PUT] - [{self.who(user, is_admin)}] - "
+            f"PUT result for [{doc_id}] - {self.work.logBody(result)}"
+        )
+        if status == "success":
+            self.work.noteOutcome(rev=result["rev"])
+        return status
+
+    def runDelete(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        stored = self.docs.get(doc_id)
+        if not stored or stored["deleted"]:
+            log.warning(
+                f"[failed] - [DELETE] - [{self.who(user, is_admin)}] - "
+                f"Unable to delete [{doc_id}] - "
+                f"Document not found or no revision available"
+            )
+            return "failed"
+        status, result = self.write(
+            doc_id, {"_id": doc_id, "_deleted": True}, user, is_admin
+        )
+        log.info(
+            f"[{status}] - [DELETE] - [{self.who(user, is_admin)}] - "
+            f"DELETE result for [{doc_id}] - {self.work.logBody(result)}"
+        )
+        return status
+
+    def runChanges(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        channels = params if params else None
+        stored = self.docs.get(doc_id)
+        context = self.userContext(user, is_admin)
+        if channels and not is_admin:
+            context["channels"] = [c for c in context["channels"]
+                                   if c in channels.split(",")]
+        elif channels:
+            context = {"admin": False, "channels": channels.split(",")}
+        rows = []
+        if stored and self.canSee(stored, context):
+            rows.append({"id": doc_id, "changes": [{"rev": stored["rev"]}]})
+            if stored["deleted"]:
+                rows[0]["deleted"] = True
+        self.work.noteOutcome(allowed=bool(rows))
+        log.info(
+            f"[success] - [CHANGES] - [{self.who(user, is_admin)}] - "
+            f"Changes feed result for [{doc_id}], "
+            f"channelFilter:{'true' if channels else 'false'}, "
+            f"channels:{channels if channels else 'None'}, "
+            f"rows: {len(rows)} - "
+            f"{self.work.logBody({'results': rows, 'last_seq': None})}"
+        )
+        return "success"
+
+    def runPurge(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        stored = self.docs.pop(doc_id, None)
+        if stored:
+            self.applyGrants(stored, -1)
+        log.info(
+            f"[success] - [PURGE] - [Admin] - "
+            f"Purge result for [{doc_id}] - "
+            f"{self.work.logBody({'purged': {doc_id: ['*']}})}"
+        )
+        return "success"
+
+    # The grants of one document as _sync keeps them: principal ->
+    # channel (or role, without its "role:" prefix) -> granting sequence
+    @staticmethod
+    def grantMap(grants, seq):
+        granted = {}
+        for principals, names in grants:
+            for principal in principals:
+                for name in names:
+                    name = str(name)
+                    if name.startswith("role:"):
+                        name = name[len("role:"):]
+                    granted.setdefault(str(principal), {})[name] = seq
+        return granted
+
+    # A stored document as _raw returns it, None when there is none
+    def rawDoc(self, doc_id):
+        stored = self.docs.get(doc_id)
+        if not stored:
+            return None
+        sync = {"rev": stored["rev"], "sequence": stored["seq"],
+                "channels": {c: None for c in stored["channels"]}}
+        # Sync Gateway leaves out the grant maps that are empty
+        for key, grants in (("access", stored["access"]),
+                            ("role_access", stored["roles"])):
+            granted = self.grantMap(grants, stored["seq"])
+            if granted:
+                sync[key] = granted
+        return dict(stored["body"], _sync=sync)
+
+    def runGetRaw(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        result = self.rawDoc(doc_id)
+        if result:
+            self.work.noteOutcome(**rawOutcome(result))
+        status = "success" if result else "failed"
+        log.info(
+            f"[{status}] - [GET_RAW] - [Admin] - "
+            f"GET_RAW result for [{doc_id}] - "
+            f"{self.work.logBody(result or None)}"
+        )
+        return status
+
+
+# One step of a compiled operations plan. Work.compilePlan parses each
+# operation string once per run, so the per-document loop only reads
+# these fields: the handler to call (None for an unknown operation),
+# whether it runs as admin, its parameter, or the seconds to sleep for
+# a SLEEP step
+
+
+class Step():
+
+    __slots__ = ("index", "operation", "op", "is_admin", "params", "admin",
+                 "sleep", "handler")
+
+    def __init__(self, index, operation, op, is_admin=False, params="",
+                 admin=False, sleep=None, handler=None):
+        self.index = index
+        self.operation = operation
+        self.op = op
+        self.is_admin = is_admin
+        self.params = params
+        self.admin = admin
+        self.sleep = sleep
+        self.handler = handler
+
+
+# Operation name -> handler, filled with the built-in operations below the
+# Work class and extended by plugins through registerOperation. A handler
+# is called as handler(work, json_data, user, is_admin, params, log) and
+# returns "success" or "failed"
+OPERATIONS = {}
+
+# Operations whose results are recorded as admin ones whoever runs them
+ADMIN_OPERATIONS = {"PURGE", "GET_RAW"}
+
+
+# Decorator registering a custom operation, e.g. in a module listed in
+# the "plugins" config key:
+#   @registerOperation("GET_ATTACHMENT")
+#   def getAttachment(work, json_data, user, is_admin, params, log): ...
+# Operations that always run with admin credentials pass admin=True
+def registerOperation(name, admin=False):
+    def register(handler):
+        OPERATIONS[name] = handler
+        if admin:
+            ADMIN_OPERATIONS.add(name)
+        return handler
+    return register
+
+
+# Reads a JSON configuration file
+def loadConfig(config_file):
+    try:
+        with open(config_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise Exception(f"Configuration file '{config_file}' not found.")
+    except json.JSONDecodeError:
+        raise Exception(f"Configuration file '{config_file}'"
+                        f"is not valid JSON."
+                        )
+
+
 # The WORK class represents the main functionality for interacting with
 # Sync Gateway to test the Sync Function
 
 
-class Work():
+class Work():
+
+    # Default configuration values
+    debug = False
+    sgHost = "http://localhost"
+    sgPort = "4984"
+    sgAdminPort = "4985"
+    sgDb = "sync_gateway"
+    sgDbScope = "_default"
+    sgDbCollection = "_default"
+    sgTestUsers = [{"userName": "bob", "password": "12345", "sgSession": ""}]
+    sgAdminUser = ""
+    sgAdminPassword = "Administrator"
+    logPathToWriteTo = "password"
+    jsonFolder = "jsons"
+    operations = []
+    concurrency = 1
+    batchMode = False
+    batchSize = 100
+    loadTest = {}
+    generator = {}
+    compare = {}
+    distributed = {}
+    contention = {}
+    analyze = {}
+    replay = {}
+    checkpointFile = ""
+    checkpointSyncEvery = 100
+    plugins = []
+    keyspaces = []
+    metricsReport = False
+    metricsSlowestDocs = 0
+    changesFeed = "normal"
+    changesTimeoutMs = 1000
+    probeTimeoutMs = 10000
+    expectationsFile = ""
+    offline = False
+    syncFunctionFile = ""
+    sessionAuth = False
+    logBodies = "truncate"
+    logBodyLimit = 2000
+    resultsLog = False
+    captureFile = ""
+    captureBodies = False
+    logRotateMB = 0
+    logBackupCount = 5
+    jsonLibrary = "auto"
+    sessionTtl = 3600
+    httpPoolSize = 10
+    httpMaxRetries = 3
+    httpBackoffFactor = 0.5
+    httpConnectTimeout = 5
+    httpReadTimeout = 30
+    httpMaxRetryAfter = 30
+    rateLimit = 0
+    userRateLimit = 0
+    opRateLimits = {}
+    rateLimitBurst = 1
+    adaptiveConcurrency = False
+    adaptiveMinConcurrency = 1
+    adaptiveLatencyMs = 0
+    retryBudgetRatio = 0.1
+    retryBudgetMin = 10
+
+    # Responses telling the client to back off, and the ones that are
+    # retried: 502/504 only for methods that are safe to send twice
+    THROTTLED_STATUSES = (429, 503)
+    RETRY_STATUSES = (429, 502, 503, 504)
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+    # _changes feeds Sync Gateway holds open until there is news
+    HELD_FEEDS = ("feed=longpoll", "feed=continuous")
+
+    # Initializes the WORK object with the given configuration file (or
+    # an already parsed configuration dict). With resume, a run picks up
+    # where the checkpoint journal left off. shard is (index, count) for
+    # a worker of a distributed run: it only takes the documents that
+    # hash to its index, and writes its own log file and journal
+    def __init__(self, config_file, resume=False, shard=None):
+        self.readConfig(config_file)
+        self.resume = resume
+        self.shard = shard
+        self.shardRing = None
+        if shard:
+            index, count = shard
+            self.shardRing = HashRing(count)
+            self.sgLogName = f"{self.sgLogName}_shard{index}"
+            if self.checkpointFile:
+                self.checkpointFile = \
+                    f"{self.checkpointFile}.shard{index}of{count}"
+            if self.captureFile:
+                self.captureFile = \
+                    f"{self.captureFile}.shard{index}of{count}"
+            # The shards share the rate limits
+            self.rateLimit /= count
+            self.userRateLimit /= count
+            self.opRateLimits = {op: rate / count
+                                 for op, rate in self.opRateLimits.items()}
+        self.jsonCodec = JsonCodec(self.jsonLibrary)
+        self.outcomeListeners = []
+        self.setupLogging()
+        self.loadPlugins()
+        self.plans = {}
+        self.urlBases = None
+        self.authCache = {}
+        self.sessions = {}
+        self.sessionsLock = threading.Lock()
+        self.userSessions = {}
+        self.userSessionLocks = {}
+        self.userSessionsLock = threading.Lock()
+        self.revCache = {}
+        self.rateBuckets = {}
+        self.rateBucketsLock = threading.Lock()
+        self.backpressure = Backpressure(self.retryBudgetRatio,
+                                         self.retryBudgetMin)
+        self.concurrencyLimit = None
+        if self.adaptiveConcurrency:
+            self.concurrencyLimit = AdaptiveConcurrency(
+                max(self.concurrency, self.loadTest.get("virtualUsers", 0)),
+                self.adaptiveMinConcurrency, self.adaptiveLatencyMs / 1000
+            )
+        self.keyspaceName = ""
+        self.keyspaceWorks = []
+        self.fixtureCache = {}
+        self.sharedFixtures = set()
+        self.fixtureCacheLock = threading.Lock()
+        self.opContext = threading.local()
+        self.metrics = LatencyReport()
+        self.slowestDocs = SlowestDocs(self.metricsSlowestDocs)
+        self.propagation = LatencyReport()
+        self.lastSeq = {}
+        self.changesSeen = {}
+        self.loadTestResult = None
+        self.offlineGateway = None
+        if self.offline:
+            self.enableOffline()
+        self.checkpoint = None
+        if self.checkpointFile:
+            self.checkpoint = Checkpoint(
+                self.checkpointFile, resume, self.checkpointSyncEvery,
+                self.batchMode
+            )
+        self.expectations = None
+        if self.expectationsFile:
+            self.expectations = Expectations(self.expectationsFile)
+            self.outcomeListeners.append(self.expectations.check)
+
+    # Reads the configuration from the specified file
+    # and sets up the object's attributes
+    def readConfig(self, config_file):
+        if isinstance(config_file, dict):
+            config = config_file
+        else:
+            config = loadConfig(config_file)
+        # Kept as read, to hand to the workers of a distributed run
+        self.config = config
+
+        self.sgLogName = config.get("logPathToWriteTo", self.logPathToWriteTo)
+        self.sgHost = config.get("sgHost", self.sgHost)
+        self.sgPort = config.get("sgPort", self.sgPort)
+        self.sgAdminPort = config.get("sgAdminPort", self.sgAdminPort)
+        self.sgDb = config.get("sgDb", self.sgDb)
+        self.sgDbScope = config.get("sgDbScope", self.sgDbScope)
+        self.sgDbCollection = config.get("sgDbCollection", self.sgDbCollection)
+        self.sgTestUsers = config.get("sgTestUsers", self.sgTestUsers)
+        # A file of users, e.g. one written by the generate command
+        if isinstance(self.sgTestUsers, str):
+            self.sgTestUsers = self.readTestUsers(self.sgTestUsers)
+        self.sgAdminUser = config.get("sgAdminUser", self.sgAdminUser)
+        self.sgAdminPassword = config.get(
+            "sgAdminPassword", self.sgAdminPassword
+        )
+        self.jsonFolder = config.get("jsonFolder", self.jsonFolder)
+        self.debug = config.get("debug", self.debug)
+        self.operations = config.get("operations", self.operations)
+        self.concurrency = config.get("concurrency", self.concurrency)
+        self.batchMode = config.get("batchMode", self.batchMode)
+        self.batchSize = config.get("batchSize", self.batchSize)
+        self.loadTest = config.get("loadTest", self.loadTest)
+        self.generator = config.get("generator", self.generator)
+        self.compare = config.get("compare", self.compare)
+        self.distributed = config.get("distributed", self.distributed)
+        self.contention = config.get("contention", self.contention)
+        self.analyze = config.get("analyze", self.analyze)
+        self.replay = config.get("replay", self.replay)
+        self.plugins = config.get("plugins", self.plugins)
+        self.checkpointFile = config.get("checkpointFile", self.checkpointFile)
+        self.checkpointSyncEvery = config.get(
+            "checkpointSyncEvery", self.checkpointSyncEvery
+        )
+        self.keyspaces = config.get("keyspaces", self.keyspaces)
+        self.metricsReport = config.get("metricsReport", self.metricsReport)
+        self.metricsSlowestDocs = config.get(
+            "metricsSlowestDocs", self.metricsSlowestDocs
+        )
+        self.changesFeed = config.get("changesFeed", self.changesFeed)
+        self.expectationsFile = config.get(
+            "expectationsFile", self.expectationsFile
+        )
+        self.offline = config.get("offline", self.offline)
+        self.syncFunctionFile = config.get(
+            "syncFunctionFile", self.syncFunctionFile
+        )
+        self.changesTimeoutMs = config.get(
+            "changesTimeoutMs", self.changesTimeoutMs
+        )
+        self.probeTimeoutMs = config.get("probeTimeoutMs", self.probeTimeoutMs)
+        self.sessionAuth = config.get("sessionAuth", self.sessionAuth)
+        self.logBodies = config.get("logBodies", self.logBodies)
+        self.logBodyLimit = config.get("logBodyLimit", self.logBodyLimit)
+        self.resultsLog = config.get("resultsLog", self.resultsLog)
+        self.captureFile = config.get("captureFile", self.captureFile)
+        self.captureBodies = config.get("captureBodies", self.captureBodies)
+        self.logRotateMB = config.get("logRotateMB", self.logRotateMB)
+        self.logBackupCount = config.get(
+            "logBackupCount", self.logBackupCount
+        )
+        self.sessionTtl = config.get("sessionTtl", self.sessionTtl)
+        self.jsonLibrary = config.get("jsonLibrary", self.jsonLibrary)
+        self.httpPoolSize = config.get("httpPoolSize", self.httpPoolSize)
+        self.httpMaxRetries = config.get(
+            "httpMaxRetries", self.httpMaxRetries
+        )
+        self.httpBackoffFactor = config.get(
+            "httpBackoffFactor", self.httpBackoffFactor
+        )
+        self.httpConnectTimeout = config.get(
+            "httpConnectTimeout", self.httpConnectTimeout
+        )
+        self.httpReadTimeout = config.get(
+            "httpReadTimeout", self.httpReadTimeout
+        )
+        self.httpMaxRetryAfter = config.get(
+            "httpMaxRetryAfter", self.httpMaxRetryAfter
+        )
+        self.rateLimit = config.get("rateLimit", self.rateLimit)
+        self.userRateLimit = config.get("userRateLimit", self.userRateLimit)
+        self.opRateLimits = config.get("opRateLimits", self.opRateLimits)
+        self.rateLimitBurst = config.get(
+            "rateLimitBurst", self.rateLimitBurst
+        )
+        self.adaptiveConcurrency = config.get(
+            "adaptiveConcurrency", self.adaptiveConcurrency
+        )
+        self.adaptiveMinConcurrency = config.get(
+            "adaptiveMinConcurrency", self.adaptiveMinConcurrency
+        )
+        self.adaptiveLatencyMs = config.get(
+            "adaptiveLatencyMs", self.adaptiveLatencyMs
+        )
+        self.retryBudgetRatio = config.get(
+            "retryBudgetRatio", self.retryBudgetRatio
+        )
+        self.retryBudgetMin = config.get(
+            "retryBudgetMin", self.retryBudgetMin
+        )
+
+    # Reads sgTestUsers from a JSON list or a JSONL file
+    def readTestUsers(self, path):
+        try:
+            with open(path, "r") as f:
+                if path.endswith((".jsonl", ".ndjson")):
+                    return [json.loads(line) for line in f if line.strip()]
+                return json.load(f)
+        except FileNotFoundError:
+            raise Exception(f"sgTestUsers file '{path}' not found.")
+        except json.JSONDecodeError:
+            raise Exception(f"sgTestUsers file '{path}' is not valid JSON.")
+
+    # Imports the modules listed in "plugins" (module names, or paths of
+    # .py files) so the operations they register can be used
+    def loadPlugins(self):
+        for plugin in self.plugins:
+            if plugin.endswith(".py"):
+                name = os.path.splitext(os.path.basename(plugin))[0]
+                spec = importlib.util.spec_from_file_location(name, plugin)
+                if spec is None:
+                    raise Exception(f"Plugin '{plugin}' not found.")
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+            else:
+                importlib.import_module(plugin)
+
+    # Sets up logging for the application with ISO 8601 timestamps.
+    # Threads only put records on a queue; a listener thread formats them
+    # and writes the log file, plus the JSON-lines results file
+    # (resultsLog), bodies file (logBodies "sidecar") and capture file
+    # (captureFile) when enabled
+    def setupLogging(self):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        log_filename = f"{self.sgLogName}_{timestamp}.log"
+        self.logFileName = log_filename
+        base = log_filename[:-len(".log")]
+
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
+
+        formatter = TimingFormatter(
+            "%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s",
+            datefmt='%Y-%m-%dT%H:%M:%S'
+        )
+
+        file_handler = self.logFileHandler(log_filename)
+        file_handler.setFormatter(formatter)
+        handlers = [file_handler]
+
+        self.resultsLogger = logging.getLogger(f"{__name__}.results")
+        self.bodyLogger = logging.getLogger(f"{__name__}.bodies")
+        self.captureLogger = logging.getLogger(f"{__name__}.capture")
+        self.bodyIds = itertools.count(1)
+        if self.resultsLog:
+            handlers.append(self.jsonLinesHandler(
+                f"{base}_results.jsonl", self.resultsLogger
+            ))
+            self.outcomeListeners.append(self.logOutcome)
+        if self.logBodies == "sidecar":
+            handlers.append(self.jsonLinesHandler(
+                f"{base}_bodies.jsonl", self.bodyLogger
+            ))
+        if self.captureFile:
+            handlers.append(self.jsonLinesHandler(
+                self.captureFile, self.captureLogger
+            ))
+        # Records of the JSON-lines loggers stay out of the log file
+        json_lines = (self.resultsLogger.name, self.bodyLogger.name,
+                      self.captureLogger.name)
+        file_handler.addFilter(lambda record: record.name not in json_lines)
+
+        log_queue = queue.SimpleQueue()
+        self.queue_handler = DeferredQueueHandler(log_queue)
+        self.logListener = QueueListener(
+            log_queue, *handlers, respect_handler_level=True
+        )
+        self.logListener.start()
+        for logger in (self.logger, self.resultsLogger, self.bodyLogger,
+                       self.captureLogger):
+            logger.addHandler(self.queue_handler)
+
+        # Store the file handlers so they can be closed later
+        self.file_handler = file_handler
+        self.logHandlers = handlers
+
+    # A handler writing to path, rotated to gzip'd backups once it grows
+    # past logRotateMB megabytes when that is set
+    def logFileHandler(self, path):
+        if not self.logRotateMB:
+            return logging.FileHandler(path)
+        handler = RotatingFileHandler(
+            path, maxBytes=int(self.logRotateMB * 1024 * 1024),
+            backupCount=self.logBackupCount
+        )
+        handler.namer = lambda name: f"{name}.gz"
+        handler.rotator = gzipRotator
+        return handler
+
+    # A JSON-lines file handler that only takes the records of one logger,
+    # which is detached from the root logger
+    def jsonLinesHandler(self, path, logger):
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = self.logFileHandler(path)
+        handler.setFormatter(JsonLinesFormatter())
+        handler.addFilter(lambda record: record.name == logger.name)
+        return handler
+
+    # Closes the log file, after the listener wrote out what was queued
+    def closeLogFile(self):
+        if hasattr(self, 'file_handler'):
+            for logger in (self.logger, self.resultsLogger, self.bodyLogger,
+                           self.captureLogger):
+                logger.removeHandler(self.queue_handler)
+            self.logListener.stop()
+            for handler in self.logHandlers:
+                handler.close()
+            del self.file_handler
+
+    # Writes one operation outcome to the results file as a JSON line
+    def logOutcome(self, outcome):
+        self.resultsLogger.info({
+            "keyspace": outcome.keyspace, "op": outcome.op,
+            "user": outcome.user, "doc": outcome.doc_id,
+            "status": outcome.status, "http": outcome.http,
+            "ms": round(outcome.elapsed * 1000, 3), "rev": outcome.rev,
+            "allowed": outcome.allowed, "channels": outcome.channels
+        })
+
+    # Text for a response body in a log line, as logBodies says: the full
+    # JSON ("full"), JSON cut to logBodyLimit bytes ("truncate"), nothing
+    # ("none"), or a reference to the copy written to the bodies file
+    # ("sidecar"). When the body is the one the running operation's last
+    # HTTP call returned, the bytes it was parsed from are logged as they
+    # are instead of encoding the body again; "truncate" only decodes the
+    # part it keeps
+    def logBody(self, body):
+        if body is None:
+            return "null"
+        if self.logBodies == "none":
+            return "(body not logged)"
+        calls = getattr(self.opContext, "calls", None)
+        raw = calls[-1].raw if calls and calls[-1].body is body else None
+        if self.logBodies == "sidecar":
+            body_id = next(self.bodyIds)
+            self.bodyLogger.info({"id": body_id,
+                                  "body": body if raw is None else raw})
+            return f"(body #{body_id})"
+        data = self.jsonCodec.dumps(body) if raw is None else raw
+        if self.logBodies == "truncate" and len(data) > self.logBodyLimit:
+            kept = data[:self.logBodyLimit].decode("utf-8", "ignore")
+            return f"{kept}...({len(data)} bytes)"
+        return data.decode("utf-8", "replace")
+
+    # Returns the pooled keep-alive session for one credential. Each
+    # credential (admin or a test user) gets its own session so
+    # connections are reused while cookies never leak between users
+    def getSession(self, userName="", is_admin=False):
+        key = ("admin",) if is_admin else ("user", userName)
+        with self.sessionsLock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                # Connection errors only; responses asking to back off
+                # are retried by sendRequest
+                retries = Retry(
+                    total=self.httpMaxRetries,
+                    backoff_factor=self.httpBackoffFactor,
+                    respect_retry_after_header=False,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=self.httpPoolSize,
+                    pool_maxsize=self.httpPoolSize,
+                    max_retries=retries
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[key] = session
+        return session
+
+    # Switches to offline mode: operations run against an in-memory
+    # OfflineGateway executing syncFunctionFile instead of Sync Gateway
+    def enableOffline(self):
+        if not self.syncFunctionFile:
+            raise Exception("Offline mode needs syncFunctionFile "
+                            "in the configuration.")
+        self.offline = True
+        self.offlineGateway = OfflineGateway(self, self.syncFunctionFile)
+
+    # Closes every pooled session and its open connections
+    def closeSessions(self):
+        with self.sessionsLock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+    # Constructs the database URL based on scope and collection
+    def constructDbUrl(self):
+        if self.sgDbScope == "_default" and self.sgDbCollection == "_default":
+            return self.sgDb
+        else:
+            return f"{self.sgDb}.{self.sgDbScope}.{self.sgDbCollection}"
+
+    # URL of one document (or keyspace endpoint such as _changes) on the
+    # public port, or the admin port. compilePlan works out the two
+    # prefixes once per run
+    def docUrl(self, doc_id, is_admin=False):
+        bases = self.urlBases or self.buildUrlBases()
+        return f"{bases[is_admin]}{doc_id}"
+
+    # URL of a document's raw form, _sync metadata included, on the admin
+    # port
+    def rawUrl(self, doc_id):
+        return self.docUrl(f"_raw/{doc_id}", True)
+
+    # The public and admin URL prefixes of this keyspace
+    def buildUrlBases(self):
+        keyspace = self.constructDbUrl()
+        return (f"{self.sgHost}:{self.sgPort}/{keyspace}/",
+                f"{self.sgHost}:{self.sgAdminPort}/{keyspace}/")
+
+    # Headers and auth for one request: admin credentials, the user's
+    # SyncGatewaySession cookie if there is one, or else their Basic
+    # credentials. The cookie alone is enough, so Sync Gateway does not
+    # re-check the password hash on every request
+    # The result is built once per credential and reused
+    def requestAuth(self, userName, password, session, is_admin):
+        key = ((True, self.sgAdminUser, self.sgAdminPassword) if is_admin
+               else (False, userName, password, session))
+        cached = self.authCache.get(key)
+        if cached is None:
+            cached = self.authCache[key] = self.buildAuth(
+                userName, password, session, is_admin
+            )
+        return cached
+
+    def buildAuth(self, userName, password, session, is_admin):
+        headers = {"Content-Type": "application/json"}
+        if is_admin:
+            auth = HTTPBasicAuth(self.sgAdminUser, self.sgAdminPassword)
+        elif session:
+            headers["Cookie"] = f"SyncGatewaySession={session}"
+            auth = None
+        else:
+            auth = (HTTPBasicAuth(userName, password)
+                    if userName and password else None)
+        return headers, auth
+
+    # Creates a Sync Gateway session for a user and returns its ID, or
+    # None. Uses the admin _session endpoint when admin credentials are
+    # configured, so not even this request checks the password; otherwise
+    # logs in once on the public one
+    def createUserSession(self, userName, password):
+        sgUrl = f"{self.sgHost}:{self.sgAdminPort}/{self.sgDb}/_session"
+        try:
+            if self.sgAdminUser:
+                result = self.httpRequest(
+                    "POST", sgUrl,
+                    json_data={"name": userName, "ttl": self.sessionTtl},
+                    is_admin=True
+                )
+                return result.get("session_id") if result else None
+            # Log in without any stale session cookie the user's pool kept
+            pooled = self.getSession(userName)
+            pooled.cookies.clear()
+            response = pooled.request(
+                "POST",
+                f"{self.sgHost}:{self.sgPort}/{self.sgDb}/_session",
+                json={"name": userName, "password": password},
+                headers={"Content-Type": "application/json"},
+                timeout=(self.httpConnectTimeout, self.httpReadTimeout)
+            )
+            response.raise_for_status()
+            return response.cookies.get("SyncGatewaySession")
+        except requests.RequestException as e:
+            self.logger.error(
+                f"Unable to create a session for [{userName}]: {e}"
+            )
+            return None
+
+    # Returns the cached session ID for a user in this database, creating
+    # it on first use.
+    # Pass the session that just got a 401 as stale to replace it; a
+    # session another thread already replaced is not created again. The
+    # login holds a lock of its own user only, so one slow login does
+    # not hold up the other users
+    def userSession(self, userName, password, stale=None):
+        key = (self.sgDb, userName)
+        with self.userSessionsLock:
+            lock = self.userSessionLocks.setdefault(key, threading.Lock())
+        with lock:
+            session = self.userSessions.get(key)
+            if session is None or session == stale:
+                session = self.createUserSession(userName, password)
+                if session:
+                    self.userSessions[key] = session
+                else:
+                    self.userSessions.pop(key, None)
+            return session
+
+    # Creates the sessions of every test user up front, so the run itself
+    # never waits on a login
+    def openUserSessions(self):
+        if not self.sessionAuth or self.offline:
+            return
+        opened = sum(
+            1 for user in self.sgTestUsers
+            if not user.get("sgSession")
+            and self.userSession(user["userName"], user["password"])
+        )
+        self.logger.info(
+            f"[SESSION] - Created sessions for {opened} of "
+            f"{len(self.sgTestUsers)} test users"
+        )
+
+    # Sends one request with the right credentials on the pooled session.
+    # With sessionAuth on, users authenticate with their cached session
+    # cookie, and a session that expired (401) is replaced once. When Sync
+    # Gateway pushes back (429, 503, or 502/504 for idempotent methods)
+    # the request is sent again after its Retry-After, or an exponential
+    # backoff, while httpMaxRetries and the retry budget allow
+    def sendRequest(self, method, url, userName, password, session,
+                    is_admin, **kwargs):
+        renewable = self.sessionAuth and not is_admin and userName
+        if renewable and not session:
+            session = self.userSession(userName, password)
+        pooled = self.getSession(userName, is_admin)
+        refreshed = False
+        retries = 0
+        self.backpressure.count("requests")
+        while True:
+            headers, auth = self.requestAuth(
+                userName, password, session, is_admin
+            )
+            response = self.pacedRequest(
+                pooled, method, url, "Admin" if is_admin else userName,
+                headers=headers, auth=auth,
+                timeout=(self.httpConnectTimeout, self.httpReadTimeout),
+                **kwargs
+            )
+            status = getattr(response, "status_code", None)
+            if status == 401 and renewable and session and not refreshed:
+                refreshed = True
+                response.close()
+                session = self.userSession(userName, password, stale=session)
+                continue
+            if not self.shouldRetry(method, status, retries):
+                return response
+            wait = self.retryDelay(response, retries)
+            response.close()
+            retries += 1
+            time.sleep(wait)
+
+    # Sends one request once the rate limits allow it and, with
+    # adaptiveConcurrency, while holding one of the controller's slots
+    def pacedRequest(self, pooled, method, url, who, **kwargs):
+        self.acquireRate(who)
+        limiter = self.concurrencyLimit
+        if limiter:
+            limiter.acquire()
+        started = time.perf_counter()
+        throttled = False
+        failed = True
+        try:
+            response = pooled.request(method, url, **kwargs)
+            failed = False
+            status = getattr(response, "status_code", None)
+            throttled = status in self.THROTTLED_STATUSES
+            if throttled:
+                self.backpressure.count(f"throttled{status}")
+            return response
+        except requests.RequestException:
+            # No response at all, which is not Sync Gateway throttling
+            self.backpressure.count("connectionErrors")
+            raise
+        finally:
+            if limiter:
+                limiter.release(
+                    time.perf_counter() - started, throttled, failed,
+                    sample=not any(feed in url for feed in self.HELD_FEEDS)
+                )
+
+    # Whether a response should be retried, taking the retry from the
+    # budget when it should
+    def shouldRetry(self, method, status, retries):
+        if status not in self.THROTTLED_STATUSES and not (
+                status in self.RETRY_STATUSES
+                and method in self.IDEMPOTENT_METHODS):
+            return False
+        if retries >= self.httpMaxRetries:
+            return False
+        return self.backpressure.allowRetry()
+
+    # Seconds to wait before a retry: what Retry-After asks for (up to
+    # httpMaxRetryAfter), or an exponential backoff
+    def retryDelay(self, response, retries):
+        wait = retryAfterSeconds(response.headers.get("Retry-After"))
+        if wait is None:
+            wait = self.httpBackoffFactor * 2 ** retries
+        else:
+            self.backpressure.count("retryAfterHonored")
+        wait = min(wait, self.httpMaxRetryAfter)
+        self.backpressure.count("retryWaitSeconds", wait)
+        return wait
+
+    # Waits for a token of every rate limit that applies to a request: the
+    # global one, the one of the user (or "Admin") and the one of the
+    # operation running on this thread
+    def acquireRate(self, who):
+        op = getattr(self.opContext, "op", None)
+        limits = (("*", self.rateLimit), (("user", who), self.userRateLimit),
+                  (("op", op), self.opRateLimits.get(op, 0)))
+        waited = 0.0
+        for key, rate in limits:
+            if rate:
+                waited += self.rateBucket(key, rate).acquire()
+        if waited:
+            self.backpressure.count("rateLimitWaitSeconds", waited)
+
+    # The token bucket of one rate limit, created on first use
+    def rateBucket(self, key, rate):
+        bucket = self.rateBuckets.get(key)
+        if bucket is None:
+            with self.rateBucketsLock:
+                bucket = self.rateBuckets.setdefault(
+                    key, TokenBucket(rate, self.rateLimitBurst)
+                )
+        return bucket
+
+    # Performs an HTTP request to the Sync Gateway and returns an
+    # HttpResult carrying both the status code and the parsed body
+    def httpCall(
+        self,
+        method,
+        url,
+        json_data=None,
+        userName="",
+        password="",
+        session="",
+        is_admin=False
+    ):
+        result = HttpResult()
+        at = time.time()
+        started = time.perf_counter()
+        data = None if json_data is None else self.jsonCodec.dumps(json_data)
+        try:
+            if is_admin:
+                url = url.replace(
+                    f":{self.sgPort}/",
+                    f":{self.sgAdminPort}/"
+                )
+
+            response = self.sendRequest(
+                method, url, userName, password, session, is_admin,
+                data=data
+            )
+
+            # Handle the case where response might
+            # be a dictionary (for testing purposes)
+            if isinstance(response, dict):
+                result.status = 200
+                result.body = response
+            else:
+                # requests times the exchange up to the response headers,
+                # which includes the connect on a fresh connection
+                elapsed = getattr(response, "elapsed", None)
+                if isinstance(elapsed, timedelta):
+                    result.server = elapsed.total_seconds()
+                response.raise_for_status()
+                result.status = response.status_code
+                content = response.content
+                if isinstance(content, bytes):
+                    result.raw = content or None
+                    result.body = (self.jsonCodec.loads(content)
+                                   if content else None)
+                else:
+                    # A mocked response (for testing purposes)
+                    result.body = response.json() if response.text else None
+        except requests.HTTPError as e:
+            result.status = (e.response.status_code
+                             if e.response is not None else None)
+            # Running out of retries under backpressure is never silent
+            if self.debug or result.status in self.THROTTLED_STATUSES:
+                self.logger.error(f"Error in HTTP {method}: {e}")
+        except (requests.RequestException, ValueError) as e:
+            if self.debug:
+                self.logger.error(f"Error in HTTP {method}: {e}")
+        result.elapsed = time.perf_counter() - started
+        if self.captureFile:
+            self.captureRequest(at, method, url, userName, is_admin, data,
+                                result)
+
+        # Hand the timing to the operation running on this thread, if any
+        calls = getattr(self.opContext, "calls", None)
+        if calls is not None:
+            calls.append(result)
+        return result
+
+    # Performs an HTTP request to the Sync Gateway and returns only the
+    # parsed body, or None if the request failed
+    def httpRequest(
+        self,
+        method,
+        url,
+        json_data=None,
+        userName="",
+        password="",
+        session="",
+        is_admin=False
+    ):
+        return self.httpCall(
+            method, url, json_data=json_data,
+            userName=userName, password=password,
+            session=session, is_admin=is_admin
+        ).body
+
+    # Writes one request to captureFile as a JSON line: when it was sent
+    # (seconds since the epoch), the method, path and query, whether it
+    # went to the admin port, the user (or "Admin"), the operation it was
+    # part of, the SHA-1 of its body, the status and the latency. With
+    # captureBodies on, the body is kept too, as it was sent
+    def captureRequest(self, at, method, url, userName, is_admin, data,
+                       result):
+        parts = urlsplit(url)
+        entry = {
+            "at": round(at, 6), "method": method,
+            "path": f"{parts.path}?{parts.query}" if parts.query
+            else parts.path,
+            "admin": is_admin, "user": "Admin" if is_admin else userName,
+            "op": getattr(self.opContext, "op", None),
+            "bodyHash": hashlib.sha1(data).hexdigest() if data else None,
+            "status": result.status, "ms": round(result.elapsed * 1000, 3)
+        }
+        if self.captureBodies and data:
+            entry["body"] = data
+        self.captureLogger.info(entry)
+
+    # Returns the last known revision of a document in this collection,
+    # or None if the pipeline has not seen it yet
+    def getCachedRev(self, doc_id):
+        return self.revCache.get((self.constructDbUrl(), doc_id))
+
+    # Remembers (or with rev=None forgets) the current revision of a
+    # document so later writes can skip the GET that looks it up
+    def setCachedRev(self, doc_id, rev):
+        key = (self.constructDbUrl(), doc_id)
+        if rev:
+            self.revCache[key] = rev
+        else:
+            self.revCache.pop(key, None)
+
+    # Looks up the current revision with a GET, used on a cache miss or
+    # after a 409 conflict, and refreshes the cache with it
+    def fetchRev(self, doc_id, sgUrl, userName="", password="",
+                 session="", is_admin=False):
+        current_doc = self.httpRequest(
+            "GET", sgUrl, userName=userName,
+            password=password, session=session,
+            is_admin=is_admin
+        )
+        rev = current_doc.get("_rev") if current_doc else None
+        self.setCachedRev(doc_id, rev)
+        return rev
+
+    # Retrieves the changes feed from Sync Gateway. Only changes after the
+    # last sequence this user (or admin) has already seen for the same
+    # channel filter are requested, unless `since` is given
+    def getChangesFeed(
+        self, userName="",
+        password="", session="",
+        is_admin=False, channels=None, since=None
+    ):
+        key = self.changesKey(userName, is_admin, channels)
+        if since is None:
+            since = self.lastSeq.get(key)
+        result = self.httpRequest(
+            "GET", self.changesUrl(is_admin, channels, since),
+            userName=userName, password=password,
+            session=session, is_admin=is_admin
+        )
+        for row in (result or {}).get("results") or []:
+            self.noteChangesRow(key, row)
+        if result and result.get("last_seq") is not None:
+            self.setLastSeq(key, result["last_seq"])
+        return result
+
+    # The feed position is tracked per collection, user and channel filter
+    def changesKey(self, userName, is_admin, channels):
+        return (self.constructDbUrl(),
+                "admin" if is_admin else userName, channels or "")
+
+    # Remembers, per feed position key, the documents a read of that feed
+    # returned and whether they are still visible: a row with "removed"
+    # says the document left the user's channels. Every document shares
+    # the cursor, so a read for one document consumes the changes of
+    # others; this is what tells whether a document is in the feed
+    def noteChangesRow(self, key, row):
+        doc_id = row.get("id")
+        if doc_id:
+            self.changesSeen.setdefault(key, {})[doc_id] = \
+                "removed" not in row
+
+    # Whether a document has shown up (and not been removed) on the feed
+    # of a feed position key
+    def seenInChanges(self, key, doc_id):
+        return self.changesSeen.get(key, {}).get(doc_id, False)
+
+    def setLastSeq(self, key, last_seq):
+        with self.sessionsLock:
+            self.lastSeq[key] = last_seq
+
+    # Builds a _changes URL with only the parameters that are needed
+    def changesUrl(self, is_admin=False, channels=None, since=None,
+                   feed="normal"):
+        query = []
+        if channels:
+            query.append(f"filter=sync_gateway/bychannel&channels={channels}")
+        if feed != "normal":
+            query.append(f"feed={feed}&timeout={self.changesTimeoutMs}")
+        if since is not None:
+            query.append(f"since={since}")
+        url = self.docUrl("_changes", is_admin)
+        return f"{url}?{'&'.join(query)}" if query else url
+
+    # Streams a _changes response and hands each row to on_row as soon as
+    # it is decoded, so the feed is never held in memory. Returns an
+    # HttpResult whose body is {"last_seq": ..., "rows": <count>}
+    def readChanges(self, url, on_row, userName="", password="",
+                    session="", is_admin=False):
+        result = HttpResult()
+        at = time.time()
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.sendRequest(
+                "GET", url, userName, password, session, is_admin,
+                data=None, stream=True
+            )
+            elapsed = getattr(response, "elapsed", None)
+            if isinstance(elapsed, timedelta):
+                result.server = elapsed.total_seconds()
+            response.raise_for_status()
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            reader = ChangesReader(
+                (decoder.decode(chunk)
+                 for chunk in response.iter_content(chunk_size=65536)),
+                continuous="feed=continuous" in url,
+                loads=self.jsonCodec.loads
+            )
+            rows = 0
+            for row in reader:
+                rows += 1
+                on_row(row)
+            result.status = response.status_code
+            result.body = {"last_seq": reader.last_seq, "rows": rows}
+        except requests.HTTPError as e:
+            if self.debug:
+                self.logger.error(f"Error in HTTP GET: {e}")
+            result.status = (e.response.status_code
+                             if e.response is not None else None)
+        except (requests.RequestException, ValueError) as e:
+            if self.debug:
+                self.logger.error(f"Error in HTTP GET: {e}")
+        finally:
+            if response is not None:
+                response.close()
+        result.elapsed = time.perf_counter() - started
+        if self.captureFile:
+            self.captureRequest(at, "GET", url, userName, is_admin, None,
+                                result)
+        calls = getattr(self.opContext, "calls", None)
+        if calls is not None:
+            calls.append(result)
+        return result
+
+    # Performs a purge operation on the specified document IDs
+    def postPurge(self, docIds):
+        sgUrl = (f"{self.sgHost}:{self.sgAdminPort}/"
+                 f"{self.constructDbUrl()}/_purge")
+        purgeData = {docId: ["*"] for docId in docIds}
+        result = self.httpRequest(
+            "POST", sgUrl,
+            json_data=purgeData, is_admin=True
+        )
+        return result.json() if hasattr(result, 'json') else result
+
+    # Yields every fixture document that has an "_id", lazily, from the
+    # folder, JSONL file(s) or archive(s) configured in jsonFolder. When
+    # several keyspaces of one run read the same jsonFolder, it is parsed
+    # once and each keyspace gets its own shallow copies of the documents
+    def iterJsonFolder(self):
+        key = json.dumps(self.jsonFolder)
+        if key in self.sharedFixtures:
+            docs = (dict(json_data) for json_data in self.cachedFixtures(key))
+        else:
+            docs = iter(FixtureSource(self.jsonFolder, self.logger,
+                                      self.jsonCodec.loads))
+        if self.shardRing:
+            index = self.shard[0]
+            docs = (json_data for json_data in docs
+                    if self.shardRing.owner(json_data["_id"]) == index)
+        return docs
+
+    # The parsed documents of a shared jsonFolder, read on first use
+    def cachedFixtures(self, key):
+        with self.fixtureCacheLock:
+            docs = self.fixtureCache.get(key)
+            if docs is None:
+                docs = list(FixtureSource(self.jsonFolder, self.logger,
+                                          self.jsonCodec.loads))
+                self.fixtureCache[key] = docs
+            return docs
+
+    # Runs the operations against every document in the folder. With a
+    # concurrency above 1 documents run in parallel on a thread pool; the
+    # operations of one document still run in order and its log lines are
+    # written together, in the order the documents were read
+    def openJsonFolder(self):
+        if self.keyspaces:
+            self.runKeyspaces()
+        else:
+            self.runKeyspace()
+        self.writeMetricsReport()
+        for work in [self] + self.keyspaceWorks:
+            if work.expectations:
+                work.writeExpectationsReport()
+
+    # Runs the operations over this keyspace's documents
+    def runKeyspace(self):
+        self.restoreCheckpoint()
+        self.openUserSessions()
+        if self.batchMode and not self.offline:
+            self.openJsonFolderBatched()
+        else:
+            self.runDocs(self.iterJsonFolder(), self.operations)
+
+    # The checkpoint journal, unless the run is offline: the in-memory
+    # store of an offline run does not survive a restart
+    def journal(self):
+        return None if self.offline else self.checkpoint
+
+    # Name of this keyspace (or compare target) in the journal
+    def journalScope(self):
+        return self.keyspaceName or self.constructDbUrl()
+
+    # Puts the revisions the journal recorded back in the revision cache,
+    # so resumed writes do not have to look them up again
+    def restoreCheckpoint(self):
+        journal = self.journal()
+        if not journal:
+            return
+        scope = self.journalScope()
+        restored = 0
+        for (keyspace, doc_id), rev in journal.revs.items():
+            if keyspace == scope:
+                self.setCachedRev(doc_id, rev)
+                restored += 1
+        if journal.done:
+            self.logger.info(
+                f"[success] - [RESUME] - [{scope}] - Skipping "
+                f"{len(journal.done)} completed steps, restored "
+                f"{restored} revisions from {journal.path}"
+            )
+
+    # Records a completed step of one document for one user
+    def recordStep(self, doc_id, step, user):
+        self.journal().record(self.journalScope(), doc_id, step, user,
+                              self.getCachedRev(doc_id))
+
+    # Flushes and closes the checkpoint journal
+    def closeCheckpoint(self):
+        if self.checkpoint:
+            self.checkpoint.close()
+
+    # Settings a "keyspaces" entry can override; the rest is shared
+    KEYSPACE_KEYS = ("sgDb", "sgDbScope", "sgDbCollection", "jsonFolder",
+                     "operations", "sgTestUsers", "syncFunctionFile",
+                     "expectationsFile")
+
+    # Settings a "compare" target can override
+    TARGET_KEYS = KEYSPACE_KEYS + ("sgHost", "sgPort", "sgAdminPort",
+                                   "sgAdminUser", "sgAdminPassword",
+                                   "offline")
+
+    # A Work for one "keyspaces" entry. It shares the connection pools,
+    # user sessions, caches, loggers and outcome listeners of this one, and
+    # keeps its own metrics, offline store and expectations
+    def keyspaceWork(self, spec, keys=KEYSPACE_KEYS):
+        work = copy.copy(self)
+        for key in keys:
+            if key in spec:
+                setattr(work, key, spec[key])
+        if isinstance(work.sgTestUsers, str):
+            work.sgTestUsers = self.readTestUsers(work.sgTestUsers)
+        work.keyspaces = []
+        work.keyspaceWorks = []
+        work.keyspaceName = spec.get("name", work.constructDbUrl())
+        work.metrics = LatencyReport()
+        work.slowestDocs = SlowestDocs(work.metricsSlowestDocs)
+        work.urlBases = None
+        work.offlineGateway = None
+        if work.offline:
+            work.enableOffline()
+        if "expectationsFile" in spec:
+            work.outcomeListeners = [
+                listener for listener in self.outcomeListeners
+                if not self.expectations
+                or listener != self.expectations.check
+            ]
+            work.expectations = None
+            if work.expectationsFile:
+                work.expectations = Expectations(work.expectationsFile)
+                work.outcomeListeners.append(work.expectations.check)
+
+        # Log lines of this keyspace say which keyspace they are from
+        def tagKeyspace(record):
+            record.keyspace = work.keyspaceName
+            return True
+        work.logger = logging.getLogger(
+            f"{__name__}.keyspace.{work.keyspaceName}"
+        )
+        work.logger.filters = [tagKeyspace]
+        return work
+
+    # Runs every entry of "keyspaces" at the same time, then merges their
+    # metrics into this Work's, with documents labelled by keyspace
+    def runKeyspaces(self):
+        self.runWorks([self.keyspaceWork(spec) for spec in self.keyspaces])
+
+    # Runs several keyspace Works at the same time, sharing the parsed
+    # documents of a jsonFolder they have in common
+    def runWorks(self, works):
+        self.keyspaceWorks = works
+        folders = Counter(json.dumps(work.jsonFolder) for work in works)
+        self.sharedFixtures.update(
+            key for key, count in folders.items() if count > 1
+        )
+        with ThreadPoolExecutor(max_workers=len(works)) as executor:
+            for future in [executor.submit(work.runKeyspace)
+                           for work in works]:
+                future.result()
+        for work in works:
+            self.metrics.mergeState(work.metrics.state())
+            for seconds, (op, role, doc_id), ok in work.slowestDocs.state():
+                self.slowestDocs.record(
+                    (op, role, f"{work.keyspaceName}/{doc_id}"), seconds, ok
+                )
+
+    # A/B mode: runs the plan against the two targets of "compare" at the
+    # same time, e.g. two databases holding the old and the new sync
+    # function, or two offline runs of two syncFunctionFiles. Logs every
+    # (docId, user, op) whose outcome differs and the per-operation
+    # latency deltas, writes them to <log>_diff.json and returns the report
+    def runCompare(self):
+        diff = OutcomeDiff()
+        works = []
+        for side in ("a", "b"):
+            spec = dict(self.compare.get(side) or {})
+            spec.setdefault("name", side)
+            work = self.keyspaceWork(spec, self.TARGET_KEYS)
+            # Targets may share a database name on two hosts
+            work.revCache = {}
+            work.lastSeq = {}
+            work.changesSeen = {}
+            work.userSessions = {}
+            work.userSessionLocks = {}
+            work.expectations = None
+            work.outcomeListeners = [
+                listener for listener in self.outcomeListeners
+                if not self.expectations
+                or listener != self.expectations.check
+            ] + [lambda outcome, side=side: diff.add(side, outcome)]
+            works.append(work)
+        self.runWorks(works)
+        self.writeMetricsReport()
+
+        report = diff.report()
+        report["targets"] = {"a": works[0].keyspaceName,
+                             "b": works[1].keyspaceName}
+        latency = {}
+        a_ops, b_ops = (self.operationHistograms(work.metrics)
+                        for work in works)
+        for labels in sorted(set(a_ops) & set(b_ops)):
+            a, b = a_ops[labels].summary(), b_ops[labels].summary()
+            latency["|".join(labels)] = {
+                key: round(b[key] - a[key], 3)
+                for key in ("mean_ms", "p50_ms", "p95_ms", "p99_ms")
+            }
+        report["latencyDelta"] = latency
+        summary = {"flips": report["flips"], "latencyDelta": latency}
+        self.logger.info(
+            f"[{'success' if report['identical'] else 'failed'}] - [DIFF] - "
+            f"{report['compared']} outcomes compared, {report['changed']} "
+            f"changed, {report['onlyInA']} only in a, {report['onlyInB']} "
+            f"only in b - {json.dumps(summary)}"
+        )
+        with open(f"{self.logFileName[:-len('.log')]}_diff.json", "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    # Number of shards of a distributed run: the local worker processes
+    # plus the remote workers of "distributed". 0 when it is not set, and
+    # in a shard itself
+    def shardCount(self):
+        if self.shard:
+            return 0
+        return (self.distributed.get("workers", 0)
+                + self.distributed.get("remoteWorkers", 0))
+
+    # Distributed mode: shards the documents by consistent hash of their
+    # _id over "workers" local processes and "remoteWorkers" workers
+    # connecting from other machines. Every shard runs the command ("run",
+    # "offline" or "loadtest") in its own Work pipeline, and its metrics,
+    # expectations and load test timings are merged into this Work's
+    # reports. Returns the merged metrics (or load test) report
+    def runDistributed(self, command="run"):
+        local = self.distributed.get("workers", 0)
+        count = self.shardCount()
+        self.logger.info(
+            f"[success] - [SHARD] - Running {command} in {count} shards, "
+            f"{local} local and {count - local} remote"
+        )
+        executor = None
+        futures = []
+        if local:
+            # A fresh interpreter per worker: a fork would copy the
+            # logging thread and locks of this process mid-flight
+            executor = ProcessPoolExecutor(
+                max_workers=local,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            futures = [
+                executor.submit(runShard, self.config, (index, count),
+                                command, self.resume)
+                for index in range(local)
+            ]
+        try:
+            remote = self.serveShards(range(local, count), count, command)
+            results = [future.result() for future in futures] + remote
+        finally:
+            if executor:
+                executor.shutdown()
+        for result in results:
+            for key, amount in result["backpressure"].items():
+                self.backpressure.count(key, amount)
+            self.logger.info(
+                f"[success] - [SHARD] - Shard {result['shard'][0]} of "
+                f"{count} ran {result['operations']} operations - "
+                f"{result['logFile']}"
+            )
+        if command == "loadtest":
+            return self.mergeLoadTests(results)
+        return self.mergeShards(results)
+
+    # Hands shards to remote workers as they connect to distributed.listen
+    # and returns their results. A worker first proves it knows authKey by
+    # answering a random challenge; one that does not is dropped and does
+    # not take a shard. Workers authenticate on the executor, so a
+    # connection that stalls does not keep the others out. The protocol is
+    # not encrypted and the task carries the whole config, credentials
+    # included, so without an authKey only a loopback listen is allowed
+    def serveShards(self, shards, count, command):
+        shards = list(shards)
+        if not shards:
+            return []
+        listen = self.distributed.get("listen", "127.0.0.1:7788")
+        host, port = listen.rsplit(":", 1)
+        if not self.distributed.get("authKey") and not isLoopback(host):
+            raise Exception(
+                f"distributed.listen {listen} is reachable from other "
+                f"machines, set distributed.authKey."
+            )
+        wait = self.distributed.get("workerWaitSeconds", 300)
+        free = queue.Queue()
+        for shard in shards:
+            free.put(shard)
+        authenticating = set()
+        lock = threading.Lock()
+        futures = []
+
+        def admit(conn, address):
+            with lock:
+                authenticating.add(conn)
+            passed = self.authenticateWorker(conn)
+            with lock:
+                authenticating.discard(conn)
+            if not passed:
+                self.logger.warning(
+                    f"[failed] - [SHARD] - Worker {address[0]} did not "
+                    f"authenticate"
+                )
+                conn.close()
+                return None
+            try:
+                shard = free.get_nowait()
+            except queue.Empty:
+                # Every shard went to a worker that was quicker
+                conn.close()
+                return None
+            return self.serveShard(conn, address, shard, count, command)
+
+        # Room for as many connections authenticating as shards running
+        with socket.create_server((host, int(port))) as server, \
+                ThreadPoolExecutor(max_workers=2 * len(shards)) as executor:
+            server.settimeout(1)
+            deadline = time.monotonic() + wait
+            while not free.empty():
+                try:
+                    conn, address = server.accept()
+                except socket.timeout:
+                    if time.monotonic() < deadline:
+                        continue
+                    raise Exception(
+                        f"Only {len(shards) - free.qsize()} of "
+                        f"{len(shards)} remote workers connected to "
+                        f"{listen} in {wait}s."
+                    )
+                deadline = time.monotonic() + wait
+                futures.append(executor.submit(admit, conn, address))
+            # All shards are out, the stragglers would be turned away
+            with lock:
+                for conn in authenticating:
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            results = [future.result() for future in futures]
+        return [result for result in results if result is not None]
+
+    # Challenge-response check of distributed.authKey on a new connection
+    def authenticateWorker(self, conn):
+        challenge = os.urandom(16).hex()
+        conn.settimeout(10)
+        try:
+            stream = conn.makefile("rwb")
+            writeMessage(stream, {"challenge": challenge})
+            reply = readMessage(stream) or {}
+        except (OSError, ValueError):
+            return False
+        expected = shardAuth(self.distributed.get("authKey", ""), challenge)
+        return hmac.compare_digest(str(reply.get("auth", "")), expected)
+
+    # Sends one shard's task to a connected worker, waits for its result
+    def serveShard(self, conn, address, shard, count, command):
+        conn.settimeout(None)
+        with conn, conn.makefile("rwb") as stream:
+            writeMessage(stream, {"shard": [shard, count], "command": command,
+                                  "resume": self.resume,
+                                  "config": self.config})
+            reply = readMessage(stream) or {"error": "connection closed"}
+        if "error" in reply:
+            raise Exception(f"Shard {shard} on {address[0]} failed: "
+                            f"{reply['error']}")
+        return reply["result"]
+
+    # What a shard sends back: its metrics (overall and per keyspace),
+    # expectations and load test timings, as a JSON-safe dict
+    def shardResult(self):
+        result = {
+            "shard": list(self.shard),
+            "logFile": self.logFileName,
+            "operations": sum(histogram.count for histogram in
+                              self.metrics.series.values()),
+            "metrics": self.metrics.state(),
+            "slowestDocs": self.slowestDocs.state(),
+            "propagation": self.propagation.state(),
+            "keyspaces": {work.keyspaceName: work.metrics.state()
+                          for work in self.keyspaceWorks},
+            "expectations": {work.keyspaceName: work.expectations.state()
+                             for work in [self] + self.keyspaceWorks
+                             if work.expectations},
+            "backpressure": dict(self.backpressure.counts)
+        }
+        if self.loadTestResult:
+            elapsed, virtual_users, rate, by_operation, by_user = \
+                self.loadTestResult
+            result["loadTest"] = {
+                "durationSeconds": elapsed, "virtualUsers": virtual_users,
+                "byOperation": by_operation.state(),
+                "byUser": by_user.state()
+            }
+        return result
+
+    # Merges the shards of a run into this Work's metrics and
+    # expectations, then writes the reports as a single run would
+    def mergeShards(self, results):
+        self.keyspaceWorks = [self.keyspaceWork(spec)
+                              for spec in self.keyspaces]
+        works = {work.keyspaceName: work
+                 for work in [self] + self.keyspaceWorks}
+        for result in results:
+            self.metrics.mergeState(result["metrics"])
+            self.slowestDocs.mergeState(result["slowestDocs"])
+            self.propagation.mergeState(result["propagation"])
+            for name, state in result["keyspaces"].items():
+                works[name].metrics.mergeState(state)
+            for name, state in result["expectations"].items():
+                works[name].expectations.mergeState(state)
+        report = self.writeMetricsReport()
+        for work in works.values():
+            if work.expectations:
+                work.writeExpectationsReport()
+        return report
+
+    # Merges the load tests of the shards into one report
+    def mergeLoadTests(self, results):
+        by_operation = LatencyReport()
+        by_user = LatencyReport()
+        for result in results:
+            by_operation.mergeState(result["loadTest"]["byOperation"])
+            by_user.mergeState(result["loadTest"]["byUser"])
+        return self.loadTestReport(
+            max(result["loadTest"]["durationSeconds"] for result in results),
+            sum(result["loadTest"]["virtualUsers"] for result in results),
+            self.loadTest.get("targetRate", 0), by_operation, by_user
+        )
+
+    # Whether every expectations file of the run (one per keyspace at
+    # most) was met
+    def expectationsPassed(self):
+        return all(work.expectations.report()["passed"]
+                   for work in [self] + self.keyspaceWorks
+                   if work.expectations)
+
+    # Logs how the run compared with the expectations file and returns
+    # the report
+    def writeExpectationsReport(self):
+        report = self.expectations.report()
+        self.logger.info(
+            f"[{'success' if report['passed'] else 'failed'}] - [EXPECT] - "
+            f"{report['checked']} results checked against "
+            f"{self.expectationsFile}, {report['mismatches']} mismatches, "
+            f"{report['notRun']} expectations not run - {json.dumps(report)}"
+        )
+        return report
+
+    # Rolls the timings of the run up per operation and admin/user, with
+    # the metricsSlowestDocs slowest documents when that is set. The
+    # per-operation view is logged; with metricsReport on, the full report
+    # is also written next to the log file as JSON and in Prometheus text
+    # format. Returns the report
+    def writeMetricsReport(self):
+        by_operation = self.operationHistograms(self.metrics)
+        report = {
+            "byOperation": {
+                f"{op}|{role}": histogram.summary()
+                for (op, role), histogram in sorted(by_operation.items())
+            }
+        }
+        if self.metricsSlowestDocs > 0:
+            report["slowestDocs"] = self.slowestDocs.summary()
+        if self.keyspaceWorks:
+            report["byKeyspace"] = {
+                work.keyspaceName: {
+                    f"{op}|{role}": histogram.summary()
+                    for (op, role), histogram in sorted(
+                        self.operationHistograms(work.metrics).items())
+                }
+                for work in self.keyspaceWorks
+            }
+        self.logger.info(
+            f"[success] - [METRICS] - Latency per operation - "
+            f"{json.dumps(report['byOperation'])}"
+        )
+        if self.propagation.series:
+            report["propagation"] = self.propagation.summary()
+            self.logger.info(
+                f"[success] - [PROPAGATION] - Write to _changes delay per "
+                f"user and channel - {json.dumps(report['propagation'])}"
+            )
+        report["backpressure"] = self.backpressureReport()
+        if self.metricsReport:
+            base = self.logFileName[:-len(".log")]
+            with open(f"{base}_metrics.json", "w") as f:
+                json.dump(report, f, indent=2)
+            with open(f"{base}_metrics.prom", "w") as f:
+                f.write(self.prometheusMetrics(by_operation))
+        return report
+
+    # How Sync Gateway pushed back during the run: throttled responses
+    # per status, retries against the retry budget, Retry-After headers
+    # honored, seconds spent waiting on retries and rate limits, and the
+    # adaptive concurrency limit. Logged when there was any pushback
+    def backpressureReport(self):
+        report = self.backpressure.summary()
+        if self.concurrencyLimit:
+            report["concurrency"] = self.concurrencyLimit.summary()
+        throttled = sum(count for key, count in report.items()
+                        if key.startswith("throttled"))
+        errors = report.get("connectionErrors", 0)
+        if throttled or errors or report.get("retries") or \
+                report["rateLimitWaitSeconds"]:
+            exhausted = report.get("retryBudgetExhausted", 0)
+            self.logger.info(
+                f"[{'failed' if exhausted else 'success'}] - "
+                f"[BACKPRESSURE] - {report.get('requests', 0)} requests, "
+                f"{throttled} throttled, {errors} connection errors, "
+                f"{report.get('retries', 0)} retries, "
+                f"{exhausted} over the retry budget - {json.dumps(report)}"
+            )
+        return report
+
+    # Histograms of a LatencyReport merged per operation and admin/user
+    def operationHistograms(self, metrics):
+        by_operation = {}
+        for labels, histogram in list(metrics.series.items()):
+            by_operation.setdefault(labels[:2], LatencyHistogram()).merge(
+                histogram
+            )
+        return by_operation
+
+    # Times one operation per operation and admin/user, and offers it to
+    # the slowest documents
+    def recordLatency(self, op, admin, doc_id, elapsed, ok):
+        role = "admin" if admin else "user"
+        self.metrics.record((op, role), elapsed, ok)
+        self.slowestDocs.record((op, role, doc_id), elapsed, ok)
+
+    # Prometheus text exposition of per-operation latency summaries and
+    # error counters. Documents are left out to keep label cardinality low
+    def prometheusMetrics(self, by_operation):
+        name = "sg_sync_function_tester_operation_latency_seconds"
+        errors = "sg_sync_function_tester_operation_errors_total"
+        lines = [
+            f"# HELP {name} Time spent in HTTP calls per operation.",
+            f"# TYPE {name} summary"
+        ]
+        error_lines = [
+            f"# HELP {errors} Operations that failed.",
+            f"# TYPE {errors} counter"
+        ]
+        for (op, role), histogram in sorted(by_operation.items()):
+            labels = f'operation="{op}",role="{role}"'
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(
+                    f'{name}{{{labels},quantile="{quantile}"}} '
+                    f"{histogram.percentile(quantile * 100):.6f}"
+                )
+            lines.append(f"{name}_sum{{{labels}}} {histogram.total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+            error_lines.append(f"{errors}{{{labels}}} {histogram.errors}")
+        return "\n".join(lines + error_lines) + "\n"
+
+    # Runs a list of operations against each document of an iterable,
+    # in parallel when concurrency is above 1. step is the position of the
+    # first operation in the configured list
+    def runDocs(self, docs, operations, step=0):
+        plan = self.compilePlan(operations, step)
+        if self.concurrency <= 1:
+            for json_data in docs:
+                self.processDoc(json_data, self.logger, plan)
+            return
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for json_data in docs:
+                log = DocLog(self.logger)
+                future = executor.submit(
+                    self.processDoc, json_data, log, plan
+                )
+                pending.append((future, log))
+                # Bound the in-flight window so memory stays flat
+                if len(pending) >= self.concurrency * 2:
+                    self.flushDoc(*pending.popleft())
+            while pending:
+                self.flushDoc(*pending.popleft())
+
+    # Waits for one document's pipeline and writes its buffered log lines
+    def flushDoc(self, future, log):
+        try:
+            future.result()
+        finally:
+            log.flush()
+
+    # Batch mode: reads the documents in groups of batchSize and runs each
+    # operation step over the whole group before moving to the next step.
+    # Admin steps go through one bulk request per group, the others still
+    # run per document
+    def openJsonFolderBatched(self):
+        batch = []
+        for json_data in self.iterJsonFolder():
+            batch.append(json_data)
+            if len(batch) >= self.batchSize:
+                self.processBatch(batch)
+                batch = []
+        if batch:
+            self.processBatch(batch)
+
+    # Runs every operation step, in order, over one group of documents
+    def processBatch(self, docs):
+        bulk_operations = {
+            "PUT_ADMIN": self.bulkPut,
+            "GET_ADMIN": self.bulkGet,
+            "DELETE_ADMIN": self.bulkDelete,
+            "GET_RAW": self.bulkGetRaw,
+            "PURGE": self.bulkPurge
+        }
+        journal = self.journal()
+        for step in self.compilePlan(self.operations):
+            operation = step.operation
+            bulk_operation = bulk_operations.get(operation)
+            if bulk_operation:
+                todo = docs
+                if journal:
+                    scope = self.journalScope()
+                    todo = [json_data for json_data in docs
+                            if not journal.isDone(scope, json_data["_id"],
+                                                  step.index, "Admin")]
+                    if not todo:
+                        continue
+                ok = True
+                started = time.perf_counter()
+                try:
+                    bulk_operation(todo)
+                    if journal:
+                        for json_data in todo:
+                            self.recordStep(json_data["_id"], step.index,
+                                            "Admin")
+                except requests.RequestException as e:
+                    ok = False
+                    self.logger.error(
+                        f"[failed] - [{operation}] - [Admin] - "
+                        f"Error in bulk {operation} for "
+                        f"{len(todo)} docs - {str(e)}"
+                    )
+                self.metrics.record((step.op, "admin"),
+                                    time.perf_counter() - started, ok)
+            else:
+                self.runDocs(docs, [operation], step.index)
+
+    # Admin URL of a keyspace endpoint such as _bulk_docs or _all_docs
+    def bulkUrl(self, endpoint):
+        return (
+            f"{self.sgHost}:{self.sgAdminPort}/"
+            f"{self.constructDbUrl()}/{endpoint}"
+        )
+
+    # Fetches the revisions of the documents the cache does not know yet
+    # with a single _all_docs request
+    def bulkFetchRevs(self, doc_ids):
+        missing = [doc_id for doc_id in doc_ids
+                   if self.getCachedRev(doc_id) is None]
+        if not missing:
+            return
+        result = self.httpRequest(
+            "POST", self.bulkUrl("_all_docs"),
+            json_data={"keys": missing}, is_admin=True
+        )
+        for row in (result or {}).get("rows", []):
+            value = row.get("value") or {}
+            self.setCachedRev(row.get("key"), value.get("rev"))
 
-    # Default configuration values
-    debug = False
-    sgHost = "http://localhost"
-    sgPort = "4984"
-    sgAdminPort = "4985"
-    sgDb = "sync_gateway"
-    sgDbScope = "_default"
-    sgDbCollection = "_default"
-    sgTestUsers = [{"userName": "bob", "password": "12345", "sgSession": ""}]
-    sgAdminUser = ""
-    sgAdminPassword = "Administrator"
-    logPathToWriteTo = "password"
-    jsonFolder = "jsons"
-    operations = []
+    # GET_ADMIN for a group of documents through _all_docs?include_docs
+    def bulkGet(self, docs):
+        doc_ids = [json_data["_id"] for json_data in docs]
+        result = self.httpRequest(
+            "POST", self.bulkUrl("_all_docs?include_docs=true"),
+            json_data={"keys": doc_ids}, is_admin=True
+        )
+        rows = {row.get("key"): row
+                for row in (result or {}).get("rows", [])}
+        for doc_id in doc_ids:
+            doc = (rows.get(doc_id) or {}).get("doc")
+            status = "success" if doc else "failed"
+            self.logger.info(
+                f"[{status}] - [GET] - [Admin] - "
+                f"GET result for [{doc_id}] - "
+                f"{self.logBody(doc or None)}"
+            )
+            if doc:
+                self.setCachedRev(doc_id, doc.get("_rev"))
+            self.emitOutcome(OpOutcome(
+                doc_id, "GET", "Admin", status,
+                rev=doc.get("_rev") if doc else None
+            ))
 
-    # Initializes the WORK object with the given configuration file
-    def __init__(self, config_file):
-        self.readConfig(config_file)
-        self.setupLogging()
+    # Sends a group of revisions through _bulk_docs. Rows rejected with a
+    # conflict get their revision refetched and are sent once more.
+    # Returns the result row of every document keyed by its ID. A response
+    # that is not a list of rows (an error object from a proxy or an older
+    # Sync Gateway) fails every document of the group, with that response
+    # as its row
+    def bulkWrite(self, docs):
+        rows = {}
+        for attempt in range(2):
+            result = self.httpRequest(
+                "POST", self.bulkUrl("_bulk_docs"),
+                json_data={"docs": docs}, is_admin=True
+            )
+            if result is not None and not isinstance(result, list):
+                for doc in docs:
+                    rows[doc["_id"]] = {"id": doc["_id"],
+                                        "error": "unexpected_response",
+                                        "response": result}
+                break
+            for row in result or []:
+                rows[row.get("id")] = row
+            conflicts = [
+                doc for doc in docs
+                if rows.get(doc["_id"], {}).get("error") == "conflict"
+            ]
+            if not conflicts or attempt:
+                break
+            for doc in conflicts:
+                self.setCachedRev(doc["_id"], None)
+            self.bulkFetchRevs([doc["_id"] for doc in conflicts])
+            docs = conflicts
+            for doc in docs:
+                rev = self.getCachedRev(doc["_id"])
+                if rev:
+                    doc["_rev"] = rev
+                else:
+                    doc.pop("_rev", None)
+        for doc_id, row in rows.items():
+            if row.get("rev") and not row.get("error"):
+                self.setCachedRev(doc_id, row["rev"])
+        return rows
 
-    # Reads the configuration from the specified file
-    # and sets up the object's attributes
-    def readConfig(self, config_file):
-        try:
-            with open(config_file, "r") as f:
-                config = json.load(f)
-        except FileNotFoundError:
-            raise Exception(f"Configuration file '{config_file}' not found.")
-        except json.JSONDecodeError:
-            raise Exception(f"Configuration file '{config_file}'"
-                            f"is not valid JSON."
+    # PUT_ADMIN for a group of documents through _bulk_docs
+    def bulkPut(self, docs):
+        self.bulkFetchRevs([json_data["_id"] for json_data in docs])
+        for json_data in docs:
+            rev = self.getCachedRev(json_data["_id"])
+            if rev:
+                json_data["_rev"] = rev
+            else:
+                json_data.pop("_rev", None)
+            json_data["dateTimeStamp"] = datetime.now().isoformat()
+        rows = self.bulkWrite(docs)
+        for json_data in docs:
+            doc_id = json_data["_id"]
+            row = rows.get(doc_id)
+            ok = row and row.get("rev") and not row.get("error")
+            status = "success" if ok else "failed"
+            self.logger.info(
+                f"[{status}] - [PUT] - [Admin] - "
+                f"PUT result for [{doc_id}] - {self.logBody(row)}"
+            )
+            self.emitOutcome(OpOutcome(
+                doc_id, "PUT", "Admin", status,
+                rev=row.get("rev") if ok else None
+            ))
+
+    # DELETE_ADMIN for a group of documents through _bulk_docs
+    def bulkDelete(self, docs):
+        doc_ids = [json_data["_id"] for json_data in docs]
+        self.bulkFetchRevs(doc_ids)
+        tombstones = []
+        for doc_id in doc_ids:
+            rev = self.getCachedRev(doc_id)
+            if rev:
+                tombstones.append(
+                    {"_id": doc_id, "_rev": rev, "_deleted": True}
+                )
+            else:
+                self.logger.warning(
+                    f"[failed] - [DELETE] - [Admin] - "
+                    f"Unable to delete [{doc_id}] - "
+                    f"Document not found or no revision available"
+                )
+                self.emitOutcome(
+                    OpOutcome(doc_id, "DELETE", "Admin", "failed")
+                )
+        if not tombstones:
+            return
+        rows = self.bulkWrite(tombstones)
+        for tombstone in tombstones:
+            doc_id = tombstone["_id"]
+            row = rows.get(doc_id)
+            ok = row and row.get("rev") and not row.get("error")
+            status = "success" if ok else "failed"
+            self.logger.info(
+                f"[{status}] - [DELETE] - [Admin] - "
+                f"DELETE result for [{doc_id}] - {self.logBody(row)}"
+            )
+            self.emitOutcome(OpOutcome(
+                doc_id, "DELETE", "Admin", status,
+                rev=row.get("rev") if ok else None
+            ))
+
+    # GET_RAW for a group of documents. Sync Gateway has no bulk _raw
+    # endpoint, so the requests are fanned out over the connection pool
+    def bulkGetRaw(self, docs):
+        doc_ids = [json_data["_id"] for json_data in docs]
+        urls = [self.bulkUrl(f"_raw/{doc_id}") for doc_id in doc_ids]
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.httpPoolSize, len(urls)))
+        ) as executor:
+            results = executor.map(
+                lambda url: self.httpRequest("GET", url, is_admin=True),
+                urls
+            )
+            for doc_id, result in zip(doc_ids, results):
+                status = "success" if result else "failed"
+                self.logger.info(
+                    f"[{status}] - [GET_RAW] - [Admin] - "
+                    f"GET_RAW result for [{doc_id}] - "
+                    f"{self.logBody(result or None)}"
+                )
+                self.emitOutcome(OpOutcome(
+                    doc_id, "GET_RAW", "Admin", status,
+                    **(rawOutcome(result) if result else {})
+                ))
+
+    # PURGE for a group of documents with one multi-ID _purge request
+    def bulkPurge(self, docs):
+        doc_ids = [json_data["_id"] for json_data in docs]
+        result = self.postPurge(doc_ids)
+        purged = (result or {}).get("purged") or {}
+        for doc_id in doc_ids:
+            if doc_id in purged:
+                self.setCachedRev(doc_id, None)
+                status = "success"
+                result_str = self.logBody({"purged": {doc_id: purged[doc_id]}})
+            else:
+                status = "failed"
+                result_str = "null"
+            self.logger.info(
+                f"[{status}] - [PURGE] - [Admin] - "
+                f"Purge result for [{doc_id}] - {result_str}"
+            )
+            self.emitOutcome(OpOutcome(doc_id, "PURGE", "Admin", status))
+
+    # Runs a compiled plan (all the configured operations by default), in
+    # order, against one document
+    def processDoc(self, json_data, log, plan=None):
+        journal = self.journal()
+        doc_id = json_data.get("_id")
+        for step in self.compilePlan(self.operations) if plan is None \
+                else plan:
+            if step.sleep is not None:
+                if journal and journal.isDone(self.journalScope(), doc_id,
+                                              step.index, ""):
+                    continue
+                sleep_time = step.sleep
+                if self.offline:
+                    # Nothing to wait for without a Sync Gateway
+                    log.info(
+                        f"[success] - [SLEEP] - Skipped {sleep_time} "
+                        f"seconds offline"
+                    )
+                    continue
+                log.info(
+                    f"[success] - [SLEEP] - Sleeping for"
+                    f"{sleep_time} seconds"
+                )
+                time.sleep(sleep_time)
+                if journal:
+                    self.recordStep(doc_id, step.index, "")
+                continue
+            if step.handler is None:
+                continue
+
+            for user in self.sgTestUsers:
+                if journal and journal.isDone(self.journalScope(), doc_id,
+                                              step.index, user["userName"]):
+                    continue
+                status = self.runOperation(step, json_data, user, log)
+                if journal and status is not None:
+                    self.recordStep(doc_id, step.index, user["userName"])
+
+    # Load-test mode: virtual users loop over the operations for a fixed
+    # duration, optionally paced to a target rate across all of them, and
+    # every operation's latency is recorded per operation and per user.
+    # Returns the report, which is also logged and optionally written to
+    # loadTest.reportFile
+    def runLoadTest(self):
+        settings = self.loadTest
+        steps = [
+            step for step in self.compilePlan(
+                settings.get("operations", self.operations))
+            if step.sleep is None and step.handler is not None
+        ]
+        docs = list(itertools.islice(
+            self.iterJsonFolder(), settings.get("maxDocs", 1000)
+        ))
+        if not steps or not docs:
+            raise Exception("Load test needs at least one operation "
+                            "and one document.")
+        virtual_users = settings.get("virtualUsers", len(self.sgTestUsers))
+        duration = settings.get("durationSeconds", 60)
+        rate = settings.get("targetRate", 0)
+        if self.shard:
+            # Every shard runs its share of the virtual users and rate
+            index, count = self.shard
+            virtual_users = max(1, virtual_users // count
+                                + (index < virtual_users % count))
+            rate = rate / count
+        bucket = TokenBucket(rate) if rate else None
+        self.openUserSessions()
+        by_operation = LatencyReport()
+        by_user = LatencyReport()
+        next_doc = itertools.count()
+
+        started = time.monotonic()
+        deadline = started + duration
+
+        def virtualUser(index):
+            user = self.sgTestUsers[index % len(self.sgTestUsers)]
+            log = NullLog()
+            while time.monotonic() < deadline:
+                # A private copy, PUT adds _rev and a timestamp to it
+                json_data = dict(docs[next(next_doc) % len(docs)])
+                for step in steps:
+                    if bucket:
+                        bucket.acquire()
+                    if time.monotonic() >= deadline:
+                        return
+                    op_started = time.perf_counter()
+                    status = self.runOperation(step, json_data, user, log)
+                    elapsed = time.perf_counter() - op_started
+                    ok = status == "success"
+                    who = "Admin" if step.is_admin else user["userName"]
+                    by_operation.record((step.operation,), elapsed, ok)
+                    by_user.record((who,), elapsed, ok)
+
+        with ThreadPoolExecutor(max_workers=virtual_users) as executor:
+            list(executor.map(virtualUser, range(virtual_users)))
+
+        elapsed = time.monotonic() - started
+        self.loadTestResult = (elapsed, virtual_users, rate, by_operation,
+                               by_user)
+        return self.loadTestReport(*self.loadTestResult)
+
+    # Logs the results of a load test, writes them to loadTest.reportFile
+    # when set (by the coordinator only, in a distributed run) and returns
+    # them
+    def loadTestReport(self, elapsed, virtual_users, rate, by_operation,
+                       by_user):
+        total = sum(histogram.count
+                    for histogram in by_operation.series.values())
+        report = {
+            "durationSeconds": round(elapsed, 3),
+            "virtualUsers": virtual_users,
+            "targetRate": rate,
+            "operations": total,
+            "throughput": round(total / elapsed, 3) if elapsed else 0.0,
+            "byOperation": by_operation.summary(),
+            "byUser": by_user.summary(),
+            "backpressure": self.backpressureReport()
+        }
+        self.logger.info(
+            f"[success] - [LOADTEST] - {total} operations in "
+            f"{report['durationSeconds']}s, "
+            f"{report['throughput']} ops/sec - {json.dumps(report)}"
+        )
+        if self.loadTest.get("reportFile") and not self.shard:
+            with open(self.loadTest["reportFile"], "w") as f:
+                json.dump(report, f, indent=2)
+        return report
+
+    # Operations contention mode runs, the writes that race on _rev
+    CONTENDED_OPERATIONS = ("PUT", "DELETE")
+
+    # Write-contention mode: every PUT/DELETE step of the plan is fired by
+    # contention.writers writers (spread over sgTestUsers) at the same
+    # document at the same moment, for contention.rounds rounds per step.
+    # A writer that loses the GET -> PUT race on _rev gets a 409, reads
+    # the revision again and retries, up to contention.maxRetries times.
+    # Reports the conflict rate, the retries per successful write and the
+    # end-to-end write latency per operation, and after the last step the
+    # depth of each document's revision tree from GET_RAW. The report is
+    # logged and optionally written to contention.reportFile
+    def runContention(self):
+        if self.offline:
+            raise Exception("Contention mode needs a Sync Gateway, "
+                            "it does not run offline.")
+        settings = self.contention
+        steps = [
+            step for step in self.compilePlan(
+                settings.get("operations", self.operations))
+            if step.op in self.CONTENDED_OPERATIONS
+            and step.handler is not None
+        ]
+        docs = list(itertools.islice(
+            self.iterJsonFolder(), settings.get("maxDocs", 10)
+        ))
+        if not steps or not docs:
+            raise Exception("Contention mode needs at least one PUT or "
+                            "DELETE step and one document.")
+        writers = settings.get("writers", len(self.sgTestUsers))
+        rounds = settings.get("rounds", 1)
+        self.openUserSessions()
+        counts = {}
+        latency = LatencyReport()
+        rev_trees = {}
+
+        def writer(index, step, json_data, barrier):
+            user = self.sgTestUsers[index % len(self.sgTestUsers)]
+            # All writers leave the barrier together, so their GETs
+            # and writes overlap
+            barrier.wait()
+            return user, self.contendedWrite(step, json_data, user)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=writers) as executor:
+            for json_data in docs:
+                doc_id = json_data.get("_id")
+                for step in steps:
+                    counter = counts.setdefault(step.operation, Counter())
+                    for _ in range(rounds):
+                        barrier = threading.Barrier(writers)
+                        futures = [
+                            executor.submit(writer, index, step, json_data,
+                                            barrier)
+                            for index in range(writers)
+                        ]
+                        for future in futures:
+                            user, result = future.result()
+                            self.noteContendedWrite(
+                                step, doc_id, user, result, counter, latency
                             )
+                rev_trees[doc_id] = self.contendedRevTree(doc_id)
 
-        self.sgLogName = config.get("logPathToWriteTo", self.logPathToWriteTo)
-        self.sgHost = config.get("sgHost", self.sgHost)
-        self.sgPort = config.get("sgPort", self.sgPort)
-        self.sgAdminPort = config.get("sgAdminPort", self.sgAdminPort)
-        self.sgDb = config.get("sgDb", self.sgDb)
-        self.sgDbScope = config.get("sgDbScope", self.sgDbScope)
-        self.sgDbCollection = config.get("sgDbCollection", self.sgDbCollection)
-        self.sgTestUsers = config.get("sgTestUsers", self.sgTestUsers)
-        self.sgAdminUser = config.get("sgAdminUser", self.sgAdminUser)
-        self.sgAdminPassword = config.get(
-            "sgAdminPassword", self.sgAdminPassword
+        elapsed = time.monotonic() - started
+        return self.contentionReport(elapsed, writers, rounds, len(docs),
+                                     counts, latency, rev_trees)
+
+    # One writer's GET -> write loop for one contended step. Returns
+    # (status, attempts, conflicts, seconds, last HttpResult); status is
+    # "success", "failed" (a non-409 error, e.g. the sync function said
+    # no), "gave up" (still conflicting after maxRetries) or, for a
+    # DELETE, "gone" when another writer deleted the document first
+    def contendedWrite(self, step, json_data, user):
+        settings = self.contention
+        max_retries = settings.get("maxRetries", 10)
+        backoff = settings.get("retryBackoffMs", 0) / 1000
+        doc_id = json_data.get("_id")
+        userName = user["userName"]
+        password = user["password"]
+        session = user["sgSession"]
+        is_admin = step.is_admin
+        sgUrl = self.docUrl(doc_id, is_admin)
+        attempts = conflicts = 0
+        status = "gave up"
+        response = HttpResult()
+        started = time.perf_counter()
+        while attempts <= max_retries:
+            # Always a fresh read, the revision cache would only hide the
+            # race being measured
+            rev = self.fetchRev(
+                doc_id, sgUrl, userName=userName, password=password,
+                session=session, is_admin=is_admin
+            )
+            if step.op == "DELETE" and not rev:
+                status = "gone"
+                break
+            attempts += 1
+            if step.op == "PUT":
+                body = dict(json_data,
+                            dateTimeStamp=datetime.now().isoformat())
+                if rev:
+                    body["_rev"] = rev
+                else:
+                    body.pop("_rev", None)
+                response = self.httpCall(
+                    "PUT", sgUrl, json_data=body,
+                    userName=userName, password=password,
+                    session=session, is_admin=is_admin
+                )
+            else:
+                response = self.httpCall(
+                    "DELETE", f"{sgUrl}?rev={rev}",
+                    userName=userName, password=password,
+                    session=session, is_admin=is_admin
+                )
+            if step.op == "DELETE" and response.status == 404:
+                # Deleted between this writer's GET and its DELETE
+                status = "gone"
+                break
+            if response.status != 409:
+                result = response.body
+                status = ("success" if isinstance(result, dict)
+                          and result.get("ok") else "failed")
+                break
+            conflicts += 1
+            if backoff:
+                # Jittered, so the losers do not collide again in step
+                time.sleep(random.uniform(0, backoff * conflicts))
+        return (status, attempts, conflicts, time.perf_counter() - started,
+                response)
+
+    # Counts, times, logs and hands to the outcome listeners one
+    # contended write
+    def noteContendedWrite(self, step, doc_id, user, result, counter,
+                           latency):
+        status, attempts, conflicts, elapsed, response = result
+        ok = status == "success"
+        who = "Admin" if step.is_admin else user["userName"]
+        counter["writes"] += 1
+        counter["attempts"] += attempts
+        counter["conflicts"] += conflicts
+        counter[{"success": "succeeded", "gave up": "gaveUp"}.get(
+            status, status)] += 1
+        latency.record((step.operation,), elapsed, ok)
+        self.recordLatency(step.op, step.admin, doc_id, elapsed, ok)
+        rev = response.body.get("rev") \
+            if ok and isinstance(response.body, dict) else None
+        self.emitOutcome(OpOutcome(
+            doc_id, step.op, who, "success" if ok else "failed",
+            rev=rev, elapsed=elapsed, http=response.status
+        ))
+        self.logger.info(
+            f"[{'success' if ok else 'failed'}] - [{step.op}] - [{who}] - "
+            f"Contended {step.op} result for [{doc_id}] - {status} after "
+            f"{attempts} attempts, {conflicts} conflicts, "
+            f"{elapsed * 1000:.3f}ms - {self.logBody(response.body)}"
         )
-        self.jsonFolder = config.get("jsonFolder", self.jsonFolder)
-        self.debug = config.get("debug", self.debug)
-        self.operations = config.get("operations", self.operations)
 
-    # Sets up logging for the application with ISO 8601 timestamps
-    def setupLogging(self):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        log_filename = f"{self.sgLogName}_{timestamp}.log"
+    # The revision tree of a contended document, read with GET_RAW
+    def contendedRevTree(self, doc_id):
+        raw = self.httpRequest("GET", self.rawUrl(doc_id), is_admin=True)
+        tree = revTree(raw) if isinstance(raw, dict) else None
+        self.logger.info(
+            f"[{'success' if tree else 'failed'}] - [GET_RAW] - [Admin] - "
+            f"Revision tree of [{doc_id}] - {json.dumps(tree)}"
+        )
+        return tree
 
-        self.logger = logging.getLogger()
-        self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
+    # Logs the results of a contention run, writes them to
+    # contention.reportFile when set and returns them
+    def contentionReport(self, elapsed, writers, rounds, documents, counts,
+                         latency, rev_trees):
+        by_operation = {}
+        for operation, counter in counts.items():
+            attempts = counter["attempts"]
+            succeeded = counter["succeeded"]
+            by_operation[operation] = dict(
+                counter,
+                conflictRate=round(counter["conflicts"] / attempts, 4)
+                if attempts else 0.0,
+                retriesPerWrite=round(counter["conflicts"] / succeeded, 3)
+                if succeeded else None,
+                latency=latency.histogram((operation,)).summary()
+            )
+        depths = [tree["depth"] for tree in rev_trees.values()
+                  if tree and tree["depth"] is not None]
+        report = {
+            "durationSeconds": round(elapsed, 3),
+            "writers": writers,
+            "rounds": rounds,
+            "documents": documents,
+            "byOperation": by_operation,
+            "maxRevTreeDepth": max(depths) if depths else None,
+            "revTrees": rev_trees,
+            "backpressure": self.backpressureReport()
+        }
+        self.logger.info(
+            f"[success] - [CONTENTION] - {writers} writers, "
+            f"{documents} documents - {json.dumps(report)}"
+        )
+        if self.contention.get("reportFile"):
+            with open(self.contention["reportFile"], "w") as f:
+                json.dump(report, f, indent=2)
+        return report
 
-        formatter = logging.Formatter(
-            "%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s",
-            datefmt='%Y-%m-%dT%H:%M:%S'
+    # Metadata bloat analyzer: reads _raw (as GET_RAW does) for every
+    # document of the corpus, `concurrency` requests at a time with at
+    # most batchSize in flight, and measures each document's _sync
+    # metadata with syncMetadata(). Reports the totals, the per-docType
+    # mean and max of every metric and the top offenders, and writes it
+    # all, per-document numbers included, as a snapshot to
+    # analyze.reportFile (<log>_sync_analysis.json by default). Given the
+    # snapshot of an earlier run as analyze.baselineFile, it also reports
+    # what grew since then
+    def runAnalyze(self):
+        if self.offline:
+            raise Exception("The analyzer reads _sync from a Sync Gateway, "
+                            "it does not run offline.")
+        settings = self.analyze
+        docs = self.iterJsonFolder()
+        if settings.get("maxDocs"):
+            docs = itertools.islice(docs, settings["maxDocs"])
+        by_doc = {}
+        missing = []
+
+        def analyze(json_data):
+            doc_id = json_data.get("_id")
+            result = self.httpCall("GET", self.rawUrl(doc_id), is_admin=True)
+            if not isinstance(result.body, dict):
+                missing.append(doc_id)
+                self.logger.info(
+                    f"[failed] - [ANALYZE] - [Admin] - No _raw for "
+                    f"[{doc_id}] - HTTP {result.status}"
+                )
+                return False
+            metrics = by_doc[doc_id] = syncMetadata(
+                doc_id, result.body,
+                len(result.raw) if result.raw
+                else len(self.jsonCodec.dumps(result.body)),
+                self.jsonCodec.dumps
+            )
+            self.logger.info(
+                f"[success] - [ANALYZE] - [Admin] - _sync metadata of "
+                f"[{doc_id}] - {json.dumps(metrics)}"
+            )
+            return True
+
+        started = time.monotonic()
+        self.runConcurrently(analyze, docs)
+        report = self.analysisReport(by_doc, missing,
+                                     time.monotonic() - started)
+        baseline_file = settings.get("baselineFile")
+        if baseline_file:
+            with open(baseline_file) as f:
+                report["comparison"] = self.compareAnalyses(
+                    json.load(f), report)
+            report["comparison"]["baselineFile"] = baseline_file
+        summary = {key: report[key] for key in ("totals", "byDocType")}
+        self.logger.info(
+            f"[success] - [ANALYZE] - {report['documents']} documents, "
+            f"{report['totals']['syncBytes']['total']} bytes of _sync "
+            f"metadata, {len(missing)} not found - {json.dumps(summary)}"
         )
+        if baseline_file:
+            comparison = report["comparison"]
+            self.logger.info(
+                f"[success] - [ANALYZE] - Compared with {baseline_file}: "
+                f"{comparison['newDocs']} new and {comparison['goneDocs']} "
+                f"gone documents - {json.dumps(comparison['byDocType'])}"
+            )
+        report_file = settings.get("reportFile") or \
+            f"{self.logFileName[:-len('.log')]}_sync_analysis.json"
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
 
-        file_handler = logging.FileHandler(log_filename)
-        file_handler.setFormatter(formatter)
+    # Rolls the per-document numbers of the analyzer up into totals,
+    # per-docType totals, means and maxima, and the top analyze.top
+    # documents by metadata size, revision tree depth, channel history
+    # and grants
+    def analysisReport(self, by_doc, missing, elapsed):
+        top_n = self.analyze.get("top", 10)
+        totals = {}
+        by_type = {}
+        for metrics in by_doc.values():
+            for stats in (totals, by_type.setdefault(metrics["docType"], {})):
+                stats["docs"] = stats.get("docs", 0) + 1
+                for metric in SYNC_METRICS:
+                    value = stats.setdefault(metric, {"total": 0, "max": 0})
+                    value["total"] += metrics[metric]
+                    value["max"] = max(value["max"], metrics[metric])
+        for stats in [totals] + list(by_type.values()):
+            for metric in SYNC_METRICS:
+                value = stats.setdefault(metric, {"total": 0, "max": 0})
+                value["mean"] = round(value["total"] / stats["docs"], 3) \
+                    if stats.get("docs") else 0.0
+        top = {
+            metric: [
+                {"docId": doc_id, metric: metrics[metric]}
+                for doc_id, metrics in heapq.nlargest(
+                    top_n, by_doc.items(), key=lambda item: item[1][metric])
+                if metrics[metric]
+            ]
+            for metric in ("syncBytes", "revTreeDepth", "channelHistory",
+                           "accessGrants")
+        }
+        return {
+            "durationSeconds": round(elapsed, 3),
+            "documents": len(by_doc),
+            "missing": sorted(missing),
+            "totals": totals,
+            "byDocType": dict(sorted(by_type.items())),
+            "top": top,
+            "byDoc": by_doc
+        }
 
-        self.logger.addHandler(file_handler)
+    # What changed between an earlier analyzer snapshot and this one: the
+    # change in every per-docType mean, the documents that are new or
+    # gone, and the top analyze.top documents whose metadata grew most
+    def compareAnalyses(self, baseline, report):
+        before_docs = baseline.get("byDoc", {})
+        after_docs = report["byDoc"]
+        by_type = {}
+        for doc_type in sorted(set(baseline.get("byDocType", {}))
+                               | set(report["byDocType"])):
+            before = baseline.get("byDocType", {}).get(doc_type, {})
+            after = report["byDocType"].get(doc_type, {})
+            by_type[doc_type] = {
+                metric: round(after.get(metric, {}).get("mean", 0)
+                              - before.get(metric, {}).get("mean", 0), 3)
+                for metric in SYNC_METRICS
+            }
+            by_type[doc_type]["docs"] = after.get("docs", 0) \
+                - before.get("docs", 0)
+        grown = heapq.nlargest(
+            self.analyze.get("top", 10),
+            ((after_docs[doc_id]["syncBytes"]
+              - before_docs[doc_id]["syncBytes"], doc_id)
+             for doc_id in set(before_docs) & set(after_docs))
+        )
+        return {
+            "newDocs": len(set(after_docs) - set(before_docs)),
+            "goneDocs": len(set(before_docs) - set(after_docs)),
+            "byDocType": by_type,
+            "grown": [
+                {"docId": doc_id,
+                 "before": before_docs[doc_id]["syncBytes"],
+                 "after": after_docs[doc_id]["syncBytes"],
+                 "delta": delta}
+                for delta, doc_id in grown if delta > 0
+            ]
+        }
 
-        # Store the file handler so it can be closed later
-        self.file_handler = file_handler
+    # Replay mode: streams a capture file (replay.file, written with
+    # captureFile) and sends its requests again with their original
+    # spacing divided by replay.speed (2 = twice as fast, 0 = back to
+    # back). Every user (and Admin) gets a pipeline of their own that
+    # sends their requests in order, one at a time like a client, while
+    # the pipelines of different users run at the same time. Paths are
+    # sent as captured, with the keyspaces named in replay.rewrite swapped
+    # for others. Reports the latency per operation and per user, the
+    # statuses that differ from the captured ones and how far requests
+    # slipped behind their schedule; the report is logged and optionally
+    # written to replay.reportFile
+    def runReplay(self):
+        settings = self.replay
+        path = settings.get("file")
+        if not path:
+            raise Exception("Replay needs replay.file, a file written "
+                            "with captureFile.")
+        if self.captureFile and \
+                os.path.abspath(path) == os.path.abspath(self.captureFile):
+            raise Exception("replay.file cannot be the captureFile of the "
+                            "replay itself.")
+        speed = settings.get("speed", 1.0)
+        users = {user["userName"]: user for user in self.sgTestUsers}
+        self.openUserSessions()
+        by_operation = LatencyReport()
+        by_user = LatencyReport()
+        lag = LatencyHistogram()
+        counts = Counter()
+        pipelines = {}
+        threads = []
 
-    # Closes the log file
-    def closeLogFile(self):
-        if hasattr(self, 'file_handler'):
-            self.file_handler.close()
-            self.logger.removeHandler(self.file_handler)
+        def pipeline(entries):
+            while True:
+                entry, due = entries.get()
+                if entry is None:
+                    return
+                lag.record(max(0.0, time.monotonic() - due))
+                self.replayRequest(entry, users, counts, by_operation,
+                                   by_user)
 
-    # Constructs the database URL based on scope and collection
-    def constructDbUrl(self):
-        if self.sgDbScope == "_default" and self.sgDbCollection == "_default":
-            return self.sgDb
+        source = FixtureSource(path, self.logger, self.jsonCodec.loads)
+        first = last = None
+        started = time.monotonic()
+        try:
+            with source.openFile(path) as f:
+                for entry in source.iterLines(f, path):
+                    if not isinstance(entry, dict) or \
+                            "method" not in entry or "path" not in entry:
+                        counts["skipped"] += 1
+                        continue
+                    who = "Admin" if entry.get("admin") else entry.get("user")
+                    if who != "Admin" and who not in users:
+                        counts["unknownUser"] += 1
+                        continue
+                    at = entry.get("at", last or 0)
+                    first = at if first is None else first
+                    last = at
+                    due = (started + (at - first) / speed if speed
+                           else time.monotonic())
+                    wait = due - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    entries = pipelines.get(who)
+                    if entries is None:
+                        entries = pipelines[who] = queue.SimpleQueue()
+                        thread = threading.Thread(target=pipeline,
+                                                  args=(entries,),
+                                                  daemon=True)
+                        thread.start()
+                        threads.append(thread)
+                    entries.put((entry, due))
+        finally:
+            for entries in pipelines.values():
+                entries.put((None, None))
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.monotonic() - started
+        total = sum(histogram.count
+                    for histogram in by_operation.series.values())
+        report = {
+            "durationSeconds": round(elapsed, 3),
+            "capturedSeconds": round(last - first, 3)
+            if first is not None else 0.0,
+            "speed": speed,
+            "requests": total,
+            "pipelines": len(pipelines),
+            "counts": dict(sorted(counts.items())),
+            "lag": lag.summary(),
+            "byOperation": by_operation.summary(),
+            "byUser": by_user.summary(),
+            "backpressure": self.backpressureReport()
+        }
+        self.logger.info(
+            f"[{'failed' if counts['statusChanged'] else 'success'}] - "
+            f"[REPLAY] - {total} requests in {report['durationSeconds']}s "
+            f"over {len(pipelines)} pipelines, {counts['statusChanged']} "
+            f"with a different status than captured - {json.dumps(report)}"
+        )
+        if settings.get("reportFile"):
+            with open(settings["reportFile"], "w") as f:
+                json.dump(report, f, indent=2)
+        return report
+
+    # Sends one captured request again and records it. A document write
+    # uses the revision the replay knows (or looks it up) instead of the
+    # captured one, and is sent again once after a 409. A PUT captured
+    # without its body sends the jsonFolder document with the same _id
+    def replayRequest(self, entry, users, counts, by_operation, by_user):
+        is_admin = bool(entry.get("admin"))
+        who = "Admin" if is_admin else entry["user"]
+        user = users.get(who, {})
+        userName = user.get("userName", "")
+        password = user.get("password", "")
+        session = user.get("sgSession", "")
+        method = entry["method"]
+        parts = urlsplit(entry["path"])
+        segments = parts.path.split("/")
+        if len(segments) > 1:
+            segments[1] = self.replay.get("rewrite", {}).get(
+                segments[1], segments[1])
+        doc_path = "/".join(segments)
+        base = f"{self.sgHost}:{self.sgAdminPort if is_admin else self.sgPort}"
+        # (keyspace, docId) of a document request, the revCache key
+        doc_key = (tuple(segments[1:]) if len(segments) == 3
+                   and not segments[2].startswith("_") else None)
+        body = entry.get("body")
+        query = dict(parse_qsl(parts.query))
+        # Whether the captured write named a revision; for a fixture body
+        # the replay can only tell by knowing the document already
+        has_rev = "_rev" in (body or {}) or "rev" in query
+        if body is None and method == "PUT" and doc_key:
+            body = self.replayFixture(doc_key[1])
+            has_rev = doc_key in self.revCache
+        if body is None and method in ("PUT", "POST"):
+            counts["noBody"] += 1
+            return
+
+        self.opContext.op = entry.get("op")
+        try:
+            for attempt in range(2):
+                if doc_key and method in ("PUT", "DELETE") and (
+                        has_rev or attempt):
+                    rev = self.revCache.get(doc_key) if not attempt \
+                        else None
+                    if rev is None:
+                        current = self.httpRequest(
+                            "GET", f"{base}{doc_path}", userName=userName,
+                            password=password, session=session,
+                            is_admin=is_admin
+                        )
+                        rev = (current or {}).get("_rev")
+                    if method == "PUT":
+                        body = dict(body, _rev=rev)
+                        if not rev:
+                            del body["_rev"]
+                    elif rev:
+                        query["rev"] = rev
+                url = f"{base}{doc_path}"
+                if query:
+                    url = f"{url}?{urlencode(query)}"
+                result = self.httpCall(
+                    method, url, json_data=body, userName=userName,
+                    password=password, session=session, is_admin=is_admin
+                )
+                if result.status != 409 or not doc_key or attempt:
+                    break
+        finally:
+            self.opContext.op = None
+
+        if doc_key and isinstance(result.body, dict):
+            rev = result.body.get("rev") or result.body.get("_rev")
+            if rev:
+                self.revCache[doc_key] = rev
+        ok = result.status is not None and result.status < 400
+        by_operation.record((entry.get("op") or method,), result.elapsed, ok)
+        by_user.record((who,), result.elapsed, ok)
+        counts[f"http{result.status}"] += 1
+        changed = result.status != entry.get("status")
+        if changed:
+            counts["statusChanged"] += 1
+        self.logger.info(
+            f"[{'success' if ok else 'failed'}] - [REPLAY] - [{who}] - "
+            f"{method} {doc_path} - HTTP {result.status}"
+            + (f", captured {entry.get('status')}" if changed else "")
+            + f" - {result.elapsed * 1000:.3f}ms"
+        )
+
+    # The jsonFolder document with this _id, for PUTs captured without
+    # their body. The folder is read once, on first use
+    def replayFixture(self, doc_id):
+        with self.fixtureCacheLock:
+            fixtures = self.fixtureCache.get("replay")
+            if fixtures is None:
+                fixtures = self.fixtureCache["replay"] = {
+                    json_data["_id"]: json_data
+                    for json_data in self.iterJsonFolder()
+                }
+        json_data = fixtures.get(doc_id)
+        return dict(json_data) if json_data is not None else None
+
+    # Calls fn for every item on a thread pool of `concurrency` workers,
+    # keeping at most batchSize calls in flight. Returns the sum of what
+    # the calls returned (a True counts as 1)
+    def runConcurrently(self, fn, items):
+        done = 0
+        pending = deque()
+        with ThreadPoolExecutor(
+                max_workers=max(1, self.concurrency)) as executor:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= self.batchSize:
+                    done += pending.popleft().result()
+            while pending:
+                done += pending.popleft().result()
+        return done
+
+    # The roles named in the generator's user templates
+    def generatedRoles(self):
+        return sorted({role for template in
+                       self.generator.get("userTemplates", [])
+                       for role in template.get("roles", [])})
+
+    # The users the generator settings describe, one sgTestUsers entry per
+    # user. Templates are used in turn; "{user}" and "{n}" in a template's
+    # channels are replaced with the user's name and number
+    def generatedUsers(self):
+        settings = self.generator
+        prefix = settings.get("userPrefix", "user-")
+        password = settings.get("password", "password")
+        templates = settings.get("userTemplates") or [{}]
+        for n in range(settings.get("users", 0)):
+            template = templates[n % len(templates)]
+            userName = f"{prefix}{n}"
+            yield {
+                "userName": userName,
+                "password": password,
+                "sgSession": "",
+                "roles": list(template.get("roles", [])),
+                "channels": [
+                    channel.format(user=userName, n=n)
+                    for channel in template.get("channels", ["{user}"])
+                ]
+            }
+
+    # The fixture documents the generator settings describe. IDs follow
+    # the "<docType>-<n>" convention the example sync functions split on,
+    # and each document gets a random set of the generated users' channels
+    def generatedDocs(self):
+        settings = self.generator
+        doc_types = settings.get("docTypes", ["order", "job"])
+        users = settings.get("users", 0)
+        prefix = settings.get("userPrefix", "user-")
+        per_doc = settings.get("channelsPerDoc", 1)
+        rng = random.Random(settings.get("seed", 1))
+        for n in range(settings.get("docs", 0)):
+            doc_type = doc_types[n % len(doc_types)]
+            picks = (rng.sample(range(users),
+                                rng.randint(1, min(per_doc, users)))
+                     if users else [])
+            yield {
+                "_id": f"{doc_type}-{n}",
+                "docType": doc_type,
+                "channels": [f"{prefix}{i}" for i in sorted(picks)]
+            }
+
+    # Generates test data for scale testing: creates the roles and users
+    # through the admin REST API, then streams the fixture documents to
+    # fixtureFile (gzip'd when it ends in .gz). The users are also written
+    # to usersFile, which sgTestUsers can point at
+    def runGenerate(self):
+        settings = self.generator
+        admin = f"{self.sgHost}:{self.sgAdminPort}/{self.sgDb}"
+        started = time.monotonic()
+
+        roles = self.generatedRoles()
+        for role in roles:
+            self.httpCall("PUT", f"{admin}/_role/{role}",
+                          json_data={"name": role}, is_admin=True)
+
+        def createUser(user):
+            result = self.httpCall(
+                "PUT", f"{admin}/_user/{user['userName']}",
+                json_data={
+                    "name": user["userName"],
+                    "password": user["password"],
+                    "admin_roles": user["roles"],
+                    "admin_channels": user["channels"]
+                },
+                is_admin=True
+            )
+            return result.status in (200, 201)
+
+        users_file = settings.get("usersFile", "generated_users.jsonl")
+        with open(users_file, "w") as f:
+            def users():
+                for user in self.generatedUsers():
+                    f.write(json.dumps(user) + "\n")
+                    yield user
+            created = self.runConcurrently(createUser, users())
+
+        fixture_file = settings.get("fixtureFile", "generated.jsonl.gz")
+        opener = gzip.open if fixture_file.endswith(".gz") else open
+        docs = 0
+        with opener(fixture_file, "wt") as f:
+            for json_data in self.generatedDocs():
+                f.write(json.dumps(json_data) + "\n")
+                docs += 1
+
+        self.logger.info(
+            f"[GENERATE] - Created {len(roles)} roles and {created} of "
+            f"{settings.get('users', 0)} users in {users_file}, wrote {docs} "
+            f"documents to {fixture_file} in "
+            f"{time.monotonic() - started:.1f}s"
+        )
+        return {"roles": len(roles), "users": created, "docs": docs}
+
+    # Removes everything runGenerate made: the generated documents are
+    # purged batchSize IDs per _purge request, several requests at a time,
+    # then the users and roles are deleted
+    def runTeardown(self):
+        admin = f"{self.sgHost}:{self.sgAdminPort}/{self.sgDb}"
+        started = time.monotonic()
+
+        def batches():
+            ids = (json_data["_id"] for json_data in self.generatedDocs())
+            while True:
+                batch = list(itertools.islice(ids, self.batchSize))
+                if not batch:
+                    return
+                yield batch
+
+        def purge(batch):
+            result = self.postPurge(batch)
+            return len((result or {}).get("purged") or {})
+
+        purged = self.runConcurrently(purge, batches())
+
+        def deleteUser(user):
+            result = self.httpCall(
+                "DELETE", f"{admin}/_user/{user['userName']}", is_admin=True
+            )
+            return result.status == 200
+        deleted = self.runConcurrently(deleteUser, self.generatedUsers())
+
+        roles = self.generatedRoles()
+        for role in roles:
+            self.httpCall("DELETE", f"{admin}/_role/{role}", is_admin=True)
+
+        self.logger.info(
+            f"[TEARDOWN] - Purged {purged} documents, deleted {deleted} "
+            f"users and {len(roles)} roles in "
+            f"{time.monotonic() - started:.1f}s"
+        )
+        return {"purged": purged, "users": deleted, "roles": len(roles)}
+
+    # Splits an operation string such as "CHANGES_ADMIN:bob" into the
+    # operation name, whether it runs as admin, and its parameter
+    def parseOperation(self, operation):
+        is_admin = "_ADMIN" in operation
+        if is_admin:
+            op, *rest = operation.split("_ADMIN")
+            params = (rest[0].split(":", 1)[1]
+                      if rest and ":" in rest[0] else "")
         else:
-            return f"{self.sgDb}.{self.sgDbScope}.{self.sgDbCollection}"
+            op, *rest = operation.split(":")
+            params = rest[0] if rest else ""
+        return op, is_admin, params
 
-    # Performs an HTTP request to the Sync Gateway
-    def httpRequest(
-        self,
-        method,
-        url,
-        json_data=None,
-        userName="",
-        password="",
-        session="",
-        is_admin=False
-    ):
+    # Compiles a list of operation strings into a tuple of Steps, numbered
+    # from first_step. Plans are cached, so each list is parsed once
+    def compilePlan(self, operations, first_step=0):
+        self.urlBases = self.buildUrlBases()
+        key = (tuple(operations), first_step)
+        plan = self.plans.get(key)
+        if plan is not None:
+            return plan
+        steps = []
+        for index, operation in enumerate(operations, first_step):
+            if operation.startswith("SLEEP"):
+                sleep_time = 1  # Default sleep time
+                if ":" in operation:
+                    try:
+                        sleep_time = int(operation.split(":")[1])
+                    except ValueError:
+                        self.logger.warning(
+                            f"Invalid sleep time format:"
+                            f"{operation}. Using default 1 second."
+                        )
+                steps.append(Step(index, operation, "SLEEP",
+                                  sleep=sleep_time))
+                continue
+            op, is_admin, params = self.parseOperation(operation)
+            handler = OPERATIONS.get(op)
+            if handler is None:
+                self.logger.warning(
+                    f"[failed] - [{operation}] - Unknown operation, skipped"
+                )
+            steps.append(Step(
+                index, operation, op, is_admin, params,
+                admin=is_admin or op in ADMIN_OPERATIONS, handler=handler
+            ))
+        plan = self.plans[key] = tuple(steps)
+        return plan
+
+    # Runs one step for one user against one document. Returns "success"
+    # or "failed", or None when the step did not run. The HTTP calls it
+    # makes are timed, attached to its log records and recorded in the
+    # run's metrics, and its outcome goes to the outcome listeners
+    def runOperation(self, step, json_data, user, log):
+        context = self.opContext
+        context.calls = calls = []
+        context.details = details = {}
+        context.op = step.op
+        started = time.perf_counter()
         try:
-            headers = {"Content-Type": "application/json"}
-            if session:
-                headers["Cookie"] = f"SyncGatewaySession={session}"
+            status = self.dispatchOperation(
+                step, json_data, user, TimedLog(log, calls)
+            )
+        finally:
+            context.calls = context.details = context.op = None
+        if status is None:
+            return None
+        op = step.op
+        admin = step.admin
+        doc_id = json_data.get("_id")
+        # Time spent in HTTP calls, or the whole operation when it made
+        # none (offline mode)
+        elapsed = (sum(call.elapsed for call in calls) if calls
+                   else time.perf_counter() - started)
+        self.recordLatency(op, admin, doc_id, elapsed, status == "success")
+        self.emitOutcome(OpOutcome(
+            doc_id, op, "Admin" if admin else user["userName"], status,
+            elapsed=elapsed, http=calls[-1].status if calls else None,
+            **details
+        ))
+        return status
 
-            if is_admin:
-                auth = HTTPBasicAuth(self.sgAdminUser, self.sgAdminPassword)
-                url = url.replace(
-                    f":{self.sgPort}/",
-                    f":{self.sgAdminPort}/"
+    # Lets the running operation's handler report more than success or
+    # failure, e.g. the channels a document was assigned to
+    def noteOutcome(self, **details):
+        current = getattr(self.opContext, "details", None)
+        if current is not None:
+            current.update(details)
+
+    # Hands an operation's outcome to every registered listener
+    def emitOutcome(self, outcome):
+        outcome.keyspace = self.keyspaceName or None
+        for listener in self.outcomeListeners:
+            listener(outcome)
+
+    # Calls the handler of one step
+    def dispatchOperation(self, step, json_data, user, log):
+        if self.offlineGateway:
+            return self.offlineGateway.dispatch(
+                step.op, step.is_admin, step.params, json_data, user, log
+            )
+        return step.handler(self, json_data, user, step.is_admin,
+                            step.params, log)
+
+    # Reads the document as the user (or admin)
+    def runGet(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        userName = user["userName"]
+        password = user["password"]
+        session = user["sgSession"]
+        sgUrl = self.docUrl(doc_id, is_admin)
+        status = "failed"
+        try:
+            result = self.httpRequest(
+                "GET", sgUrl, userName=userName,
+                password=password, session=session,
+                is_admin=is_admin
+            )
+            status = "success" if result else "failed"
+            log.info(
+                f"[{status}] - [GET] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"GET result for [{doc_id}] - "
+                f"{self.logBody(result or None)}"
+            )
+            if result:
+                self.setCachedRev(doc_id, result.get('_rev'))
+                self.noteOutcome(rev=result.get('_rev'))
+        except requests.RequestException:
+            log.info(
+                f"[failed] - [GET] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"GET result for [{doc_id}] - null"
+            )
+        return status
+
+    # Writes the document as the user (or admin), reusing the cached
+    # revision when there is one
+    def runPut(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        userName = user["userName"]
+        password = user["password"]
+        session = user["sgSession"]
+        sgUrl = self.docUrl(doc_id, is_admin)
+        status = "failed"
+        try:
+            # Only look the revision up when the cache misses
+            rev = self.getCachedRev(doc_id)
+            if rev is None:
+                rev = self.fetchRev(
+                    doc_id, sgUrl, userName=userName,
+                    password=password, session=session,
+                    is_admin=is_admin
+                )
+            for attempt in range(2):
+                if rev:
+                    json_data['_rev'] = rev
+                else:
+                    json_data.pop('_rev', None)
+                json_data['dateTimeStamp'] = datetime.now().isoformat()
+                response = self.httpCall(
+                    "PUT", sgUrl, json_data=json_data,
+                    userName=userName, password=password,
+                    session=session, is_admin=is_admin
+                )
+                if response.status != 409 or attempt:
+                    break
+                # A stale cached revision, refetch and retry once
+                rev = self.fetchRev(
+                    doc_id, sgUrl, userName=userName,
+                    password=password, session=session,
+                    is_admin=is_admin
+                )
+            result = response.body
+            status = "success" if result and result.get("ok") else "failed"
+            log.info(
+                f"[{status}] - [PUT] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"PUT result for [{doc_id}] - "
+                f"{self.logBody(result)}"
+            )
+            if result and result.get("rev"):
+                self.setCachedRev(doc_id, result["rev"])
+                self.noteOutcome(rev=result["rev"])
+        except requests.RequestException as e:
+            log.error(
+                f"[failed] - [PUT] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"Error in HTTP PUT for [{doc_id}] - {str(e)}"
+            )
+            log.info(
+                f"[failed] - [PUT] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"PUT result for [{doc_id}] - null"
+            )
+        return status
+
+    # Deletes the document as the user (or admin), reusing the cached
+    # revision when there is one
+    def runDelete(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        userName = user["userName"]
+        password = user["password"]
+        session = user["sgSession"]
+        sgUrl = self.docUrl(doc_id, is_admin)
+        status = "failed"
+        try:
+            # Only look the revision up when the cache misses
+            rev = self.getCachedRev(doc_id)
+            if rev is None:
+                rev = self.fetchRev(
+                    doc_id, sgUrl, userName=userName,
+                    password=password, session=session,
+                    is_admin=is_admin
+                )
+            if rev:
+                for attempt in range(2):
+                    delete_url = f"{sgUrl}?rev={rev}"
+                    response = self.httpCall(
+                        "DELETE", delete_url,
+                        userName=userName, password=password,
+                        session=session, is_admin=is_admin
+                    )
+                    if response.status != 409 or attempt:
+                        break
+                    # A stale cached revision, refetch and retry
+                    rev = self.fetchRev(
+                        doc_id, sgUrl, userName=userName,
+                        password=password, session=session,
+                        is_admin=is_admin
+                    )
+                    if not rev:
+                        break
+                result = response.body
+                status = "success" if result and result.get("ok") else "failed"
+                log.info(
+                    f"[{status}] - [DELETE] - "
+                    f"[{'Admin' if is_admin else userName}] - "
+                    f"DELETE result for [{doc_id}] - "
+                    f"{self.logBody(result)}"
                 )
+                if status == "success":
+                    # The tombstone revision, if SG returned one
+                    self.setCachedRev(doc_id, result.get("rev"))
             else:
-                auth = (HTTPBasicAuth(userName, password)
-                        if userName and password else None)
+                log.warning(
+                    f"[failed] - [DELETE] - "
+                    f"[{'Admin' if is_admin else userName}] - "
+                    f"Unable to delete [{doc_id}] - "
+                    f"Document not found"
+                    "or no revision available"
+                )
+        except requests.RequestException as e:
+            log.error(
+                f"[failed] - [DELETE] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"Error in HTTP DELETE for "
+                f"[{doc_id}] - {str(e)}"
+            )
+            log.info(
+                f"[failed] - [DELETE] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"DELETE result for [{doc_id}] - null"
+            )
+        return status
 
-            response = requests.request(
-                method,
-                url,
-                json=json_data,
-                headers=headers,
-                auth=auth
+    # Reads the changes feed as the user (or admin), optionally filtered
+    # by the channel(s) given as the operation parameter
+    def runChanges(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        userName = user["userName"]
+        password = user["password"]
+        session = user["sgSession"]
+        status = "failed"
+        try:
+            channels = params if params else None
+            key = self.changesKey(userName, is_admin, channels)
+            sgUrl = self.changesUrl(
+                is_admin, channels, self.lastSeq.get(key), self.changesFeed
             )
+            # Only rows about this document are kept for the log line
+            doc_rows = []
 
-            # Handle the case where response might
-            # be a dictionary (for testing purposes)
-            if isinstance(response, dict):
-                return response
+            def onRow(row):
+                self.noteChangesRow(key, row)
+                if row.get("id") == doc_id:
+                    doc_rows.append(row)
+            response = self.readChanges(
+                sgUrl, onRow,
+                userName=userName, password=password,
+                session=session, is_admin=is_admin
+            )
+            result = response.body
+            status = "success" if result else "failed"
+            result_count = result["rows"] if result else 0
+            if result and result["last_seq"] is not None:
+                self.setLastSeq(key, result["last_seq"])
+            # For CHANGES "allowed" means the document is visible in the
+            # feed. The read only returns what changed since the shared
+            # cursor, so an earlier read (for another document, or on
+            # another thread) may have been the one that returned it
+            self.noteOutcome(allowed=self.seenInChanges(key, doc_id))
+            body = self.logBody(
+                {"results": doc_rows, "last_seq": result["last_seq"]}
+                if result else None
+            )
+            filter_flag = "true" if channels else "false"
+            log.info(
+                f"[{status}] - [CHANGES] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"Changes feed result for [{doc_id}], "
+                f"channelFilter:{filter_flag}, "
+                f"channels:{channels if channels else 'None'}, "
+                f"rows: {result_count} - {body}"
+            )
+        except requests.RequestException as e:
+            log.error(
+                f"[failed] - [CHANGES] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"Error in HTTP CHANGES for [{doc_id}]"
+                f"- {str(e)}"
+            )
+            log.info(
+                f"[failed] - [CHANGES] - "
+                f"[{'Admin' if is_admin else userName}] - "
+                f"Changes feed result for [{doc_id}], "
+                "channelFilter:false, channels:None,"
+                "rows: 0 - null"
+            )
+        return status
 
-            response.raise_for_status()
-            return response.json() if response.text else None
+    # Purges the document (admin only)
+    def runPurge(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        status = "failed"
+        try:
+            result = self.postPurge([doc_id])
+            if result and result.get("purged"):
+                self.setCachedRev(doc_id, None)
+            status = "success" if result and result.get("purged") else "failed"
+            result_str = (
+                self.logBody(result) if isinstance(result, dict)
+                else str(result)
+            )
+            log.info(
+                f"[{status}] - [PURGE] - [Admin] - "
+                f"Purge result for "
+                f"[{doc_id}] - {result_str}"
+            )
         except requests.RequestException as e:
-            if self.debug:
-                self.logger.error(f"Error in HTTP {method}: {e}")
-        return None
+            log.error(
+                f"[failed] - [PURGE] - [Admin] - "
+                f"Error in HTTP PURGE for "
+                f"[{doc_id}] - {str(e)}"
+            )
+            log.info(
+                f"[failed] - [PURGE] - [Admin] - "
+                f"Purge result for [{doc_id}] - null"
+            )
+        return status
 
-    # Retrieves the changes feed from Sync Gateway
-    def getChangesFeed(
-        self, userName="",
-        password="", session="",
-        is_admin=False, channels=None
-    ):
-        sgUrl = f"{self.sgHost}:{self.sgPort}/{self.sgDb}/_changes"
-        if channels:
-            sgUrl += f"?filter=sync_gateway/bychannel&channels={channels}"
-        return self.httpRequest(
-            "GET", sgUrl,
-            userName=userName, password=password,
-            session=session, is_admin=is_admin
-        )
+    # Reads the document with its _sync metadata (admin only)
+    def runGetRaw(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        status = "failed"
+        try:
+            result = self.httpRequest(
+                "GET",
+                self.rawUrl(doc_id),
+                is_admin=True
+            )
+            status = "success" if result else "failed"
+            if result:
+                self.noteOutcome(**rawOutcome(result))
+            log.info(
+                f"[{status}] - [GET_RAW] - [Admin] - "
+                f"GET_RAW result for [{doc_id}] - "
+                f"{self.logBody(result or None)}"
+            )
+        except requests.RequestException as e:
+            log.error(
+                f"[failed] - [GET_RAW] - [Admin] - "
+                f"Error in HTTP GET_RAW for "
+                f"[{doc_id}] - {str(e)}"
+            )
+            log.info(
+                f"[failed] - [GET_RAW] - [Admin] - "
+                f"GET_RAW result for [{doc_id}] - null"
+            )
+        return status
 
-    # Performs a purge operation on the specified document IDs
-    def postPurge(self, docIds):
-        sgUrl = f"{self.sgHost}:{self.sgAdminPort}/{self.sgDb}/_purge"
-        purgeData = {docId: ["*"] for docId in docIds}
-        result = self.httpRequest(
-            "POST", sgUrl,
-            json_data=purgeData, is_admin=True
-        )
-        return result.json() if hasattr(result, 'json') else result
+    # Propagation probe: writes the document as admin, then long-polls the
+    # user's (or admin's) _changes feed, filtered by the channel(s) given
+    # as the operation parameter, until the written revision shows up or
+    # probeTimeoutMs runs out. The delay from the write's response to the
+    # row arriving goes into the propagation report per user and channel
+    def runProbe(self, json_data, user, is_admin, params, log):
+        doc_id = json_data.get("_id")
+        userName = user["userName"]
+        password = user["password"]
+        session = user["sgSession"]
+        who = "Admin" if is_admin else userName
+        channels = params if params else None
+        doc_channels = json_data.get("channels") or []
+        if isinstance(doc_channels, str):
+            doc_channels = [doc_channels]
+        channel = channels or ",".join(sorted(doc_channels))
+        key = self.changesKey(userName, is_admin, channels)
+        status = "failed"
+        try:
+            # Catch the feed up first, so the wait is only for the write
+            response = self.readChanges(
+                self.changesUrl(is_admin, channels, self.lastSeq.get(key)),
+                lambda row: self.noteChangesRow(key, row),
+                userName=userName, password=password,
+                session=session, is_admin=is_admin
+            )
+            if response.body is None:
+                raise requests.RequestException(
+                    f"_changes returned {response.status}")
+            since = response.body["last_seq"]
+            if self.runPut(json_data, user, True, "", NullLog()) \
+                    != "success":
+                raise requests.RequestException("the probe write failed")
+            rev = self.getCachedRev(doc_id)
+            generation = revGeneration(rev)
+            if generation is None:
+                raise requests.RequestException(
+                    f"the probe write returned rev {rev}")
+            written = time.perf_counter()
+            deadline = written + self.probeTimeoutMs / 1000
+            seen = []
+
+            # A row with a malformed rev is skipped, not taken for the end
+            # of the feed
+            def onRow(row):
+                self.noteChangesRow(key, row)
+                if seen or row.get("id") != doc_id:
+                    return
+                generations = [revGeneration(change.get("rev"))
+                               for change in row.get("changes") or []
+                               if isinstance(change, dict)]
+                if any(generation <= found for found in generations
+                       if found is not None):
+                    seen.append(time.perf_counter())
+
+            while not seen and time.perf_counter() < deadline:
+                response = self.readChanges(
+                    self.changesUrl(is_admin, channels, since, "longpoll"),
+                    onRow, userName=userName, password=password,
+                    session=session, is_admin=is_admin
+                )
+                if response.body is None:
+                    break
+                if response.body["last_seq"] is not None:
+                    since = response.body["last_seq"]
+            self.setLastSeq(key, since)
+            delay = (seen[0] if seen else time.perf_counter()) - written
+            status = "success" if seen else "failed"
+            self.propagation.record((who, channel), delay, bool(seen))
+            self.noteOutcome(allowed=bool(seen), rev=rev)
+            log.info(
+                f"[{status}] - [PROBE] - [{who}] - "
+                f"Propagation of [{doc_id}] rev {rev} - "
+                + (f"visible after {delay * 1000:.3f}ms" if seen else
+                   f"not visible after {delay * 1000:.3f}ms")
+                + f", channels:{channel or 'None'}"
+            )
+        except requests.RequestException as e:
+            log.error(
+                f"[failed] - [PROBE] - [{who}] - "
+                f"Error in propagation probe for [{doc_id}] - {str(e)}"
+            )
+        return status
+
+
+OPERATIONS.update({
+    "GET": Work.runGet,
+    "PUT": Work.runPut,
+    "DELETE": Work.runDelete,
+    "CHANGES": Work.runChanges,
+    "PURGE": Work.runPurge,
+    "GET_RAW": Work.runGetRaw,
+    "PROBE": Work.runProbe
+})
+
+
+COMMANDS = ("run", "loadtest", "offline", "generate", "teardown",
+            "compare", "contention", "analyze", "replay", "worker")
+
+# Commands a distributed run shards over its workers
+SHARDED_COMMANDS = ("run", "offline", "loadtest")
+
+
+# Whether a listen host only takes connections from this machine
+def isLoopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+# Proof that a worker knows distributed.authKey, for one challenge
+def shardAuth(key, challenge):
+    return hmac.new(key.encode(), challenge.encode(), "sha256").hexdigest()
+
+
+# Coordinator and workers talk in JSON objects, one per line
+def writeMessage(stream, message):
+    stream.write(json.dumps(message).encode() + b"\n")
+    stream.flush()
+
+
+def readMessage(stream):
+    line = stream.readline()
+    return json.loads(line) if line.strip() else None
+
+
+# Runs one shard of a distributed run and returns its shardResult(). The
+# entry point of local worker processes and of the worker command
+def runShard(config, shard, command="run", resume=False):
+    work = Work(config, resume=resume, shard=tuple(shard))
+    try:
+        if command == "offline" and not work.offline:
+            work.enableOffline()
+        if command == "loadtest":
+            work.runLoadTest()
+        else:
+            work.openJsonFolder()
+        return work.shardResult()
+    finally:
+        work.closeCheckpoint()
+        work.closeSessions()
+        work.closeLogFile()
+
+
+# The worker command: connects to the coordinator at
+# distributed.coordinator (retrying until workerWaitSeconds have passed,
+# so workers can be started first), runs the shard it is given with the
+# coordinator's configuration, and sends the result back. Paths in that
+# configuration (jsonFolder, plugins, ...) are read on this machine
+def runWorker(config_file):
+    settings = loadConfig(config_file).get("distributed", {})
+    host, port = settings.get("coordinator", "127.0.0.1:7788").rsplit(":", 1)
+    deadline = time.monotonic() + settings.get("workerWaitSeconds", 300)
+    while True:
+        try:
+            conn = socket.create_connection((host, int(port)))
+            break
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise Exception(f"No coordinator at {host}:{port}.")
+            time.sleep(1)
+    with conn, conn.makefile("rwb") as stream:
+        challenge = (readMessage(stream) or {}).get("challenge", "")
+        writeMessage(stream, {
+            "auth": shardAuth(settings.get("authKey", ""), challenge)
+        })
+        task = readMessage(stream)
+        if task is None:
+            raise Exception(f"The coordinator at {host}:{port} refused "
+                            f"this worker, check authKey.")
+        try:
+            result = runShard(task["config"], task["shard"],
+                              task["command"], task["resume"])
+        except Exception as e:
+            writeMessage(stream, {"error": f"{type(e).__name__}: {e}"})
+            raise
+        writeMessage(stream, {"result": result})
+    return 0
+
+
+# Command line entry point. The command is optional and defaults to
+# "run", so "python3 sg_sync_function_tester.py config.json" still works
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    command = argv.pop(0) if argv and argv[0] in COMMANDS else "run"
+    parser = argparse.ArgumentParser(
+        prog="sg_sync_function_tester.py",
+        usage="python3 sg_sync_function_tester.py "
+              "[run|loadtest|offline|generate|teardown|compare|contention|"
+              "analyze|replay|worker] "
+              "<config_file> [--resume]"
+    )
+    parser.add_argument("config_file")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="skip the steps recorded in checkpointFile by an earlier run"
+    )
+    args = parser.parse_args(argv)
+    if command == "worker":
+        return runWorker(args.config_file)
+
+    workAll = Work(args.config_file, resume=args.resume)
+    try:
+        if command == "offline" and not workAll.offline:
+            workAll.enableOffline()
+        if command in SHARDED_COMMANDS and workAll.shardCount():
+            workAll.runDistributed(command)
+            if command != "loadtest" and not workAll.expectationsPassed():
+                return 1
+        elif command == "loadtest":
+            workAll.runLoadTest()
+        elif command == "generate":
+            workAll.runGenerate()
+        elif command == "teardown":
+            workAll.runTeardown()
+        elif command == "compare":
+            # Like diff(1), any difference exits with 1
+            return 0 if workAll.runCompare()["identical"] else 1
+        elif command == "contention":
+            workAll.runContention()
+        elif command == "analyze":
+            workAll.runAnalyze()
+        elif command == "replay":
+            workAll.runReplay()
+        else:
+            # "run" and "offline" go through the same pipeline
+            workAll.openJsonFolder()
+            # A mismatch with the expectations fails the run, e.g. in CI
+            if not workAll.expectationsPassed():
+                return 1
+    finally:
+        workAll.closeCheckpoint()
+        workAll.closeSessions()
+        workAll.closeLogFile()
+    return 0
 
-    def openJsonFolder(self):
-        json_folder = self.jsonFolder
-        processed_docs = []
-        for filename in os.listdir(json_folder):
-            if filename.endswith(".json"):
-                with open(os.path.join(json_folder, filename), "r") as f:
-                    json_data = json.load(f)
-                doc_id = json_data.get("_id")
-                if doc_id:
-                    processed_docs.append(doc_id)
-                    rev = None
-                    for operation in self.operations:
-                        if operation.startswith("SLEEP"):
-                            sleep_time = 1  # Default sleep time
-                            if ":" in operation:
-                                try:
-                                    sleep_time = int(operation.split(":")[1])
-                                except ValueError:
-                                    self.logger.warning(
-                                        f"Invalid sleep time format:"
-                                        f"{operation}. Using default 1 second."
-                                    )
-                            self.logger.info(
-                                f"[success] - [SLEEP] - Sleeping for"
-                                f"{sleep_time} seconds"
-                            )
-                            time.sleep(sleep_time)
-                            continue
-
-                        is_admin = "_ADMIN" in operation
-                        if is_admin:
-                            op, *rest = operation.split("_ADMIN")
-                            params = (rest[0].split(":", 1)[1]
-                                      if rest and ":" in rest[0] else "")
-                        else:
-                            op, *rest = operation.split(":")
-                            params = rest[0] if rest else ""
-
-                        for user in self.sgTestUsers:
-                            sgUrl = (
-                                f"{self.sgHost}:"
-                                f"{self.sgPort if not is_admin else self.sgAdminPort}/"
-                                f"{self.constructDbUrl()}/{doc_id}"
-                            )
-                            userName = user["userName"]
-                            password = user["password"]
-                            session = user["sgSession"]
-
-                            if op == "GET":
-                                try:
-                                    result = self.httpRequest(
-                                        "GET", sgUrl, userName=userName,
-                                        password=password, session=session,
-                                        is_admin=is_admin
-                                    )
-                                    status = "success" if result else "failed"
-                                    self.logger.info(
-                                        f"[{status}] - [GET] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"GET result for [{doc_id}] - "
-                                        f"{json.dumps(result) if result else 'null'}"
-                                    )
-                                    if result:
-                                        rev = result.get('_rev')
-                                except requests.RequestException:
-                                    self.logger.info(
-                                        f"[failed] - [GET] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"GET result for [{doc_id}] - null"
-                                    )
-
-                            elif op == "PUT":
-                                try:
-                                    # Get the current document first
-                                    current_doc = self.httpRequest(
-                                        "GET", sgUrl, userName=userName,
-                                        password=password, session=session,
-                                        is_admin=is_admin
-                                    )
-                                    if current_doc and '_rev' in current_doc:
-                                        # Update the revision if the document exists
-                                        json_data['_rev'] = current_doc['_rev']
-
-                                    json_data['dateTimeStamp'] = datetime.now().isoformat()
-                                    result = self.httpRequest(
-                                        "PUT", sgUrl, json_data=json_data,
-                                        userName=userName, password=password,
-                                        session=session, is_admin=is_admin
-                                    )
-                                    status = "success" if result and result.get("ok") else "failed"
-                                    self.logger.info(
-                                        f"[{status}] - [PUT] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"PUT result for [{doc_id}] - "
-                                        f"{json.dumps(result)}"
-                                    )
-                                    if result and result.get("rev"):
-                                        rev = result["rev"]
-                                except requests.RequestException as e:
-                                    self.logger.error(
-                                        f"[failed] - [PUT] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"Error in HTTP PUT for [{doc_id}] - {str(e)}"
-                                    )
-                                    self.logger.info(
-                                        f"[failed] - [PUT] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"PUT result for [{doc_id}] - null"
-                                    )
-
-                            elif op == "DELETE":
-                                try:
-                                    # Get the current document first
-                                    current_doc = self.httpRequest(
-                                        "GET", sgUrl, userName=userName,
-                                        password=password, session=session,
-                                        is_admin=is_admin
-                                    )
-                                    if current_doc and '_rev' in current_doc:
-                                        rev = current_doc['_rev']
-                                        delete_url = (
-                                            f"{self.sgHost}:"
-                                            f"{self.sgPort if not is_admin else self.sgAdminPort}/"
-                                            f"{self.constructDbUrl()}/{doc_id}?rev={rev}"
-                                        )
-                                        result = self.httpRequest(
-                                            "DELETE", delete_url,
-                                            userName=userName, password=password,
-                                            session=session, is_admin=is_admin
-                                        )
-                                        status = "success" if result and result.get("ok") else "failed"
-                                        self.logger.info(
-                                            f"[{status}] - [DELETE] - "
-                                            f"[{'Admin' if is_admin else userName}] - "
-                                            f"DELETE result for [{doc_id}] - "
-                                            f"{json.dumps(result)}"
-                                        )
-                                    else:
-                                        self.logger.warning(
-                                            f"[failed] - [DELETE] - "
-                                            f"[{'Admin' if is_admin else userName}] - "
-                                            f"Unable to delete [{doc_id}] - "
-                                            f"Document not found"
-                                            "or no revision available"
-                                        )
-                                except requests.RequestException as e:
-                                    self.logger.error(
-                                        f"[failed] - [DELETE] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"Error in HTTP DELETE for "
-                                        f"[{doc_id}] - {str(e)}"
-                                    )
-                                    self.logger.info(
-                                        f"[failed] - [DELETE] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"DELETE result for [{doc_id}] - null"
-                                    )
-
-                            elif op == "CHANGES":
-                                try:
-                                    channels = params if params else None
-                                    sgUrl = (
-                                        f"{self.sgHost}:"
-                                        f"{self.sgPort if not is_admin else self.sgAdminPort}/"
-                                        f"{self.constructDbUrl()}/_changes"
-                                    )
-                                    if channels:
-                                        sgUrl += (
-                                            f"?filter=sync_gateway/bychannel"
-                                            f"&channels={channels}"
-                                        )
-                                    result = self.httpRequest(
-                                        "GET", sgUrl, userName=userName,
-                                        password=password, session=session,
-                                        is_admin=is_admin
-                                    )
-                                    status = "success" if result else "failed"
-                                    result_count = len(result.get("results", [])) if result else 0
-                                    filter_flag = "true" if channels else "false"
-                                    self.logger.info(
-                                        f"[{status}] - [CHANGES] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"Changes feed result for [{doc_id}], "
-                                        f"channelFilter:{filter_flag}, "
-                                        f"channels:{channels if channels else 'None'}, "
-                                        f"rows: {result_count} - "
-                                        f"{json.dumps(result)}"
-                                    )
-                                except requests.RequestException as e:
-                                    self.logger.error(
-                                        f"[failed] - [CHANGES] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"Error in HTTP CHANGES for [{doc_id}]"
-                                        f"- {str(e)}"
-                                    )
-                                    self.logger.info(
-                                        f"[failed] - [CHANGES] - "
-                                        f"[{'Admin' if is_admin else userName}] - "
-                                        f"Changes feed result for [{doc_id}], "
-                                        "channelFilter:false, channels:None,"
-                                        "rows: 0 - null"
-                                    )
-
-                            elif op == "PURGE":
-                                try:
-                                    result = self.postPurge([doc_id])
-                                    status = "success" if result and result.get("purged") else "failed"
-                                    result_str = (
-                                        json.dumps(result) if isinstance(result, dict)
-                                        else str(result)
-                                    )
-                                    self.logger.info(
-                                        f"[{status}] - [PURGE] - [Admin] - "
-                                        f"Purge result for "
-                                        f"[{doc_id}] - {result_str}"
-                                    )
-                                except requests.RequestException as e:
-                                    self.logger.error(
-                                        f"[failed] - [PURGE] - [Admin] - "
-                                        f"Error in HTTP PURGE for "
-                                        f"[{doc_id}] - {str(e)}"
-                                    )
-                                    self.logger.info(
-                                        f"[failed] - [PURGE] - [Admin] - "
-                                        f"Purge result for [{doc_id}] - null"
-                                    )
-
-                            elif op == "GET_RAW":
-                                try:
-                                    raw_url = (
-                                        f"{self.sgHost}:{self.sgAdminPort}/"
-                                        f"{self.constructDbUrl()}/_raw/{doc_id}"
-                                    )
-                                    result = self.httpRequest(
-                                        "GET",
-                                        raw_url,
-                                        is_admin=True
-                                    )
-                                    status = "success" if result else "failed"
-                                    self.logger.info(
-                                        f"[{status}] - [GET_RAW] - [Admin] - "
-                                        f"GET_RAW result for [{doc_id}] - "
-                                        f"{json.dumps(result) if result else 'null'}"
-                                    )
-                                except requests.RequestException as e:
-                                    self.logger.error(
-                                        f"[failed] - [GET_RAW] - [Admin] - "
-                                        f"Error in HTTP GET_RAW for "
-                                        f"[{doc_id}] - {str(e)}"
-                                    )
-                                    self.logger.info(
-                                        f"[failed] - [GET_RAW] - [Admin] - "
-                                        f"GET_RAW result for [{doc_id}] - null"
-                                    )
 
+# Plugins import this module by name; when it runs as a script (or as the
+# main module of a worker process) let them find this instance, and the
+# operations registry in it, instead of loading a second copy
+sys.modules.setdefault("sg_sync_function_tester", sys.modules[__name__])
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python3 sg_sync_function_tester.py <config_file>")
-        sys.exit(1)
-
-    config_file = sys.argv[1]
-    workAll = Work(config_file)
-    workAll.openJsonFolder()
-    workAll.closeLogFile()
+    sys.exit(main())
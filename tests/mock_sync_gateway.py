@@ -0,0 +1,268 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# A local stand-in for Sync Gateway, for integration tests and benchmarks
+# of the tester itself. It serves a public and an admin port backed by
+# one in-memory store, and implements what the tester calls: document
+# GET/PUT/DELETE with revision checks, _changes (normal and longpoll
+# feeds, since and channel filter), _raw (with a linear revision
+# history), _purge, _bulk_docs, _all_docs, _session, _user and _role.
+# There is no sync function: a document is in the channels listed in its
+# "channels" field and every user can read and write it.
+# latency adds a fixed delay (seconds) to every response, and with
+# throttleEvery set every n-th request gets a 503 with "Retry-After: 0"
+
+
+class MockSyncGateway():
+
+    def __init__(self, latency=0.0, throttleEvery=0):
+        self.latency = latency
+        self.throttleEvery = throttleEvery
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.keyspaces = {}
+        self.seq = 0
+        self.requests = 0
+        self.servers = []
+        self.threads = []
+
+    # Starts both ports on 127.0.0.1 and returns self, for use as a
+    # context manager
+    def start(self):
+        for admin in (False, True):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler(admin))
+            server.daemon_threads = True
+            thread = threading.Thread(target=server.serve_forever,
+                                      daemon=True)
+            thread.start()
+            self.servers.append(server)
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def host(self):
+        return "http://127.0.0.1"
+
+    @property
+    def port(self):
+        return str(self.servers[0].server_address[1])
+
+    @property
+    def adminPort(self):
+        return str(self.servers[1].server_address[1])
+
+    # Config keys pointing the tester at this gateway
+    def config(self):
+        return {"sgHost": self.host, "sgPort": self.port,
+                "sgAdminPort": self.adminPort}
+
+    def handler(self, admin):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in one write, without Nagle's
+            # delay, or every keep-alive request waits out a delayed ACK
+            disable_nagle_algorithm = True
+            wbufsize = 65536
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body, headers=None):
+                if gateway.latency:
+                    time.sleep(gateway.latency)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+                self.wfile.flush()
+
+            def body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length)) if length else {}
+
+            def route(self, method):
+                body = self.body() if method in ("PUT", "POST") else None
+                with gateway.lock:
+                    gateway.requests += 1
+                    throttle = gateway.throttleEvery and \
+                        gateway.requests % gateway.throttleEvery == 0
+                    gateway.throttled += bool(throttle)
+                if throttle:
+                    self.respond(503, {"error": "Service Unavailable"},
+                                 {"Retry-After": "0"})
+                    return
+                url = urlsplit(self.path)
+                keyspace, _, rest = url.path.strip("/").partition("/")
+                query = {key: values[0]
+                         for key, values in parse_qs(url.query).items()}
+                status, result, headers = gateway.dispatch(
+                    method, keyspace, rest, query, body, admin
+                )
+                self.respond(status, result, headers)
+
+            def do_GET(self):
+                self.route("GET")
+
+            def do_PUT(self):
+                self.route("PUT")
+
+            def do_POST(self):
+                self.route("POST")
+
+            def do_DELETE(self):
+                self.route("DELETE")
+
+        return Handler
+
+    # Returns (status, body, headers) for one request
+    def dispatch(self, method, keyspace, rest, query, body, admin):
+        docs = self.keyspaces.setdefault(keyspace, {})
+        name, _, sub = rest.partition("/")
+        if name == "_session" and method == "POST":
+            user = body.get("name", "")
+            session_id = hashlib.sha1(user.encode()).hexdigest()
+            if admin:
+                return 200, {"session_id": session_id,
+                             "cookie_name": "SyncGatewaySession"}, None
+            return 200, {"ok": True, "userCtx": {"name": user}}, {
+                "Set-Cookie": f"SyncGatewaySession={session_id}; Path=/"}
+        if name in ("_user", "_role") and admin:
+            return (201 if method == "PUT" else 200), {}, None
+        with self.lock:
+            if name == "_changes" and method == "GET":
+                if query.get("feed") == "longpoll":
+                    since = int(query.get("since") or 0)
+                    self.changed.wait_for(
+                        lambda: self.seq > since,
+                        int(query.get("timeout") or 0) / 1000
+                    )
+                return 200, self.changes(docs, query), None
+            if name == "_raw" and method == "GET" and admin:
+                return self.raw(docs, sub)
+            if name == "_purge" and method == "POST" and admin:
+                purged = {doc_id: ["*"] for doc_id in body
+                          if docs.pop(doc_id, None) is not None}
+                return 200, {"purged": purged}, None
+            if name == "_bulk_docs" and method == "POST" and admin:
+                rows = []
+                for doc in body.get("docs", []):
+                    status, result = self.write(docs, doc["_id"], doc)
+                    rows.append(result if status == 201 else {
+                        "id": doc["_id"], "error": "conflict",
+                        "status": status})
+                return 201, rows, None
+            if name == "_all_docs" and method == "POST" and admin:
+                return 200, self.allDocs(docs, body.get("keys", []),
+                                         query.get("include_docs")), None
+            if name.startswith("_"):
+                return 404, {"error": "not_found"}, None
+            if method == "GET":
+                stored = docs.get(name)
+                if not stored or stored["deleted"]:
+                    return 404, {"error": "not_found"}, None
+                return 200, self.document(name, stored), None
+            if method == "PUT":
+                status, result = self.write(docs, name, body)
+                return status, result, None
+            if method == "DELETE":
+                status, result = self.write(
+                    docs, name, {"_rev": query.get("rev"), "_deleted": True}
+                )
+                return (200 if status == 201 else status), result, None
+        return 405, {"error": "method_not_allowed"}, None
+
+    # Stores a new revision when body["_rev"] is the current one (or the
+    # document does not exist, or is a tombstone). Returns (status, body)
+    def write(self, docs, doc_id, body):
+        stored = docs.get(doc_id)
+        current = stored["rev"] if stored else None
+        if stored and not stored["deleted"] and body.get("_rev") != current:
+            return 409, {"error": "conflict", "reason": "Document exists"}
+        if stored and stored["deleted"] and body.get("_deleted"):
+            return 404, {"error": "not_found", "reason": "deleted"}
+        generation = int(current.split("-")[0]) + 1 if current else 1
+        content = {k: v for k, v in body.items() if not k.startswith("_")}
+        digest = hashlib.md5(
+            json.dumps(content, sort_keys=True).encode()).hexdigest()
+        rev = f"{generation}-{digest}"
+        self.seq += 1
+        self.changed.notify_all()
+        docs[doc_id] = {"rev": rev, "seq": self.seq, "body": content,
+                        "deleted": bool(body.get("_deleted")),
+                        "history": (stored["history"] if stored else [])
+                        + [rev]}
+        return 201, {"id": doc_id, "ok": True, "rev": rev}
+
+    def document(self, doc_id, stored):
+        return dict(stored["body"], _id=doc_id, _rev=stored["rev"])
+
+    def changes(self, docs, query):
+        since = int(query.get("since") or 0)
+        channels = query.get("channels")
+        wanted = set(channels.split(",")) if channels else None
+        results = []
+        for doc_id, stored in sorted(docs.items(),
+                                     key=lambda item: item[1]["seq"]):
+            if stored["seq"] <= since:
+                continue
+            if wanted is not None and \
+                    not wanted & set(stored["body"].get("channels") or []):
+                continue
+            row = {"seq": stored["seq"], "id": doc_id,
+                   "changes": [{"rev": stored["rev"]}]}
+            if stored["deleted"]:
+                row["deleted"] = True
+            results.append(row)
+        return {"results": results, "last_seq": str(self.seq)}
+
+    def raw(self, docs, doc_id):
+        stored = docs.get(doc_id)
+        if not stored:
+            return 404, {"error": "not_found"}, None
+        return 200, dict(stored["body"], _sync={
+            "rev": {"rev": stored["rev"]},
+            "sequence": stored["seq"],
+            # One linear branch, each revision the parent of the next
+            "history": {"revs": stored["history"], "parents": list(
+                range(-1, len(stored["history"]) - 1))},
+            "channels": {channel: None for channel in
+                         stored["body"].get("channels") or []}
+        }), None
+
+    def allDocs(self, docs, keys, include_docs):
+        rows = []
+        for key in keys:
+            stored = docs.get(key)
+            if not stored:
+                rows.append({"key": key, "error": "not_found"})
+                continue
+            row = {"id": key, "key": key, "value": {"rev": stored["rev"]}}
+            if stored["deleted"]:
+                row["value"]["deleted"] = True
+            elif include_docs == "true":
+                row["doc"] = self.document(key, stored)
+            rows.append(row)
+        return {"rows": rows, "total_rows": len(docs)}
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import unittest
+from mock_sync_gateway import MockSyncGateway
+from sg_sync_function_tester import Work
+
+# Throughput and memory of the tester itself, against the local mock Sync
+# Gateway. The corpus sizes, concurrency levels, injected latency and the
+# floors a run must stay above can be set through the environment, e.g.
+#   SG_BENCH_DOCS=1000,10000 SG_BENCH_CONCURRENCY=1,16 \
+#   pytest tests/test_benchmark.py
+# The results are logged at INFO, and with SG_BENCH_OUTPUT set, written
+# there as JSON
+
+
+def envList(name, default):
+    return [int(value) for value in os.environ.get(name, default).split(",")]
+
+
+CORPUS_SIZES = envList("SG_BENCH_DOCS", "50,150")
+CONCURRENCY = envList("SG_BENCH_CONCURRENCY", "1,8")
+LATENCY = float(os.environ.get("SG_BENCH_LATENCY_MS", "0")) / 1000
+MIN_DOCS_PER_SEC = float(os.environ.get("SG_BENCH_MIN_DOCS_PER_SEC", "20"))
+MAX_KB_PER_DOC = float(os.environ.get("SG_BENCH_MAX_KB_PER_DOC", "64"))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gateway = MockSyncGateway(latency=LATENCY).start()
+        cls.folder = tempfile.mkdtemp()
+        cls.runs = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.gateway.stop()
+        shutil.rmtree(cls.folder)
+
+    # Writes a corpus of count documents and a config for it, in a
+    # database of its own so every run starts from an empty store
+    def makeWork(self, count, operations, **config):
+        TestBenchmark.runs += 1
+        corpus = os.path.join(self.folder, f"corpus-{count}.jsonl")
+        if not os.path.exists(corpus):
+            with open(corpus, "w") as f:
+                for n in range(count):
+                    f.write(json.dumps({
+                        "_id": f"{'order' if n % 2 else 'job'}-{n}",
+                        "channels": [f"user-{n % 10}"],
+                        "amount": n
+                    }) + "\n")
+        config_file = os.path.join(self.folder, "config.json")
+        with open(config_file, "w") as f:
+            json.dump(dict(
+                self.gateway.config(),
+                sgDb=f"bench{self.runs}",
+                sgTestUsers=[{"userName": "bob", "password": "12345",
+                              "sgSession": ""}],
+                sgAdminUser="Administrator",
+                sgAdminPassword="password",
+                jsonFolder=corpus,
+                logPathToWriteTo=os.path.join(self.folder, "bench"),
+                logBodies="none",
+                operations=operations,
+                **config
+            ), f)
+        work = Work(config_file)
+        self.addCleanup(work.closeSessions)
+        self.addCleanup(work.closeLogFile)
+        return work
+
+    # Runs one corpus and returns what it took
+    def measure(self, work, count):
+        outcomes = []
+        work.outcomeListeners.append(outcomes.append)
+        requests_before = self.gateway.requests
+        started = time.perf_counter()
+        work.openJsonFolder()
+        elapsed = time.perf_counter() - started
+        requests = self.gateway.requests - requests_before
+        return {
+            "docs": count,
+            "concurrency": work.concurrency,
+            "seconds": round(elapsed, 3),
+            "docsPerSec": round(count / elapsed, 1),
+            "requestsPerSec": round(requests / elapsed, 1),
+            "requests": requests,
+            "failed": sum(outcome.status != "success"
+                          for outcome in outcomes)
+        }
+
+    def test_every_operation_succeeds_against_mock(self):
+        work = self.makeWork(20, ["PUT", "GET", "GET_RAW", "CHANGES",
+                                  "DELETE", "PUT_ADMIN", "PURGE"])
+        result = self.measure(work, 20)
+        self.assertEqual(result["failed"], 0)
+        # The rev cache saves every lookup but the first PUT's
+        self.assertEqual(result["requests"], 20 * 8)
+
+    def test_batch_mode_requests_per_batch(self):
+        work = self.makeWork(20, ["PUT_ADMIN", "GET_ADMIN", "PURGE"],
+                             batchMode=True, batchSize=10)
+        result = self.measure(work, 20)
+        self.assertEqual(result["failed"], 0)
+        # _all_docs + _bulk_docs, _all_docs, _purge per batch
+        self.assertEqual(result["requests"], 2 * 4)
+
+    def test_throughput_and_memory(self):
+        results = []
+        for count in CORPUS_SIZES:
+            for concurrency in CONCURRENCY:
+                work = self.makeWork(count, ["PUT", "GET", "GET_RAW"],
+                                     concurrency=concurrency,
+                                     httpPoolSize=max(10, concurrency))
+                result = self.measure(work, count)
+                self.assertEqual(result["failed"], 0)
+                self.assertGreaterEqual(result["docsPerSec"],
+                                        MIN_DOCS_PER_SEC, result)
+                results.append(result)
+
+            work = self.makeWork(count, ["PUT", "GET", "GET_RAW"])
+            tracemalloc.start()
+            try:
+                work.openJsonFolder()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            results.append({"docs": count, "peakKB": round(peak / 1024, 1)})
+            self.assertLessEqual(peak / 1024 / count, MAX_KB_PER_DOC)
+
+        for result in results:
+            logging.getLogger(__name__).info(json.dumps(result))
+        output = os.environ.get("SG_BENCH_OUTPUT")
+        if output:
+            with open(output, "w") as f:
+                json.dump({"latencyMs": LATENCY * 1000, "results": results},
+                          f, indent=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
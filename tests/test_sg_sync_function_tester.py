@@ -1,9 +1,41 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import glob
+import gzip
+import hashlib
+import io
 import json
 import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import requests
+import tarfile
 from requests.auth import HTTPBasicAuth
-from sg_sync_function_tester import Work
+from mock_sync_gateway import MockSyncGateway
+from sg_sync_function_tester import (
+    OPERATIONS, AdaptiveConcurrency, ChangesReader, FixtureSource, HashRing,
+    HttpResult, JsonCodec, LatencyHistogram, SlowestDocs, TokenBucket, Work,
+    isLoopback, main, orjson, quickjs, readMessage, retryAfterSeconds,
+    shardAuth, syncMetadata, writeMessage
+)
+
+
+# Matches a request body sent as encoded JSON bytes with a dict, which may
+# hold unittest.mock.ANY values
+
+
+class JsonBody():
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def __eq__(self, data):
+        return data is not None and json.loads(data) == self.expected
+
+    def __repr__(self):
+        return f"JsonBody({self.expected!r})"
 
 
 class TestWORK(unittest.TestCase):
@@ -50,7 +82,7 @@ class TestWORK(unittest.TestCase):
         os.rmdir(self.json_folder)
         self.work.closeLogFile()
 
-    @patch('requests.request')
+    @patch('requests.Session.request')
     def test_httpRequest_get(self, mock_request):
         mock_response = MagicMock()
         mock_response.json.return_value = self.sample_doc
@@ -64,12 +96,13 @@ class TestWORK(unittest.TestCase):
         self.assertEqual(result, self.sample_doc)
         mock_request.assert_called_once_with(
             "GET", url,
-            json=None,
+            data=None,
             headers={'Content-Type': 'application/json'},
-            auth=HTTPBasicAuth("bob", "12345")
+            auth=HTTPBasicAuth("bob", "12345"),
+            timeout=(5, 30)
         )
 
-    @patch('requests.request')
+    @patch('requests.Session.request')
     def test_httpRequest_put(self, mock_request):
         mock_response = MagicMock()
         mock_response.json.return_value = {"ok": True, "id": "foo", "rev": "1-a"}
@@ -85,12 +118,13 @@ class TestWORK(unittest.TestCase):
         self.assertEqual(result, {"ok": True, "id": "foo", "rev": "1-a"})
         mock_request.assert_called_once_with(
             "PUT", url,
-            json=self.sample_doc,
+            data=JsonBody(self.sample_doc),
             headers={'Content-Type': 'application/json'},
-            auth=HTTPBasicAuth("bob", "12345")
+            auth=HTTPBasicAuth("bob", "12345"),
+            timeout=(5, 30)
         )
 
-    @patch('requests.request')
+    @patch('requests.Session.request')
     def test_getChangesFeed(self, mock_request):
         changes_feed = {
             "results": [{"seq": 1, "id": "foo", "changes": [{"rev": "1-a"}]}],
@@ -111,11 +145,12 @@ class TestWORK(unittest.TestCase):
                f"_changes?filter=sync_gateway/bychannel&channels=bob")
         mock_request.assert_called_once_with(
             "GET", url,
-            json=None, headers={'Content-Type': 'application/json'},
-            auth=HTTPBasicAuth("bob", "12345")
+            data=None, headers={'Content-Type': 'application/json'},
+            auth=HTTPBasicAuth("bob", "12345"),
+            timeout=(5, 30)
             )
 
-    @patch('requests.request')
+    @patch('requests.Session.request')
     def test_postPurge(self, mock_request):
         purge_response = {"purged": {"foo": ["*"]}}
         mock_response = MagicMock()
@@ -132,12 +167,13 @@ class TestWORK(unittest.TestCase):
         purge_data = {"foo": ["*"]}
         mock_request.assert_called_once_with(
             "POST", url,
-            json=purge_data,
+            data=JsonBody(purge_data),
             headers={'Content-Type': 'application/json'},
-            auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+            auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+            timeout=(5, 30)
         )
 
-    @patch('requests.request')
+    @patch('requests.Session.request')
     def test_openJsonFolder(self, mock_request):
         def side_effect(*args, **kwargs):
             mock_response = MagicMock()
@@ -168,62 +204,1466 @@ class TestWORK(unittest.TestCase):
         expected_calls = [
             unittest.mock.call(
                 "GET", f"{sgDbUrl}/foo",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth("bob", "12345")
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth("bob", "12345"),
+                timeout=(5, 30)
             ),
             unittest.mock.call(
                 "PUT", f"{sgDbUrl}/foo",
-                json={'_id': 'foo', 'channels': ['bob'],
-                      '_rev': '1-a', 'dateTimeStamp': unittest.mock.ANY},
+                data=JsonBody({'_id': 'foo', 'channels': ['bob'],
+                               '_rev': '1-a',
+                               'dateTimeStamp': unittest.mock.ANY}),
                 headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth("bob", "12345")
+                auth=HTTPBasicAuth("bob", "12345"),
+                timeout=(5, 30)
                 ),
             unittest.mock.call(
                 "DELETE", f"{sgDbUrl}/foo?rev=1-a",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth("bob", "12345")
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth("bob", "12345"),
+                timeout=(5, 30)
             ),
             unittest.mock.call(
                 "GET", f"{sgDbUrl}/_changes",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth("bob", "12345")
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth("bob", "12345"),
+                timeout=(5, 30), stream=True
             ),
             unittest.mock.call(
                 "GET", f"{sgAdminUrl}/foo",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+                timeout=(5, 30)
             ),
             unittest.mock.call(
                 "PUT", f"{sgAdminUrl}/foo",
-                json={'_id': 'foo', 'channels': ['bob'], '_rev': '1-a',
-                      'dateTimeStamp': unittest.mock.ANY},
+                data=JsonBody({'_id': 'foo', 'channels': ['bob'],
+                               '_rev': '1-a',
+                               'dateTimeStamp': unittest.mock.ANY}),
                 headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+                timeout=(5, 30)
             ),
             unittest.mock.call(
                 "DELETE", f"{sgAdminUrl}/foo?rev=1-a",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+                timeout=(5, 30)
             ),
             unittest.mock.call(
                 "GET",
                 f"{sgAdminUrl}/_changes?filter=sync_gateway/bychannel&channels=bob",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+                timeout=(5, 30), stream=True
             ),
             unittest.mock.call(
                 "GET", f"{sgAdminUrl}/_raw/foo",
-                json=None, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+                data=None, headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+                timeout=(5, 30)
             ),
             unittest.mock.call(
                 "POST", f"{sgAdminUrl}/_purge",
-                json={"foo": ["*"]}, headers={'Content-Type': 'application/json'},
-                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword)
+                data=JsonBody({"foo": ["*"]}), headers={'Content-Type': 'application/json'},
+                auth=HTTPBasicAuth(self.work.sgAdminUser, self.work.sgAdminPassword),
+                timeout=(5, 30)
             )
         ]
         mock_request.assert_has_calls(expected_calls, any_order=True)
 
+    @patch('requests.Session.request')
+    def test_openJsonFolder_concurrent(self, mock_request):
+        def side_effect(*args, **kwargs):
+            doc_id = args[1].rsplit("/", 1)[1]
+            mock_response = MagicMock()
+            mock_response.json.return_value = {"_id": doc_id, "_rev": "1-a"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        for doc_id in ("bar", "baz", "qux"):
+            with open(os.path.join(self.json_folder, f"{doc_id}.json"),
+                      'w') as f:
+                json.dump({"_id": doc_id, "channels": ["bob"]}, f)
+        self.work.concurrency = 4
+        self.work.operations = ["GET", "SLEEP:1", "GET_ADMIN"]
+
+        started = time.monotonic()
+        with self.assertLogs(level="INFO") as logs:
+            self.work.openJsonFolder()
+        elapsed = time.monotonic() - started
+
+        # SLEEP only blocks its own document's pipeline
+        self.assertLess(elapsed, 2)
+        doc_ids = [doc["_id"] for doc in self.work.iterJsonFolder()]
+        # Three lines per document, then the metrics summary
+        self.assertEqual(len(logs.records), 3 * len(doc_ids) + 1)
+        self.assertIn("[METRICS]", logs.output[-1])
+        for i, doc_id in enumerate(doc_ids):
+            block = logs.output[i * 3:(i + 1) * 3]
+            self.assertIn(f"[GET] - [bob] - GET result for [{doc_id}]",
+                          block[0])
+            self.assertIn("[SLEEP]", block[1])
+            self.assertIn(f"[GET] - [Admin] - GET result for [{doc_id}]",
+                          block[2])
+
+    @patch('requests.Session.request')
+    def test_openJsonFolder_rev_cache_skips_pre_get(self, mock_request):
+        revs = iter(["1-a", "2-b", "3-c"])
+
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            if args[0] == "GET":
+                mock_response.json.return_value = {"_id": "foo",
+                                                   "_rev": "1-a"}
+            else:
+                mock_response.json.return_value = {"ok": True, "id": "foo",
+                                                   "rev": next(revs)}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        self.work.operations = ["PUT", "PUT_ADMIN", "DELETE"]
+        self.work.openJsonFolder()
+
+        methods = [c.args[0] for c in mock_request.call_args_list]
+        # Only the first PUT misses the cache and looks the rev up
+        self.assertEqual(methods, ["GET", "PUT", "PUT", "DELETE"])
+        self.assertEqual(
+            json.loads(mock_request.call_args_list[2].kwargs["data"])["_rev"],
+            "1-a")
+        self.assertTrue(
+            mock_request.call_args_list[3].args[1].endswith("?rev=2-b"))
+        self.assertEqual(self.work.getCachedRev("foo"), "3-c")
+
+    @patch('requests.Session.request')
+    def test_openJsonFolder_rev_cache_refetches_on_conflict(self,
+                                                            mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            if args[0] == "GET":
+                mock_response.json.return_value = {"_id": "foo",
+                                                   "_rev": "5-e"}
+            elif json.loads(kwargs["data"])["_rev"] == "1-a":
+                mock_response.json.return_value = {"error": "conflict"}
+                mock_response.status_code = 409
+                mock_response.raise_for_status.side_effect = (
+                    requests.HTTPError(response=mock_response))
+            else:
+                mock_response.json.return_value = {"ok": True, "id": "foo",
+                                                   "rev": "6-f"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        self.work.setCachedRev("foo", "1-a")
+        self.work.operations = ["PUT"]
+        self.work.openJsonFolder()
+
+        methods = [c.args[0] for c in mock_request.call_args_list]
+        self.assertEqual(methods, ["PUT", "GET", "PUT"])
+        self.assertEqual(self.work.getCachedRev("foo"), "6-f")
+
+    @patch('requests.Session.request')
+    def test_openJsonFolder_batch_mode(self, mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            body = json.loads(kwargs["data"] or "null")
+            if args[1].endswith("/_all_docs"):
+                mock_response.json.return_value = {"rows": [
+                    {"key": key, "error": "not_found"} for key in body["keys"]
+                ]}
+            elif args[1].endswith("/_bulk_docs"):
+                mock_response.json.return_value = [
+                    {"id": doc["_id"], "rev": "1-a"} for doc in body["docs"]
+                ]
+            elif args[1].endswith("/_purge"):
+                mock_response.json.return_value = {
+                    "purged": {doc_id: ["*"] for doc_id in body}
+                }
+            else:
+                mock_response.json.return_value = {"_rev": "1-a"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        for doc_id in ("bar", "baz"):
+            with open(os.path.join(self.json_folder, f"{doc_id}.json"),
+                      'w') as f:
+                json.dump({"_id": doc_id, "channels": ["bob"]}, f)
+        self.work.batchMode = True
+        self.work.batchSize = 2
+        self.work.operations = ["PUT_ADMIN", "GET", "PURGE"]
+
+        with self.assertLogs(level="INFO") as logs:
+            self.work.openJsonFolder()
+
+        endpoints = [c.args[1].rsplit("/", 1)[1]
+                     for c in mock_request.call_args_list]
+        # Two groups: 2 docs then 1 doc, one bulk request per admin step
+        self.assertEqual(endpoints.count("_all_docs"), 2)
+        self.assertEqual(endpoints.count("_bulk_docs"), 2)
+        self.assertEqual(endpoints.count("_purge"), 2)
+        self.assertEqual(len(endpoints), 6 + 3)
+        for doc_id in ("foo", "bar", "baz"):
+            for line in (f"[success] - [PUT] - [Admin] - "
+                         f"PUT result for [{doc_id}]",
+                         f"[success] - [PURGE] - [Admin] - "
+                         f"Purge result for [{doc_id}]"):
+                self.assertEqual(
+                    sum(line in output for output in logs.output), 1)
+
+    @patch('requests.Session.request')
+    def test_bulkWrite_fails_the_group_on_a_non_list_response(
+            self, mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            body = json.loads(kwargs["data"] or "null")
+            if args[1].endswith("/_all_docs"):
+                mock_response.json.return_value = {"rows": [
+                    {"key": key, "error": "not_found"} for key in body["keys"]
+                ]}
+            else:
+                mock_response.json.return_value = {
+                    "error": "Bad Gateway", "reason": "upstream reset"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        with open(os.path.join(self.json_folder, "bar.json"), 'w') as f:
+            json.dump({"_id": "bar", "channels": ["bob"]}, f)
+        self.work.batchMode = True
+        self.work.batchSize = 2
+        self.work.operations = ["PUT_ADMIN"]
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+
+        with self.assertLogs(level="INFO") as logs:
+            self.work.openJsonFolder()
+
+        self.assertEqual({(outcome.doc_id, outcome.status)
+                          for outcome in outcomes},
+                         {("foo", "failed"), ("bar", "failed")})
+        for doc_id in ("foo", "bar"):
+            line = [output for output in logs.output
+                    if f"PUT result for [{doc_id}]" in output]
+            self.assertEqual(len(line), 1)
+            self.assertIn("[failed] - [PUT] - [Admin]", line[0])
+            self.assertIn("upstream reset", line[0])
+        self.assertIsNone(self.work.getCachedRev("foo"))
+
+    @patch('requests.Session.request')
+    def test_bulkDelete_fails_a_doc_that_does_not_exist(self, mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            body = json.loads(kwargs["data"] or "null")
+            mock_response.json.return_value = {"rows": [
+                {"key": key, "error": "not_found"} for key in body["keys"]
+            ]}
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        self.work.batchMode = True
+        self.work.operations = ["DELETE_ADMIN"]
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+
+        with self.assertLogs(level="WARNING"):
+            self.work.openJsonFolder()
+
+        # No tombstone to send, so only the revision lookup went out
+        self.assertEqual([c.args[1].rsplit("/", 1)[1]
+                          for c in mock_request.call_args_list],
+                         ["_all_docs"])
+        self.assertEqual([(outcome.doc_id, outcome.op, outcome.user,
+                           outcome.status) for outcome in outcomes],
+                         [("foo", "DELETE", "Admin", "failed")])
+
+    def test_FixtureSource_streams_jsonl_gzip_and_tar(self):
+        with open(os.path.join(self.json_folder, 'orders.jsonl'), 'w') as f:
+            f.write('{"_id": "order-1"}\n\nnot json\n{"_id": "order-2"}\n')
+        with gzip.open(os.path.join(self.json_folder, 'jobs.ndjson.gz'),
+                       'wt') as f:
+            f.write('{"_id": "job-1"}\n{"no_id": true}\n')
+        with tarfile.open(os.path.join(self.json_folder, 'more.tar.gz'),
+                          'w:gz') as archive:
+            data = json.dumps({"_id": "user-1"}).encode()
+            member = tarfile.TarInfo("docs/user-1.json")
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+
+        with self.assertLogs(level="WARNING") as logs:
+            doc_ids = [doc["_id"] for doc in self.work.iterJsonFolder()]
+
+        self.assertLessEqual(
+            {"foo", "job-1", "order-1", "order-2", "user-1"}, set(doc_ids)
+        )
+        self.assertEqual(len(doc_ids), len(set(doc_ids)))
+        self.assertIn("line 3 of", logs.output[0])
+        jsonl = os.path.join(self.json_folder, 'orders.jsonl')
+        archive = os.path.join(self.json_folder, 'more.tar.gz')
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(
+                [doc["_id"] for doc in FixtureSource([jsonl, archive])],
+                ["order-1", "order-2", "user-1"]
+            )
+
+    def test_LatencyHistogram_percentiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000, ok=ms % 100 != 0)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 1000)
+        self.assertEqual(summary["errors"], 10)
+        self.assertEqual(summary["max_ms"], 1000.0)
+        self.assertAlmostEqual(summary["mean_ms"], 500.5, places=3)
+        for key, exact in (("p50_ms", 500), ("p95_ms", 950),
+                           ("p99_ms", 990)):
+            self.assertAlmostEqual(summary[key], exact, delta=exact * 0.011)
+
+        other = LatencyHistogram()
+        other.record(2.0)
+        histogram.merge(other)
+        self.assertEqual(histogram.count, 1001)
+        self.assertEqual(histogram.max, 2.0)
+
+    def test_TokenBucket_paces_to_rate(self):
+        bucket = TokenBucket(50)
+        started = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        # The first token is free, the next ten take 1/50s each
+        self.assertAlmostEqual(time.monotonic() - started, 0.2, delta=0.1)
+
+    @patch('requests.Session.request')
+    def test_runLoadTest(self, mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            if args[0] == "GET":
+                mock_response.json.return_value = {"_id": "foo",
+                                                   "_rev": "1-a"}
+            else:
+                mock_response.json.return_value = {"ok": True, "rev": "2-b"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        self.work.sgTestUsers.append(
+            {"userName": "alice", "password": "678", "sgSession": ""})
+        self.work.loadTest = {
+            "operations": ["PUT", "SLEEP:5", "GET", "GET_ADMIN"],
+            "durationSeconds": 0.5,
+            "virtualUsers": 2,
+            "targetRate": 40
+        }
+
+        report = self.work.runLoadTest()
+
+        self.assertEqual(set(report["byOperation"]),
+                         {"PUT", "GET", "GET_ADMIN"})
+        self.assertEqual(set(report["byUser"]), {"bob", "alice", "Admin"})
+        # Paced at 40 ops/sec for half a second
+        self.assertGreater(report["operations"], 5)
+        self.assertLessEqual(report["operations"], 25)
+        self.assertEqual(report["byOperation"]["GET"]["errors"], 0)
+        self.assertEqual(
+            report["operations"],
+            sum(s["count"] for s in report["byOperation"].values())
+        )
+
+    @patch('requests.Session.request')
+    def test_openJsonFolder_timing_and_metrics_report(self, mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            mock_response.elapsed = timedelta(milliseconds=4)
+            mock_response.json.return_value = {"_id": "foo", "_rev": "1-a"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        self.work.operations = ["GET", "GET_ADMIN", "PUT"]
+        self.work.metricsReport = True
+        self.work.slowestDocs = SlowestDocs(2)
+        self.work.metricsSlowestDocs = 2
+
+        with self.assertLogs(level="INFO") as logs:
+            self.work.openJsonFolder()
+        base = self.work.logFileName[:-len(".log")]
+        self.addCleanup(os.remove, f"{base}_metrics.json")
+        self.addCleanup(os.remove, f"{base}_metrics.prom")
+
+        put = [r for r in logs.records if "[PUT]" in r.getMessage()][0]
+        # The PUT reuses the cached rev, so it is a single timed request
+        self.assertEqual(put.timing["requests"], 1)
+        self.assertEqual(put.timing["server_ms"], 4.0)
+        self.assertIn("server:4.0ms",
+                      self.work.file_handler.formatter.format(put))
+
+        report = self.work.writeMetricsReport()
+        self.assertEqual(set(report["byOperation"]),
+                         {"GET|user", "GET|admin", "PUT|user"})
+        # Only the per-operation histograms are kept, and the 2 slowest
+        self.assertEqual(set(self.work.metrics.series),
+                         {("GET", "user"), ("GET", "admin"), ("PUT", "user")})
+        self.assertEqual(len(report["slowestDocs"]), 2)
+        self.assertTrue(report["slowestDocs"][0]["labels"].endswith("|foo"))
+        self.assertGreaterEqual(report["slowestDocs"][0]["ms"],
+                                report["slowestDocs"][1]["ms"])
+        with open(f"{base}_metrics.json") as f:
+            self.assertIn("slowestDocs", json.load(f))
+        with open(f"{base}_metrics.prom") as f:
+            prometheus = f.read()
+        self.assertIn(
+            'sg_sync_function_tester_operation_latency_seconds_count'
+            '{operation="GET",role="admin"} 1', prometheus)
+
+    @patch('requests.Session.request')
+    def test_structured_results_and_body_sidecar(self, mock_request):
+        mock_response = MagicMock()
+        mock_response.status_code = 201
+        mock_response.json.return_value = {"ok": True, "_id": "foo",
+                                           "_rev": "1-a", "pad": "x" * 2000}
+        mock_request.return_value = mock_response
+        self.config.update({"resultsLog": True, "logBodies": "sidecar",
+                            "logRotateMB": 0.004, "logBackupCount": 2})
+        with open(self.config_file, 'w') as f:
+            json.dump(self.config, f)
+        self.work.closeLogFile()
+        self.work = Work(self.config_file)
+        self.work.operations = ["GET", "PUT"]
+        base = self.work.logFileName[:-len(".log")]
+        self.addCleanup(lambda: [os.remove(path) for path in
+                                 glob.glob(f"{base}_*") +
+                                 glob.glob(f"{base}.log.*")])
+
+        with self.assertLogs(level="INFO") as logs:
+            for _ in range(10):
+                self.work.openJsonFolder()
+        self.work.closeLogFile()
+
+        self.assertIn("GET result for [foo] - (body #1)", logs.output[0])
+        with open(f"{base}_results.jsonl") as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(len(results), 20)
+        self.assertLessEqual(
+            {"op": "PUT", "user": "bob", "doc": "foo", "status": "success",
+             "http": 201, "allowed": True}.items(), results[1].items())
+        self.assertIn("ms", results[1])
+        # Bodies go to the sidecar, which rotates into gzip'd backups
+        with open(f"{base}_bodies.jsonl") as f:
+            bodies = [json.loads(line) for line in f]
+        self.assertEqual(bodies[-1]["id"], 20)
+        self.assertEqual(bodies[-1]["body"]["_rev"], "1-a")
+        with gzip.open(f"{base}_bodies.jsonl.1.gz", "rt") as f:
+            self.assertEqual(json.loads(f.readline())["body"]["_id"], "foo")
+
+    def test_logBody_truncates(self):
+        self.work.logBodyLimit = 10
+        self.assertEqual(self.work.logBody({"a": "x" * 20}),
+                         '{"a":"xxxx...(28 bytes)')
+        self.assertEqual(self.work.logBody(None), "null")
+        self.work.logBodies = "full"
+        self.assertEqual(self.work.logBody({"a": 1}), '{"a":1}')
+        # The body of the operation's last call is logged as received
+        body = {"a": 1}
+        self.work.opContext.calls = [HttpResult(200, body, raw=b'{"a":  1}')]
+        self.assertEqual(self.work.logBody(body), '{"a":  1}')
+        self.assertEqual(self.work.logBody({"a": 1}), '{"a":1}')
+
+    def test_JsonCodec_encodes_compact_utf8(self):
+        for library in ["json"] + (["orjson"] if orjson else []):
+            codec = JsonCodec(library)
+            data = codec.dumps({"a": [1, "é"]})
+            self.assertEqual(data, '{"a":[1,"é"]}'.encode())
+            self.assertEqual(codec.loads(data), {"a": [1, "é"]})
+        self.assertIn(JsonCodec().name, ("orjson", "ujson", "json"))
+        with self.assertRaises(Exception):
+            JsonCodec("simdjson")
+
+    def test_ChangesReader_decodes_rows_incrementally(self):
+        body = ('{"results":[\n{"seq":1,"id":"_user/bob","changes":[]}\n,'
+                '{"seq":7,"id":"foo","changes":[{"rev":"1-a"}]}\n],\n'
+                '"last_seq":"7"}\n')
+        # Chunks that split rows and keys in the middle
+        chunks = [body[i:i + 5] for i in range(0, len(body), 5)]
+        reader = ChangesReader(iter(chunks))
+        self.assertEqual([row["seq"] for row in reader], [1, 7])
+        self.assertEqual(reader.last_seq, "7")
+
+        continuous = ('{"seq":8,"id":"foo","changes":[{"rev":"2-b"}]}\n\n'
+                      '{"seq":9,"id":"bar","changes":[]}\n{"last_seq":"9"}')
+        reader = ChangesReader(iter([continuous[:30], continuous[30:]]),
+                               continuous=True)
+        self.assertEqual([row["id"] for row in reader], ["foo", "bar"])
+        self.assertEqual(reader.last_seq, "9")
+
+    @patch('requests.Session.request')
+    def test_runChanges_requests_only_new_changes(self, mock_request):
+        feeds = iter([
+            '{"results":[{"seq":3,"id":"foo","changes":[]}],"last_seq":"3"}',
+            '{"results":[],"last_seq":"3"}'
+        ])
+
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            mock_response.iter_content.return_value = [next(feeds).encode()]
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        self.work.operations = ["CHANGES", "CHANGES"]
+
+        with self.assertLogs(level="INFO") as logs:
+            self.work.openJsonFolder()
+
+        urls = [c.args[1] for c in mock_request.call_args_list]
+        self.assertEqual(urls, [
+            f"{self.work.sgHost}:{self.work.sgPort}/sync_gateway/_changes",
+            f"{self.work.sgHost}:{self.work.sgPort}/sync_gateway/"
+            f"_changes?since=3"
+        ])
+        self.assertIn('rows: 1 - {"results":[{"seq":3,"id":"foo"',
+                      logs.output[0])
+        self.assertIn("rows: 0", logs.output[1])
+        self.assertEqual(
+            self.work.changesUrl(channels="bob", since="3",
+                                 feed="longpoll"),
+            f"{self.work.sgHost}:{self.work.sgPort}/sync_gateway/_changes"
+            f"?filter=sync_gateway/bychannel&channels=bob"
+            f"&feed=longpoll&timeout=1000&since=3"
+        )
+
+    @patch('requests.Session.request')
+    def test_expectations_gate_the_run(self, mock_request):
+        def side_effect(*args, **kwargs):
+            mock_response = MagicMock()
+            if args[0] == "PUT":
+                mock_response.json.return_value = {"error": "Forbidden"}
+                mock_response.status_code = 403
+                mock_response.raise_for_status.side_effect = (
+                    requests.HTTPError(response=mock_response))
+            elif "/_raw/" in args[1]:
+                mock_response.json.return_value = {"_sync": {
+                    "rev": "1-a", "channels": {"bob": None, "old": {}}
+                }}
+            else:
+                mock_response.json.return_value = {"_id": "foo",
+                                                   "_rev": "1-a"}
+            mock_response.text = json.dumps(mock_response.json.return_value)
+            return mock_response
+
+        mock_request.side_effect = side_effect
+        expectations_file = 'test_expectations.jsonl'
+        self.addCleanup(os.remove, expectations_file)
+        with open(expectations_file, 'w') as f:
+            for entry in (
+                {"docId": "foo", "user": "bob", "op": "PUT",
+                 "allowed": False},
+                {"docId": "*", "user": "bob", "op": "GET", "allowed": True},
+                {"docId": "foo", "user": "Admin", "op": "GET_RAW",
+                 "channels": ["bob", "old"]},
+                {"docId": "bar", "user": "bob", "op": "GET",
+                 "allowed": True}
+            ):
+                f.write(json.dumps(entry) + "\n")
+        self.config["expectationsFile"] = expectations_file
+        self.config["operations"] = ["PUT", "GET", "GET_RAW"]
+        with open(self.config_file, 'w') as f:
+            json.dump(self.config, f)
+
+        with self.assertLogs(level="INFO") as logs:
+            self.assertEqual(main([self.config_file]), 1)
+
+        report = json.loads(
+            [line for line in logs.output
+             if "[EXPECT] - 3 results checked" in line][0].split(" - ", 3)[3]
+        )
+        self.assertEqual(report["checked"], 3)
+        self.assertEqual(report["mismatches"], 1)
+        self.assertEqual(report["details"][0]["problems"],
+                         ["expected channels ['bob', 'old'], was ['bob']"])
+        self.assertEqual(report["notRunDetails"],
+                         [{"docId": "bar", "user": "bob", "op": "GET"}])
+
+    @unittest.skipUnless(quickjs, "offline mode needs quickjs")
+    @patch('requests.Session.request')
+    def test_offline_runs_sync_function_in_process(self, mock_request):
+        for doc_id in ("order-1", "job-1"):
+            with open(os.path.join(self.json_folder, f"{doc_id}.json"),
+                      'w') as f:
+                json.dump({"_id": doc_id, "channels": ["orders"]}, f)
+        self.work.syncFunctionFile = os.path.join(
+            os.path.dirname(__file__), "..", "example_sync_functions",
+            "3.sync_function_run.js")
+        self.work.enableOffline()
+        self.work.sgTestUsers = [
+            {"userName": "bob", "password": "12345", "sgSession": "",
+             "roles": ["user"], "channels": ["orders"]},
+            {"userName": "eve", "password": "678", "sgSession": ""}
+        ]
+        self.work.operations = ["PUT", "GET", "CHANGES", "GET_RAW",
+                                "SLEEP:60"]
+        outcomes = {}
+        self.work.outcomeListeners.append(
+            lambda o: outcomes.__setitem__((o.doc_id, o.user, o.op), o))
+
+        started = time.monotonic()
+        self.work.openJsonFolder()
+
+        self.assertLess(time.monotonic() - started, 5)
+        mock_request.assert_not_called()
+        # "user" role may write orders but not jobs; eve has no role
+        self.assertTrue(outcomes[("order-1", "bob", "PUT")].allowed)
+        self.assertFalse(outcomes[("job-1", "bob", "PUT")].allowed)
+        self.assertFalse(outcomes[("order-1", "eve", "PUT")].allowed)
+        self.assertFalse(outcomes[("foo", "bob", "PUT")].allowed)
+        # Only bob has access to the "orders" channel
+        self.assertTrue(outcomes[("order-1", "bob", "GET")].allowed)
+        self.assertFalse(outcomes[("order-1", "eve", "GET")].allowed)
+        self.assertTrue(outcomes[("order-1", "bob", "CHANGES")].allowed)
+        self.assertFalse(outcomes[("order-1", "eve", "CHANGES")].allowed)
+        self.assertEqual(outcomes[("order-1", "Admin", "GET_RAW")].channels,
+                         ["orders"])
+
+    @unittest.skipUnless(quickjs, "offline mode needs quickjs")
+    def test_offline_get_raw_grants_are_shaped_like_sync_gateway(self):
+        sync_function = os.path.join(self.json_folder, "grants.js")
+        with open(sync_function, "w") as f:
+            f.write("function (doc, oldDoc) {\n"
+                    "    channel(doc.channels);\n"
+                    "    access(doc.owner, [\"orders\", \"jobs\"]);\n"
+                    "    access(\"role:manager\", \"reports\");\n"
+                    "    role(doc.owner, \"role:manager\");\n"
+                    "}\n")
+        self.work.syncFunctionFile = sync_function
+        self.work.enableOffline()
+        gateway = self.work.offlineGateway
+        admin = {"userName": "", "password": ""}
+        gateway.write("bar", {"_id": "bar", "channels": ["bob"]}, admin, True)
+        gateway.write("foo", {"_id": "foo", "channels": ["bob"],
+                              "owner": "bob"}, admin, True)
+
+        sync = gateway.rawDoc("foo")["_sync"]
+        self.assertEqual(sync["access"], {
+            "bob": {"orders": 2, "jobs": 2},
+            "role:manager": {"reports": 2}
+        })
+        self.assertEqual(sync["role_access"], {"bob": {"manager": 2}})
+        self.assertEqual(syncMetadata("foo", {"_sync": sync}, 0,
+                                      json.dumps)["accessGrants"], 3)
+        # No owner, no grants: the maps are left out as Sync Gateway does
+        self.assertNotIn("role_access", gateway.rawDoc("bar")["_sync"])
+        self.assertIsNone(gateway.rawDoc("nope"))
+
+    @patch('requests.Session.request')
+    def test_sessionAuth_reuses_and_refreshes_session(self, mock_request):
+        sessions = iter(["s1", "s2"])
+        expired = []
+
+        def respond(method, url, **kwargs):
+            response = MagicMock()
+            response.status_code = 200
+            if url.endswith("/_session"):
+                response.json.return_value = {"session_id": next(sessions)}
+            elif not expired and method == "PUT":
+                # The first session expires half way through the run
+                expired.append(kwargs["headers"]["Cookie"])
+                response.status_code = 401
+            else:
+                response.json.return_value = {"_id": "foo", "_rev": "1-a"}
+            return response
+        mock_request.side_effect = respond
+        self.work.sessionAuth = True
+        self.work.operations = ["GET", "PUT", "GET"]
+
+        self.work.openJsonFolder()
+
+        user_calls = [c for c in mock_request.call_args_list
+                      if ":4984/" in c.args[1]]
+        session_calls = [c for c in mock_request.call_args_list
+                         if c.args[1].endswith("/_session")]
+        self.assertEqual(
+            [c.args[1] for c in session_calls],
+            ["http://localhost:4985/sync_gateway/_session"] * 2
+        )
+        self.assertEqual(json.loads(session_calls[0].kwargs["data"]),
+                         {"name": "bob", "ttl": self.work.sessionTtl})
+        self.assertEqual(expired, ["SyncGatewaySession=s1"])
+        # Users never send their password once they have a session
+        self.assertTrue(user_calls)
+        for c in user_calls:
+            self.assertIsNone(c.kwargs["auth"])
+        self.assertEqual(user_calls[-1].kwargs["headers"]["Cookie"],
+                         "SyncGatewaySession=s2")
+        self.assertEqual(self.work.userSessions,
+                         {("sync_gateway", "bob"): "s2"})
+
+    def test_userSession_login_does_not_block_other_users(self):
+        release = threading.Event()
+        logins = []
+
+        def login(userName, password):
+            logins.append(userName)
+            if userName == "bob":
+                release.wait(5)
+            return f"{userName}-session"
+        sessions = []
+        with patch.object(self.work, "createUserSession",
+                          side_effect=login):
+            bobs = [threading.Thread(target=lambda: sessions.append(
+                self.work.userSession("bob", "12345"))) for _ in range(2)]
+            for thread in bobs:
+                thread.start()
+            while not logins:
+                time.sleep(0.01)
+            # Alice logs in while bob's login is still waiting
+            self.assertEqual(self.work.userSession("alice", "pw"),
+                             "alice-session")
+            release.set()
+            for thread in bobs:
+                thread.join()
+        self.assertEqual(sessions, ["bob-session"] * 2)
+        # The second bob found the session the first one created
+        self.assertEqual(sorted(logins), ["alice", "bob"])
+
+    @patch('requests.Session.request')
+    def test_generate_and_teardown(self, mock_request):
+        def respond(method, url, **kwargs):
+            response = MagicMock()
+            response.status_code = 201 if method == "PUT" else 200
+            if url.endswith("/_purge"):
+                response.json.return_value = {"purged": {
+                    doc_id: ["*"] for doc_id in json.loads(kwargs["data"])}}
+            else:
+                response.json.return_value = {}
+            return response
+        mock_request.side_effect = respond
+        users_file = os.path.join(self.json_folder, "users.jsonl")
+        fixture_file = os.path.join(self.json_folder, "docs.jsonl.gz")
+        self.work.concurrency = 4
+        self.work.batchSize = 3
+        self.work.generator = {
+            "users": 5, "docs": 7, "channelsPerDoc": 2, "seed": 7,
+            "userTemplates": [
+                {"roles": ["user"], "channels": ["{user}"]},
+                {"roles": ["manager"], "channels": ["{user}", "jobs"]}
+            ],
+            "usersFile": users_file, "fixtureFile": fixture_file
+        }
+
+        self.assertEqual(self.work.runGenerate(),
+                         {"roles": 2, "users": 5, "docs": 7})
+
+        urls = [c.args[1] for c in mock_request.call_args_list]
+        admin = "http://localhost:4985/sync_gateway"
+        self.assertEqual(urls[:2], [f"{admin}/_role/manager",
+                                    f"{admin}/_role/user"])
+        self.assertEqual(sorted(urls[2:]),
+                         [f"{admin}/_user/user-{n}" for n in range(5)])
+        users = self.work.readTestUsers(users_file)
+        self.assertEqual(users[1], {
+            "userName": "user-1", "password": "password", "sgSession": "",
+            "roles": ["manager"], "channels": ["user-1", "jobs"]})
+        docs = list(FixtureSource(fixture_file))
+        self.assertEqual([doc["_id"] for doc in docs],
+                         ["order-0", "job-1", "order-2", "job-3", "order-4",
+                          "job-5", "order-6"])
+        for doc in docs:
+            self.assertTrue(1 <= len(doc["channels"]) <= 2)
+            self.assertLessEqual(set(doc["channels"]),
+                                 {user["userName"] for user in users})
+
+        mock_request.reset_mock()
+        self.assertEqual(self.work.runTeardown(),
+                         {"purged": 7, "users": 5, "roles": 2})
+        purges = [json.loads(c.kwargs["data"])
+                  for c in mock_request.call_args_list
+                  if c.args[1].endswith("/_purge")]
+        self.assertEqual([len(purge) for purge in purges], [3, 3, 1])
+
+    @patch('requests.Session.request')
+    def test_openJsonFolder_runs_keyspaces_concurrently(self, mock_request):
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"_id": "foo", "_rev": "1-a"}
+        mock_request.return_value = mock_response
+        self.work.operations = ["GET_ADMIN"]
+        self.work.metricsSlowestDocs = 5
+        self.work.slowestDocs = SlowestDocs(5)
+        self.work.keyspaces = [
+            {"sgDbScope": "inventory", "sgDbCollection": "orders"},
+            {"sgDbScope": "inventory", "sgDbCollection": "jobs",
+             "operations": ["GET_ADMIN", "PURGE"]}
+        ]
+
+        with self.assertLogs(level="INFO") as logs:
+            self.work.openJsonFolder()
+
+        urls = {c.args[1] for c in mock_request.call_args_list}
+        self.assertLessEqual({
+            "http://localhost:4985/sync_gateway.inventory.orders/foo",
+            "http://localhost:4985/sync_gateway.inventory.jobs/foo",
+            "http://localhost:4985/sync_gateway.inventory.jobs/_purge"
+        }, urls)
+        self.assertNotIn(
+            "http://localhost:4985/sync_gateway.inventory.orders/_purge",
+            urls)
+        # Both keyspaces read jsons, so it was parsed once
+        self.assertEqual(list(self.work.fixtureCache), ['"jsons"'])
+        self.assertTrue(any(
+            "[GET] - [Admin]" in line
+            and line.endswith("[keyspace:sync_gateway.inventory.jobs]")
+            for line in [self.work.file_handler.formatter.format(record)
+                         for record in logs.records]))
+        report = self.work.writeMetricsReport()
+        self.assertEqual(report["byOperation"]["GET|admin"]["count"], 2)
+        self.assertEqual(set(report["byKeyspace"]),
+                         {"sync_gateway.inventory.orders",
+                          "sync_gateway.inventory.jobs"})
+        self.assertIn("PURGE|admin",
+                      report["byKeyspace"]["sync_gateway.inventory.jobs"])
+        self.assertIn("GET|admin|sync_gateway.inventory.orders/foo",
+                      [entry["labels"] for entry in report["slowestDocs"]])
+
+    @patch('requests.Session.request')
+    def test_runCompare_reports_only_deltas(self, mock_request):
+        def respond(method, url, **kwargs):
+            response = MagicMock()
+            response.json.return_value = {"ok": True, "_id": "foo",
+                                          "_rev": "1-a"}
+            if method == "PUT" and "/db_new/" in url:
+                response.raise_for_status.side_effect = requests.HTTPError(
+                    response=MagicMock(status_code=403))
+            return response
+        mock_request.side_effect = respond
+        self.work.operations = ["GET_ADMIN", "PUT"]
+        self.work.compare = {"a": {"name": "old", "sgDb": "db_old"},
+                             "b": {"name": "new", "sgDb": "db_new"}}
+
+        with self.assertLogs(level="INFO") as logs:
+            report = self.work.runCompare()
+        self.addCleanup(os.remove,
+                        f"{self.work.logFileName[:-len('.log')]}_diff.json")
+
+        self.assertEqual(report["targets"], {"a": "old", "b": "new"})
+        self.assertEqual(report["compared"], 2)
+        self.assertEqual(report["changed"], 1)
+        self.assertFalse(report["identical"])
+        self.assertEqual(report["flips"], {"PUT:allowed->denied": 1})
+        self.assertEqual(report["details"][0]["user"], "bob")
+        self.assertEqual(set(report["latencyDelta"]),
+                         {"GET|admin", "PUT|user"})
+        self.assertEqual(
+            len([line for line in logs.output if "[DIFF]" in line]), 2)
+
+    @patch('requests.Session.request')
+    def test_resume_skips_steps_in_checkpoint_journal(self, mock_request):
+        def respond(method, url, **kwargs):
+            if method == "POST" and \
+                    json.loads(kwargs["data"]) == {"bar": ["*"]}:
+                raise KeyboardInterrupt
+            response = MagicMock()
+            response.json.return_value = {"ok": True, "_rev": "1-a",
+                                          "purged": {}}
+            return response
+        mock_request.side_effect = respond
+        fixtures = os.path.join(self.json_folder, "docs.jsonl")
+        with open(fixtures, "w") as f:
+            f.write('{"_id": "foo"}\n{"_id": "bar"}\n')
+        journal = "test_checkpoint.jsonl"
+        self.addCleanup(os.remove, journal)
+        self.config.update({"jsonFolder": fixtures,
+                            "operations": ["GET", "PUT", "PURGE"],
+                            "checkpointFile": journal,
+                            "checkpointSyncEvery": 2})
+        with open(self.config_file, 'w') as f:
+            json.dump(self.config, f)
+        self.work.closeLogFile()
+        self.work = Work(self.config_file)
+
+        # Ctrl-C while purging bar, in the middle of writing a line
+        with self.assertRaises(KeyboardInterrupt):
+            self.work.openJsonFolder()
+        self.work.closeCheckpoint()
+        self.work.closeLogFile()
+        with open(journal, "a") as f:
+            f.write('{"ks": "sync_gateway", "doc"')
+
+        mock_request.reset_mock(side_effect=True)
+        mock_request.side_effect = None
+        mock_request.return_value.json.return_value = {
+            "purged": {"bar": ["*"]}}
+        self.work = Work(self.config_file, resume=True)
+        self.assertEqual(self.work.checkpoint.revs[("sync_gateway", "bar")],
+                         "1-a")
+        self.work.openJsonFolder()
+        self.work.closeCheckpoint()
+
+        # Only the purge of bar was left to do
+        self.assertEqual(
+            [(c.args[0], c.args[1]) for c in mock_request.call_args_list],
+            [("POST", "http://localhost:4985/sync_gateway/_purge")])
+        with open(journal) as f:
+            header, *steps = [json.loads(line) for line in f]
+        self.assertEqual(header, {"batchMode": False})
+        self.assertEqual(len(steps), 6)
+        self.assertEqual(steps[-1], {"ks": "sync_gateway", "doc": "bar",
+                                     "step": 2, "user": "bob", "rev": None})
+
+        # Batch mode journals admin steps differently, it cannot resume
+        self.config["batchMode"] = True
+        with open(self.config_file, 'w') as f:
+            json.dump(self.config, f)
+        with self.assertRaises(Exception) as raised:
+            Work(self.config_file, resume=True)
+        self.assertIn("batchMode", str(raised.exception))
+
+    def test_compilePlan_parses_operations_once(self):
+        with self.assertLogs(level="WARNING") as logs:
+            plan = self.work.compilePlan(
+                ["GET", "CHANGES_ADMIN:bob", "SLEEP:3", "NOPE"], 5)
+        self.assertIs(plan, self.work.compilePlan(
+            ["GET", "CHANGES_ADMIN:bob", "SLEEP:3", "NOPE"], 5))
+        self.assertEqual([step.index for step in plan], [5, 6, 7, 8])
+        self.assertEqual((plan[1].op, plan[1].is_admin, plan[1].params),
+                         ("CHANGES", True, "bob"))
+        self.assertIs(plan[1].handler, Work.runChanges)
+        self.assertEqual(plan[2].sleep, 3)
+        self.assertIsNone(plan[3].handler)
+        self.assertIn("NOPE", logs.output[0])
+        self.assertEqual(self.work.docUrl("foo", True),
+                         "http://localhost:4985/sync_gateway/foo")
+
+    @patch('requests.Session.request')
+    def test_plugin_operation(self, mock_request):
+        plugin = os.path.join(self.json_folder, "touch_plugin.py")
+        with open(plugin, "w") as f:
+            f.write(
+                "from sg_sync_function_tester import registerOperation\n"
+                "@registerOperation('TOUCH', admin=True)\n"
+                "def touch(work, json_data, user, is_admin, params, log):\n"
+                "    work.httpCall('POST', work.docUrl(json_data['_id'],\n"
+                "                  True) + '?' + params, is_admin=True)\n"
+                "    return 'success'\n")
+        self.addCleanup(OPERATIONS.pop, "TOUCH", None)
+        self.work.plugins = [plugin]
+        self.work.loadPlugins()
+        self.work.operations = ["TOUCH:new_edits=false"]
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+
+        self.work.openJsonFolder()
+
+        mock_request.assert_called_once()
+        self.assertEqual(mock_request.call_args.args, (
+            "POST", "http://localhost:4985/sync_gateway/foo?new_edits=false"))
+        self.assertEqual((outcomes[0].op, outcomes[0].user),
+                         ("TOUCH", "Admin"))
+
+    def test_HashRing_is_stable_and_moves_few_docs(self):
+        ids = [f"order-{n}" for n in range(2000)]
+        ring, again = HashRing(3), HashRing(3)
+        three = [ring.owner(doc_id) for doc_id in ids]
+        self.assertEqual(three, [again.owner(doc_id) for doc_id in ids])
+        for shard in range(3):
+            self.assertGreater(three.count(shard), 2000 / 3 * 0.7)
+        ring = HashRing(4)
+        four = [ring.owner(doc_id) for doc_id in ids]
+        moved = sum(a != b for a, b in zip(three, four))
+        self.assertLess(moved, 2000 / 4 * 1.4)
+        self.assertTrue(all(a == b for a, b in zip(three, four) if b != 3))
+
+    def test_distributed_run_merges_shards(self):
+        for n in range(12):
+            with open(os.path.join(self.json_folder, f"doc{n}.json"),
+                      "w") as f:
+                json.dump({"_id": f"doc{n}", "channels": ["bob"]}, f)
+        expectations = os.path.join(self.json_folder, "expect.jsonl")
+        with open(expectations, "w") as f:
+            for n in range(12):
+                f.write(json.dumps({"docId": f"doc{n}", "user": "bob",
+                                    "op": "GET", "allowed": True}) + "\n")
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        self.config.update(gateway.config())
+        self.config.update({
+            "operations": ["PUT", "GET"],
+            "expectationsFile": expectations,
+            "distributed": {"workers": 1, "remoteWorkers": 1,
+                            "listen": f"127.0.0.1:{port}",
+                            "coordinator": f"127.0.0.1:{port}",
+                            "authKey": "s3cret", "workerWaitSeconds": 30}
+        })
+        with open(self.config_file, "w") as f:
+            json.dump(self.config, f)
+        worker = threading.Thread(target=main,
+                                  args=(["worker", self.config_file],))
+        worker.start()
+
+        self.assertEqual(main([self.config_file]), 0)
+        worker.join()
+
+        # 13 documents, foo included, each PUT (after a rev lookup) and GET
+        self.assertEqual(gateway.requests, 13 * 3)
+        self.assertEqual(len(gateway.keyspaces["sync_gateway"]), 13)
+        logs = glob.glob("sync_gateway_log_shard*.log")
+        self.assertEqual({log.split("_")[3] for log in logs},
+                         {"shard0", "shard1"})
+        with open(sorted(glob.glob("sync_gateway_log_2*.log"))[-1]) as f:
+            log = f.read()
+        self.assertIn('"PUT|user": {"count": 13', log)
+        self.assertIn('"GET|user": {"count": 13', log)
+        self.assertIn("[success] - [EXPECT] - 12 results checked", log)
+        self.assertIn("0 expectations not run", log)
+
+    def test_serveShards_refuses_open_listen_without_authKey(self):
+        self.work.distributed = {"listen": "0.0.0.0:7788", "authKey": ""}
+        with self.assertRaises(Exception) as raised:
+            self.work.serveShards([1], 2, "run")
+        self.assertIn("authKey", str(raised.exception))
+        self.assertTrue(isLoopback("127.0.0.1"))
+        self.assertTrue(isLoopback("[::1]"))
+        self.assertTrue(isLoopback("localhost"))
+        self.assertFalse(isLoopback("0.0.0.0"))
+        self.assertFalse(isLoopback("sg-coordinator"))
+
+    def test_serveShards_stalled_connection_does_not_block_workers(self):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        self.work.distributed = {"listen": f"127.0.0.1:{port}",
+                                 "authKey": "s3cret", "workerWaitSeconds": 5}
+        results = []
+
+        def serve(conn, address, shard, count, command):
+            conn.close()
+            return shard
+        with patch.object(self.work, "serveShard", side_effect=serve):
+            coordinator = threading.Thread(target=lambda: results.extend(
+                self.work.serveShards([1], 2, "run")))
+            coordinator.start()
+            while True:
+                try:
+                    stalled = socket.create_connection(("127.0.0.1", port))
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            self.addCleanup(stalled.close)
+            started = time.monotonic()
+            with socket.create_connection(("127.0.0.1", port)) as worker, \
+                    worker.makefile("rwb") as stream:
+                challenge = readMessage(stream)["challenge"]
+                writeMessage(stream, {"auth": shardAuth("s3cret", challenge)})
+                coordinator.join(5)
+        self.assertFalse(coordinator.is_alive())
+        # Well within the 10 s the stalled connection has to answer
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(results, [1])
+
+    def test_AdaptiveConcurrency_aimd(self):
+        limiter = AdaptiveConcurrency(8, minimum=2)
+        self.assertEqual(limiter.summary()["limit"], 2)
+        for _ in range(40):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.summary()["limit"], 8)
+        limiter.acquire()
+        limiter.acquire()
+        limiter.release(0.01, throttled=True)
+        # A second 503 from the same round trip does not halve it again
+        limiter.release(0.01, throttled=True)
+        self.assertEqual(limiter.summary(), {
+            "limit": 4, "lowest": 2, "highest": 8, "decreases": 1})
+        for _ in range(30):
+            limiter.acquire()
+            limiter.release(0.01)
+        # Five times the usual latency counts as a spike
+        limiter.acquire()
+        time.sleep(0.02)
+        limiter.release(0.05)
+        self.assertEqual(limiter.summary()["decreases"], 2)
+        # A longpoll held open for seconds is not a spike
+        limiter.acquire()
+        limiter.release(5.0, sample=False)
+        self.assertEqual(limiter.summary()["decreases"], 2)
+        limiter.acquire()
+        time.sleep(0.02)
+        limiter.release(5.0)
+        self.assertEqual(limiter.summary()["decreases"], 3)
+
+    def test_pacedRequest_counts_connection_errors_apart(self):
+        self.work.concurrencyLimit = AdaptiveConcurrency(8, minimum=8)
+        pooled = MagicMock()
+        pooled.request.side_effect = requests.ConnectionError("refused")
+        with self.assertRaises(requests.ConnectionError):
+            self.work.pacedRequest(pooled, "GET", "http://sg/db/doc1", "bob")
+        report = self.work.backpressure.summary()
+        self.assertEqual(report["connectionErrors"], 1)
+        self.assertFalse([key for key in report
+                          if key.startswith("throttled")])
+        self.assertEqual(self.work.concurrencyLimit.summary()["decreases"], 1)
+
+        # A longpoll that comes back after 0.2 s leaves the limit alone
+        limiter = self.work.concurrencyLimit = AdaptiveConcurrency(8)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.001)
+
+        def held(*args, **kwargs):
+            time.sleep(0.2)
+            return MagicMock(status_code=200)
+        pooled.request.side_effect = held
+        self.work.pacedRequest(
+            pooled, "GET", "http://sg/db/_changes?feed=longpoll", "bob")
+        self.assertEqual(limiter.summary()["decreases"], 0)
+
+    def test_rate_limits_and_retry_after(self):
+        self.assertEqual(retryAfterSeconds("3"), 3.0)
+        self.assertIsNone(retryAfterSeconds("soon"))
+        self.assertAlmostEqual(retryAfterSeconds(
+            (datetime.now(timezone.utc) + timedelta(seconds=30))
+            .strftime("%a, %d %b %Y %H:%M:%S GMT")), 30, delta=2)
+        self.work.rateLimit = 100
+        self.work.opRateLimits = {"PUT": 20}
+        started = time.monotonic()
+        self.work.acquireRate("bob")
+        self.work.opContext.op = "PUT"
+        for _ in range(4):
+            self.work.acquireRate("bob")
+        # The first PUT token is free, the other three wait 1/20 s each
+        self.assertGreaterEqual(time.monotonic() - started, 0.14)
+        self.assertGreater(
+            self.work.backpressure.summary()["rateLimitWaitSeconds"], 0.1)
+
+    def test_backpressure_retries_within_budget(self):
+        gateway = MockSyncGateway(throttleEvery=3).start()
+        self.addCleanup(gateway.stop)
+        for n in range(10):
+            with open(os.path.join(self.json_folder, f"doc{n}.json"),
+                      "w") as f:
+                json.dump({"_id": f"doc{n}", "channels": ["bob"]}, f)
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        self.work.operations = ["PUT", "GET"]
+        self.work.concurrency = 4
+        self.work.concurrencyLimit = AdaptiveConcurrency(4)
+        # Threads share the throttling, a request may be unlucky in a row
+        self.work.httpMaxRetries = 10
+        self.work.backpressure.ratio = 1.0
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+
+        self.work.openJsonFolder()
+
+        self.assertEqual({outcome.status for outcome in outcomes},
+                         {"success"})
+        report = self.work.backpressureReport()
+        self.assertEqual(report["throttled503"], gateway.throttled)
+        self.assertEqual(report["retries"], gateway.throttled)
+        self.assertEqual(report["retryAfterHonored"], gateway.throttled)
+        self.assertGreater(report["concurrency"]["decreases"], 0)
+
+        # Once the budget is spent a 503 fails the operation, loudly
+        self.work.backpressure.ratio = 0
+        self.work.revCache.clear()
+        outcomes.clear()
+        with self.assertLogs(level="ERROR") as logs:
+            self.work.openJsonFolder()
+        self.assertIn("failed", {outcome.status for outcome in outcomes})
+        self.assertIn("503", logs.output[0])
+        self.assertGreater(
+            self.work.backpressure.summary()["retryBudgetExhausted"], 0)
+
+    def test_contention_counts_conflicts_and_rev_tree(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        self.work.jsonFolder = os.path.join(self.json_folder, "foo.json")
+        self.work.operations = ["PUT", "GET", "DELETE"]
+        self.work.contention = {"writers": 6, "rounds": 2, "maxRetries": 50}
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+
+        report = self.work.runContention()
+
+        put = report["byOperation"]["PUT"]
+        self.assertEqual(put["writes"], 12)
+        self.assertEqual(put["succeeded"], 12)
+        # Every attempt but the winning one lost the race on _rev
+        self.assertEqual(put["conflicts"], put["attempts"] - 12)
+        self.assertGreater(put["conflicts"], 0)
+        self.assertEqual(put["retriesPerWrite"],
+                         round(put["conflicts"] / 12, 3))
+        self.assertEqual(put["latency"]["count"], 12)
+        # One writer deletes the document, the others find it gone
+        delete = report["byOperation"]["DELETE"]
+        self.assertEqual(delete["succeeded"], 1)
+        self.assertEqual(delete["gone"], 11)
+        self.assertEqual(report["revTrees"]["foo"]["depth"], 13)
+        self.assertEqual(report["revTrees"]["foo"]["storedRevs"], 13)
+        self.assertEqual(report["revTrees"]["foo"]["leaves"], 1)
+        self.assertEqual(report["maxRevTreeDepth"], 13)
+        self.assertEqual(len(outcomes), 24)
+        self.assertNotIn("GET", {outcome.op for outcome in outcomes})
+
+    def test_probe_measures_propagation_to_changes(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        self.work.jsonFolder = os.path.join(self.json_folder, "foo.json")
+        self.work.probeTimeoutMs = 300
+        self.work.changesTimeoutMs = 100
+        self.work.operations = ["PROBE", "PROBE:nobody"]
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+
+        self.work.openJsonFolder()
+
+        self.assertEqual([(outcome.op, outcome.status, outcome.allowed)
+                          for outcome in outcomes],
+                         [("PROBE", "success", True),
+                          ("PROBE", "failed", False)])
+        self.assertEqual(outcomes[1].rev.split("-")[0], "2")
+        seen = self.work.propagation.histogram(("bob", "bob"))
+        self.assertEqual((seen.count, seen.errors), (1, 0))
+        self.assertLess(seen.max, 0.3)
+        # A channel the document is not in never shows it, the probe
+        # times out
+        missed = self.work.propagation.histogram(("bob", "nobody"))
+        self.assertEqual((missed.count, missed.errors), (1, 1))
+        self.assertGreaterEqual(missed.max, 0.3)
+        with open(self.work.logFileName) as f:
+            log = f.read()
+        self.assertIn("[PROPAGATION]", log)
+        self.assertIn('"bob|nobody": {"count": 1, "errors": 1', log)
+
+    def test_probe_skips_rows_with_a_malformed_rev(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        self.work.jsonFolder = os.path.join(self.json_folder, "foo.json")
+        self.work.probeTimeoutMs = 300
+        self.work.changesTimeoutMs = 100
+        self.work.operations = ["PROBE"]
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+        readChanges = self.work.readChanges
+
+        def garbled(url, onRow, **kwargs):
+            if "feed=longpoll" in url:
+                onRow({"id": "foo", "changes": [{"rev": "garbage"}, None]})
+            return readChanges(url, onRow, **kwargs)
+
+        with patch.object(self.work, "readChanges", side_effect=garbled):
+            self.work.openJsonFolder()
+
+        self.assertEqual([(outcome.status, outcome.allowed)
+                          for outcome in outcomes], [("success", True)])
+
+    def test_syncMetadata_counts_grants_and_history(self):
+        raw = {"docType": "order", "_sync": {
+            "rev": {"rev": "3-abc"},
+            "history": {"revs": ["1-a", "2-b", "3-abc", "2-c"],
+                        "parents": [-1, 0, 1, 0]},
+            "channels": {"bob": None, "old": {"seq": 5, "rev": "2-b"}},
+            "channel_set": [{"name": "bob", "start": 1}],
+            "channel_set_history": [{"name": "old", "start": 1, "end": 5}],
+            "access": {"bob": {"orders": 3, "jobs": 3}, "ann": {"x": 3}},
+            "role_access": {"bob": {"manager": 3}},
+            "attachments": {"receipt.pdf": {"length": 10}}
+        }}
+        metrics = syncMetadata("foo", raw, 500, json.dumps)
+        self.assertEqual(metrics, {
+            "docType": "order", "bytes": 500,
+            "syncBytes": len(json.dumps(raw["_sync"])),
+            "revTreeDepth": 3, "storedRevs": 4, "leaves": 2,
+            "channels": 1, "removedChannels": 1, "channelHistory": 2,
+            "accessGrants": 3, "roleGrants": 1, "attachments": 1
+        })
+        self.assertEqual(syncMetadata("job-1", {}, 2, json.dumps)["docType"],
+                         "job")
+
+    def test_analyze_reports_and_compares_snapshots(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        docs = gateway.keyspaces.setdefault("sync_gateway", {})
+        with open(os.path.join(self.json_folder, "docs.jsonl"), "w") as f:
+            for doc_id in ("order-1", "order-2", "job-1", "gone-1"):
+                f.write(json.dumps({"_id": doc_id}) + "\n")
+                if doc_id != "gone-1":
+                    with gateway.lock:
+                        gateway.write(docs, doc_id, {"channels": ["bob"]})
+        self.work.jsonFolder = os.path.join(self.json_folder, "docs.jsonl")
+        self.work.concurrency = 4
+        snapshot = os.path.join(self.json_folder, "before.json")
+        self.work.analyze = {"top": 2, "reportFile": snapshot}
+
+        report = self.work.runAnalyze()
+
+        self.assertEqual(report["documents"], 3)
+        self.assertEqual(report["missing"], ["gone-1"])
+        self.assertEqual(set(report["byDocType"]), {"order", "job"})
+        self.assertEqual(report["byDocType"]["order"]["docs"], 2)
+        self.assertEqual(report["totals"]["revTreeDepth"]["max"], 1)
+        self.assertEqual(report["totals"]["channels"]["total"], 3)
+        self.assertEqual(len(report["top"]["syncBytes"]), 2)
+
+        # order-1 gets three more revisions
+        with gateway.lock:
+            for _ in range(3):
+                gateway.write(docs, "order-1", {
+                    "_rev": docs["order-1"]["rev"], "channels": ["bob"]})
+        self.work.analyze = {"baselineFile": snapshot,
+                             "reportFile": snapshot + ".2"}
+        comparison = self.work.runAnalyze()["comparison"]
+
+        self.assertEqual(comparison["byDocType"]["order"]["revTreeDepth"],
+                         1.5)
+        self.assertEqual(comparison["byDocType"]["job"]["revTreeDepth"], 0)
+        self.assertEqual([grown["docId"] for grown in comparison["grown"]],
+                         ["order-1"])
+        self.assertEqual((comparison["newDocs"], comparison["goneDocs"]),
+                         (0, 0))
+
+    def test_capture_then_replay_into_another_keyspace(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        capture = os.path.join(self.json_folder, "capture.jsonl")
+        config = dict(self.config, **gateway.config(),
+                      jsonFolder=os.path.join(self.json_folder, "foo.json"),
+                      operations=["PUT", "GET", "PUT", "DELETE"],
+                      captureFile=capture, captureBodies=True)
+        work = Work(config)
+        work.openJsonFolder()
+        work.closeSessions()
+        work.closeLogFile()
+        with open(capture) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(
+            [(entry["method"], entry["path"], entry["op"], entry["status"])
+             for entry in entries],
+            [("GET", "/sync_gateway/foo", "PUT", 404),
+             ("PUT", "/sync_gateway/foo", "PUT", 201),
+             ("GET", "/sync_gateway/foo", "GET", 200),
+             ("PUT", "/sync_gateway/foo", "PUT", 201),
+             ("DELETE", entries[4]["path"], "DELETE", 200)])
+        self.assertEqual(entries[1]["user"], "bob")
+        self.assertEqual(entries[1]["bodyHash"], hashlib.sha1(
+            JsonCodec().dumps(entries[1]["body"])).hexdigest())
+
+        replay = Work(dict(config, captureFile="", replay={
+            "file": capture, "speed": 0,
+            "rewrite": {"sync_gateway": "replayed"}}))
+        self.addCleanup(replay.closeSessions)
+        self.addCleanup(replay.closeLogFile)
+        report = replay.runReplay()
+
+        self.assertEqual(report["requests"], 5)
+        self.assertEqual(report["pipelines"], 1)
+        # The replay's own revisions replace the captured ones
+        self.assertNotIn("statusChanged", report["counts"])
+        self.assertTrue(gateway.keyspaces["replayed"]["foo"]["deleted"])
+        self.assertEqual(
+            report["byOperation"]["PUT"]["count"], 3)
+
+    def test_replay_keeps_spacing_scaled_by_speed(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        self.work.jsonFolder = os.path.join(self.json_folder, "foo.json")
+        capture = os.path.join(self.json_folder, "capture.jsonl")
+        with open(capture, "w") as f:
+            # A PUT captured without its body sends the fixture
+            for at, method, user, status in (
+                    (100.0, "PUT", "bob", 201), (100.3, "GET", "bob", 200),
+                    (100.4, "GET", "eve", 200), (100.6, "GET", "bob", 200)):
+                f.write(json.dumps({
+                    "at": at, "method": method, "path": "/sync_gateway/foo",
+                    "admin": False, "user": user, "op": method,
+                    "status": status}) + "\n")
+        self.work.replay = {"file": capture, "speed": 2}
+
+        report = self.work.runReplay()
+
+        self.assertEqual(report["requests"], 3)
+        self.assertEqual(report["counts"]["unknownUser"], 1)
+        self.assertEqual(report["counts"]["http201"], 1)
+        self.assertEqual(report["capturedSeconds"], 0.6)
+        self.assertGreaterEqual(report["durationSeconds"], 0.29)
+        self.assertLess(report["durationSeconds"], 0.6)
+        self.assertEqual(
+            gateway.keyspaces["sync_gateway"]["foo"]["body"]["channels"],
+            ["bob"])
+
+    # 40 documents, every fourth one in a channel bob does not filter on
+    def changesCorpus(self, gateway):
+        for key, value in gateway.config().items():
+            setattr(self.work, key, value)
+        corpus = os.path.join(self.json_folder, "corpus.jsonl")
+        with open(corpus, "w") as f:
+            for n in range(40):
+                f.write(json.dumps({
+                    "_id": f"doc-{n}",
+                    "channels": ["other" if n % 4 == 0 else "bob"]
+                }) + "\n")
+        self.work.jsonFolder = corpus
+        outcomes = []
+        self.work.outcomeListeners.append(outcomes.append)
+        return outcomes
+
+    def assertChangesVisibility(self, outcomes):
+        allowed = {outcome.doc_id: outcome.allowed for outcome in outcomes
+                   if outcome.op == "CHANGES"}
+        self.assertEqual(allowed, {f"doc-{n}": n % 4 != 0
+                                   for n in range(40)})
+
+    def test_changes_read_only_pass_sees_every_visible_doc(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        outcomes = self.changesCorpus(gateway)
+        docs = gateway.keyspaces.setdefault("sync_gateway", {})
+        with gateway.lock:
+            for n in range(40):
+                gateway.write(docs, f"doc-{n}", {
+                    "channels": ["other" if n % 4 == 0 else "bob"]})
+        self.work.operations = ["CHANGES:bob"]
+
+        self.work.openJsonFolder()
+
+        # The first read returns every document, the cursor then sits
+        # past all of them, and later documents are still reported
+        self.assertChangesVisibility(outcomes)
+        self.assertEqual(gateway.requests, 40)
+
+    def test_changes_after_concurrent_puts_sees_every_visible_doc(self):
+        gateway = MockSyncGateway().start()
+        self.addCleanup(gateway.stop)
+        outcomes = self.changesCorpus(gateway)
+        self.work.operations = ["PUT", "CHANGES:bob"]
+        self.work.concurrency = 8
+
+        self.work.openJsonFolder()
+
+        self.assertChangesVisibility(outcomes)
+
+    def test_getSession_pooled_per_credential(self):
+        bob = self.work.getSession("bob")
+        self.assertIs(bob, self.work.getSession("bob"))
+        self.assertIsNot(bob, self.work.getSession("alice"))
+        self.assertIsNot(bob, self.work.getSession(is_admin=True))
+        adapter = bob.get_adapter("http://localhost:4984/")
+        self.assertEqual(adapter.max_retries.total, self.work.httpMaxRetries)
+        self.work.closeSessions()
+        self.assertEqual(self.work.sessions, {})
+
     def test_constructDbUrl(self):
         self.assertEqual(self.work.constructDbUrl(), "sync_gateway")
         self.work.sgDbScope = "scope1"